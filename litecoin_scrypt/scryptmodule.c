@@ -4,19 +4,18 @@
 
 static PyObject *scrypt_getpowhash(PyObject *self, PyObject *args)
 {
-    char *output;
-    PyObject *value;
-    PyStringObject *input;
-    if (!PyArg_ParseTuple(args, "S", &input))
+    char input[80] = {0};
+    char output[32];
+    PyStringObject *value;
+    if (!PyArg_ParseTuple(args, "S", &value))
         return NULL;
-    Py_INCREF(input);
-    output = PyMem_Malloc(32);
+    /* hash a copy so that the GIL can be released while scrypt runs */
+    memcpy(input, PyString_AS_STRING(value), PyString_GET_SIZE(value) < 80 ? PyString_GET_SIZE(value) : 80);
 
-    scrypt_1024_1_1_256((char *)PyString_AsString((PyObject*) input), output);
-    Py_DECREF(input);
-    value = Py_BuildValue("s#", output, 32);
-    PyMem_Free(output);
-    return value;
+    Py_BEGIN_ALLOW_THREADS
+    scrypt_1024_1_1_256(input, output);
+    Py_END_ALLOW_THREADS
+    return Py_BuildValue("s#", output, 32);
 }
 
 static PyMethodDef ScryptMethods[] = {
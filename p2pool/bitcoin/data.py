@@ -177,32 +177,78 @@ def merkle_hash(hashes):
             for left, right in zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])]
     return hash_list[0]
 
-def calculate_merkle_link(hashes, index):
-    # XXX optimize this
+class MerkleTree(object):
+    '''
+    Merkle tree over a list of hashes, kept as packed 32-byte strings, that
+    can be extended with append(). Unknown hashes (None) are allowed; any node
+    depending on one is None, which is fine as long as it isn't needed as a
+    branch element. Appending only rehashes the right edge of each level.
+    '''
     
-    hash_list = [(lambda _h=h: _h, i == index, []) for i, h in enumerate(hashes)]
+    _hash_type = pack.IntType(256)
     
-    while len(hash_list) > 1:
-        hash_list = [
-            (
-                lambda _left=left, _right=right: hash256(merkle_record_type.pack(dict(left=_left(), right=_right()))),
-                left_f or right_f,
-                (left_l if left_f else right_l) + [dict(side=1, hash=right) if left_f else dict(side=0, hash=left)],
-            )
-            for (left, left_f, left_l), (right, right_f, right_l) in
-                zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])
-        ]
+    def __init__(self, hashes=[]):
+        self.hashes = []
+        self.levels = [[]]
+        self.append(hashes)
+    
+    @staticmethod
+    def _combine(left, right):
+        if left is None or right is None:
+            return None
+        return hashlib.sha256(hashlib.sha256(left + right).digest()).digest()
+    
+    def append(self, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return
+        self.hashes.extend(hashes)
+        
+        level = self.levels[0]
+        start = len(level)
+        level.extend(None if h is None else self._hash_type.pack(h) for h in hashes)
+        
+        i = 0
+        while len(self.levels[i]) > 1:
+            level = self.levels[i]
+            if i + 1 == len(self.levels):
+                self.levels.append([])
+            parent = self.levels[i + 1]
+            start //= 2
+            del parent[start:]
+            for j in xrange(2*start, len(level), 2):
+                parent.append(self._combine(level[j], level[j + 1] if j + 1 < len(level) else level[j]))
+            i += 1
+        del self.levels[i + 1:]
+    
+    def __len__(self):
+        return len(self.hashes)
+    
+    def get_root(self):
+        if not self.hashes:
+            return 0
+        root = self.levels[-1][0]
+        return None if root is None else self._hash_type.unpack(root)
     
-    res = [x['hash']() for x in hash_list[0][2]]
+    def get_link(self, index):
+        assert 0 <= index < len(self.hashes)
+        branch = []
+        i = index
+        for level in self.levels[:-1]:
+            sibling = level[i ^ 1] if i ^ 1 < len(level) else level[i]
+            branch.append(None if sibling is None else self._hash_type.unpack(sibling))
+            i //= 2
+        return dict(branch=branch, index=index)
+
+def calculate_merkle_link(hashes, index):
+    res = MerkleTree(hashes).get_link(index)
     
-    assert hash_list[0][1]
     if p2pool.DEBUG:
         new_hashes = [random.randrange(2**256) if x is None else x
             for x in hashes]
-        assert check_merkle_link(new_hashes[index], dict(branch=res, index=index)) == merkle_hash(new_hashes)
-    assert index == sum(k*2**i for i, k in enumerate([1-x['side'] for x in hash_list[0][2]]))
+        assert check_merkle_link(new_hashes[index], res) == merkle_hash(new_hashes)
     
-    return dict(branch=res, index=index)
+    return res
 
 def check_merkle_link(tip_hash, link):
     if link['index'] >= 2**len(link['branch']):
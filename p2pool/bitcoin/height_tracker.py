@@ -91,6 +91,8 @@ class HeightTracker(object):
 @defer.inlineCallbacks
 def get_height_rel_highest_func(bitcoind, factory, best_block_func, net):
     if '\ngetblock ' in (yield deferral.retry()(bitcoind.rpc_help)()):
+        # lookups started in the same reactor tick (e.g. while scoring many
+        # heads) are sent to bitcoind as one batch request by HTTPProxy
         @deferral.DeferredCacher
         @defer.inlineCallbacks
         def height_cacher(block_hash):
@@ -10,16 +10,55 @@ from p2pool.util import deferral, jsonrpc
 @deferral.retry('Error while checking Bitcoin connection:', 1)
 @defer.inlineCallbacks
 def check(bitcoind, net):
-    if not (yield net.PARENT.RPC_CHECK(bitcoind)):
+    # issued together so that they share a round trip
+    res = yield defer.DeferredList([net.PARENT.RPC_CHECK(bitcoind), bitcoind.rpc_getinfo()], consumeErrors=True)
+    for success, result in res:
+        if not success:
+            result.raiseException()
+    (_, check_passed), (_, getinfo) = res
+    if not check_passed:
         print >>sys.stderr, "    Check failed! Make sure that you're connected to the right bitcoind with --bitcoind-rpc-port!"
         raise deferral.RetrySilentlyException()
-    if not net.VERSION_CHECK((yield bitcoind.rpc_getinfo())['version']):
+    if not net.VERSION_CHECK(getinfo['version']):
         print >>sys.stderr, '    Bitcoin version too old! Upgrade to 0.6.4 or newer!'
         raise deferral.RetrySilentlyException()
 
+def _get_transactions(txs, known_txs):
+    '''
+    Returns (hash -> tx, hashes in template order) for getblocktemplate/getmemorypool
+    transaction entries, only decoding entries missing from known_txs (hash -> tx).
+    '''
+    txs_by_hash = {}
+    tx_hashes = []
+    for x in txs:
+        tx_hash = None
+        if isinstance(x, dict):
+            tx_hash_hex = x.get('txid', x.get('hash', None))
+            if tx_hash_hex is not None:
+                tx_hash = int(tx_hash_hex, 16)
+            x = x['data']
+        if tx_hash is None or tx_hash not in known_txs:
+            packed_tx = x.decode('hex')
+            if tx_hash is None:
+                tx_hash = bitcoin_data.hash256(packed_tx)
+            elif p2pool.DEBUG:
+                assert tx_hash == bitcoin_data.hash256(packed_tx)
+        if tx_hash in known_txs:
+            tx = known_txs[tx_hash]
+        else:
+            tx = bitcoin_data.tx_type.unpack(packed_tx)
+        txs_by_hash[tx_hash] = tx
+        tx_hashes.append(tx_hash)
+    return txs_by_hash, tx_hashes
+
 @deferral.retry('Error getting work from bitcoind:', 3)
 @defer.inlineCallbacks
-def getwork(bitcoind, use_getblocktemplate=False):
+def getwork(bitcoind, use_getblocktemplate=False, last_work=None):
+    '''
+    If last_work, a previous result of getwork, is given, transactions that
+    were already in it aren't decoded again, and added_transaction_hashes
+    and removed_transaction_hashes are relative to it.
+    '''
     def go():
         if use_getblocktemplate:
             return bitcoind.rpc_getblocktemplate(dict(mode='template'))
@@ -38,7 +77,8 @@ def getwork(bitcoind, use_getblocktemplate=False):
         except jsonrpc.Error_for_code(-32601): # Method not found
             print >>sys.stderr, 'Error: Bitcoin version too old! Upgrade to v0.5 or newer!'
             raise deferral.RetrySilentlyException()
-    packed_transactions = [(x['data'] if isinstance(x, dict) else x).decode('hex') for x in work['transactions']]
+    last_txs = last_work['transactions_by_hash'] if last_work is not None else {}
+    txs_by_hash, tx_hashes = _get_transactions(work['transactions'], last_txs)
     if 'height' not in work:
         work['height'] = (yield bitcoind.rpc_getblock(work['previousblockhash']))['height'] + 1
     elif p2pool.DEBUG:
@@ -46,9 +86,12 @@ def getwork(bitcoind, use_getblocktemplate=False):
     defer.returnValue(dict(
         version=work['version'],
         previous_block=int(work['previousblockhash'], 16),
-        transactions=map(bitcoin_data.tx_type.unpack, packed_transactions),
-        transaction_hashes=map(bitcoin_data.hash256, packed_transactions),
+        transactions=[txs_by_hash[tx_hash] for tx_hash in tx_hashes],
+        transaction_hashes=tx_hashes,
         transaction_fees=[x.get('fee', None) if isinstance(x, dict) else None for x in work['transactions']],
+        transactions_by_hash=txs_by_hash,
+        added_transaction_hashes=[tx_hash for tx_hash in tx_hashes if tx_hash not in last_txs],
+        removed_transaction_hashes=[tx_hash for tx_hash in last_txs if tx_hash not in txs_by_hash],
         subsidy=work['coinbasevalue'],
         time=work['time'] if 'time' in work else work['curtime'],
         bits=bitcoin_data.FloatingIntegerType().unpack(work['bits'].decode('hex')[::-1]) if isinstance(work['bits'], (str, unicode)) else bitcoin_data.FloatingInteger(work['bits']),
@@ -60,28 +103,27 @@ def getwork(bitcoind, use_getblocktemplate=False):
     ))
 
 @deferral.retry('Error submitting primary block: (will retry)', 10, 10)
-def submit_block_p2p(block, factory, net):
+def submit_block_p2p(block, factory, net, packed_block):
     if factory.conn.value is None:
         print >>sys.stderr, 'No bitcoind connection when block submittal attempted! %s%064x' % (net.PARENT.BLOCK_EXPLORER_URL_PREFIX, bitcoin_data.hash256(bitcoin_data.block_header_type.pack(block['header'])))
         raise deferral.RetrySilentlyException()
-    factory.conn.value.send_block(block=block)
+    factory.conn.value.send_packed_block(packed_block)
 
 @deferral.retry('Error submitting block: (will retry)', 10, 10)
 @defer.inlineCallbacks
-def submit_block_rpc(block, ignore_failure, bitcoind, bitcoind_work, net):
+def submit_block_rpc(block, ignore_failure, bitcoind, bitcoind_work, net, block_hex, pow_hash=None):
     if bitcoind_work.value['use_getblocktemplate']:
         try:
-            result = yield bitcoind.rpc_submitblock(bitcoin_data.block_type.pack(block).encode('hex'))
+            result = yield bitcoind.rpc_submitblock(block_hex)
         except jsonrpc.Error_for_code(-32601): # Method not found, for older litecoin versions
-            result = yield bitcoind.rpc_getblocktemplate(dict(mode='submit', data=bitcoin_data.block_type.pack(block).encode('hex')))
+            result = yield bitcoind.rpc_getblocktemplate(dict(mode='submit', data=block_hex))
         success = result is None
     else:
-        result = yield bitcoind.rpc_getmemorypool(bitcoin_data.block_type.pack(block).encode('hex'))
+        result = yield bitcoind.rpc_getmemorypool(block_hex)
         success = result
-    success_expected = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(block['header'])) <= block['header']['bits'].target
+    if pow_hash is None:
+        pow_hash = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(block['header']))
+    success_expected = pow_hash <= block['header']['bits'].target
     if (not success and success_expected and not ignore_failure) or (success and not success_expected):
         print >>sys.stderr, 'Block submittal result: %s (%r) Expected: %s' % (success, result, success_expected)
-
-def submit_block(block, ignore_failure, factory, bitcoind, bitcoind_work, net):
-    submit_block_p2p(block, factory, net)
-    submit_block_rpc(block, ignore_failure, bitcoind, bitcoind_work, net)
+    defer.returnValue(bool(success))
@@ -2,11 +2,12 @@
 Implementation of Bitcoin's p2p protocol
 '''
 
+import collections
 import random
 import sys
 import time
 
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
 
 import p2pool
 from . import data as bitcoin_data
@@ -69,13 +70,17 @@ class Protocol(p2protocol.Protocol):
         ]))),
     ])
     def handle_inv(self, invs):
+        tx_requests = []
         for inv in invs:
             if inv['type'] == 'tx':
-                self.send_getdata(requests=[inv])
+                if self.factory.start_tx_request(inv['hash']):
+                    tx_requests.append(inv)
             elif inv['type'] == 'block':
                 self.factory.new_block.happened(inv['hash'])
             else:
                 print 'Unknown inv type', inv
+        if tx_requests:
+            self.send_getdata(requests=tx_requests)
     
     message_getdata = pack.ComposedType([
         ('requests', pack.ListType(pack.ComposedType([
@@ -109,7 +114,7 @@ class Protocol(p2protocol.Protocol):
         ('tx', bitcoin_data.tx_type),
     ])
     def handle_tx(self, tx):
-        self.factory.new_tx.happened(tx)
+        self.factory.got_tx(bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx)
     
     message_block = pack.ComposedType([
         ('block', bitcoin_data.block_type),
@@ -119,6 +124,10 @@ class Protocol(p2protocol.Protocol):
         self.get_block.got_response(block_hash, block)
         self.get_block_header.got_response(block_hash, block['header'])
     
+    def send_packed_block(self, packed_block):
+        # a block message's payload is just the packed block
+        self.sendPayload('block', packed_block)
+    
     message_headers = pack.ComposedType([
         ('headers', pack.ListType(bitcoin_data.block_type)),
     ])
@@ -160,13 +169,44 @@ class ClientFactory(protocol.ReconnectingClientFactory):
     
     maxDelay = 1
     
+    MAX_TX_REQUESTS = 10000 # txids remembered as in flight
+    TX_REQUEST_TIMEOUT = 60 # seconds before a tx that never arrived can be requested again
+    TX_BATCH_DELAY = .1 # seconds that received txs are collected for before new_txs fires
+    
     def __init__(self, net):
         self.net = net
         self.conn = variable.Variable(None)
         
         self.new_block = variable.Event()
-        self.new_tx = variable.Event()
+        self.new_txs = variable.Event() # fires with a dict of hash -> tx
         self.new_headers = variable.Event()
+        
+        self._tx_requests = collections.OrderedDict() # hash -> time requested, oldest first
+        self._pending_txs = {}
+        self._pending_txs_call = None
+    
+    def start_tx_request(self, tx_hash):
+        '''Returns whether tx_hash should be requested, marking it as in flight if so'''
+        now = time.time()
+        if tx_hash in self._tx_requests:
+            if self._tx_requests[tx_hash] > now - self.TX_REQUEST_TIMEOUT:
+                return False
+            del self._tx_requests[tx_hash]
+        self._tx_requests[tx_hash] = now
+        while len(self._tx_requests) > self.MAX_TX_REQUESTS:
+            self._tx_requests.popitem(last=False)
+        return True
+    
+    def got_tx(self, tx_hash, tx):
+        self._tx_requests.pop(tx_hash, None)
+        self._pending_txs[tx_hash] = tx
+        if self._pending_txs_call is None:
+            self._pending_txs_call = reactor.callLater(self.TX_BATCH_DELAY, self._flush_txs)
+    
+    def _flush_txs(self):
+        self._pending_txs_call = None
+        txs, self._pending_txs = self._pending_txs, {}
+        self.new_txs.happened(txs)
     
     def buildProtocol(self, addr):
         p = self.protocol(self.net)
@@ -1,31 +1,322 @@
+from __future__ import division
+
+import collections
+import json
 import random
 import sys
+import time
 
-from twisted.internet import protocol, reactor
-from twisted.python import log
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.python import log, threadpool
 
 from p2pool.bitcoin import data as bitcoin_data, getwork
-from p2pool.util import expiring_dict, jsonrpc, pack
+from p2pool.util import expiring_dict, jsonrpc, math, pack
+
+
+class VarDiff(object):
+    '''
+    Per-connection pseudoshare difficulty controller. Submissions are
+    counted over a window that closes after RETARGET_SUBMITS submissions
+    or RETARGET_TIME seconds; the observed rate then picks a target that
+    should give one submission every TARGET_INTERVAL seconds. A new target
+    is only used if it differs from the current one by more than
+    HYSTERESIS, and each retarget moves by at most MAX_ADJUST. Only a
+    handful of numbers are stored, regardless of how much is submitted.
+    '''
+    
+    TARGET_INTERVAL = 5
+    RETARGET_SUBMITS = 30
+    RETARGET_TIME = 120
+    HYSTERESIS = 2
+    MAX_ADJUST = 4
+    
+    def __init__(self, target, target_range, now=None):
+        self.target_range = target_range
+        self.target = math.clip(target, target_range)
+        self.window_start = time.time() if now is None else now
+        self.window_submits = 0
+        self.previous_target = self.target
+        self.retarget_time = None
+        self.submit_rate = None
+        self.submits = 0
+        self.retargets = 0
+    
+    def set_range(self, target_range):
+        self.target_range = target_range
+        self.target = math.clip(self.target, target_range)
+    
+    def got_submit(self, now=None):
+        self.submits += 1
+        self.window_submits += 1
+        return self.check(now)
+    
+    def check(self, now=None):
+        '''Returns the new target if the difficulty should change, else None'''
+        now = time.time() if now is None else now
+        elapsed = now - self.window_start
+        if self.window_submits < self.RETARGET_SUBMITS and elapsed < self.RETARGET_TIME:
+            return None
+        
+        self.submit_rate = self.window_submits/elapsed if elapsed > 0 else None
+        attempts = bitcoin_data.target_to_average_attempts(self.target)
+        if self.window_submits and elapsed > 0:
+            ratio = self.window_submits*self.TARGET_INTERVAL/elapsed # desired attempts per submission / current
+        else:
+            ratio = 1/self.MAX_ADJUST
+        self.window_start = now
+        self.window_submits = 0
+        if 1/self.HYSTERESIS <= ratio <= self.HYSTERESIS:
+            return None
+        ratio = math.clip(ratio, (1/self.MAX_ADJUST, self.MAX_ADJUST))
+        new_target = math.clip(bitcoin_data.average_attempts_to_target(attempts*ratio), self.target_range)
+        if new_target == self.target:
+            return None
+        self.previous_target, self.target = self.target, new_target
+        self.retarget_time = now
+        self.retargets += 1
+        return new_target
+    
+    def get_accept_target(self, now=None):
+        '''Shares mined against the previous difficulty are still accepted for a short time after a retarget'''
+        now = time.time() if now is None else now
+        if self.retarget_time is not None and now < self.retarget_time + self.TARGET_INTERVAL:
+            return max(self.target, self.previous_target)
+        return self.target
+
+def _build_header(x, coinb_nonce, ntime, nonce, pow_func):
+    header = dict(
+        version=x['version'],
+        previous_block=x['previous_block'],
+        merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(x['coinb1'] + coinb_nonce + x['coinb2']), x['merkle_link']),
+        timestamp=pack.IntType(32).unpack(getwork._swap4(ntime.decode('hex'))),
+        bits=x['bits'],
+        nonce=pack.IntType(32).unpack(getwork._swap4(nonce.decode('hex'))),
+    )
+    packed_header = bitcoin_data.block_header_type.pack(header)
+    return header, bitcoin_data.hash256(packed_header), pow_func(packed_header)
+
+class SubmitValidator(object):
+    '''
+    Rebuilds and hashes submitted headers on a thread pool, handing results
+    back to the reactor in the order the submissions arrived. The scrypt
+    extension releases the GIL while hashing, so threads hash in parallel. Once
+    MAX_QUEUED submissions are outstanding, submitting connections stop
+    being read from until the queue has drained to half that; past twice
+    that, submissions are refused outright.
+    '''
+    
+    MAX_QUEUED = 1000
+    
+    def __init__(self, pow_func, threads=2):
+        self.pow_func = pow_func
+        self.pool = threadpool.ThreadPool(1, threads, 'SubmitValidator')
+        self._shutdown_trigger = None
+        
+        self._queue = collections.deque() # [result or None, deferred, enqueue time]
+        self._paused = set()
+        self.latency_monitor = math.BucketRateMonitor(60)
+        self.submits = 0
+        self.refused = 0
+    
+    def _start(self):
+        self.pool.start()
+        self._shutdown_trigger = reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+    
+    def stop(self):
+        if self.pool.started:
+            self.pool.stop()
+            reactor.removeSystemEventTrigger(self._shutdown_trigger)
+    
+    def validate(self, transport, x, coinb_nonce, ntime, nonce):
+        '''Returns a deferred that fires with (header, header_hash, pow_hash)'''
+        if len(self._queue) >= 2*self.MAX_QUEUED:
+            self.refused += 1
+            raise jsonrpc.Error_for_code(-12345)(u'submit queue full')
+        if len(self._queue) >= self.MAX_QUEUED and transport is not None and transport not in self._paused:
+            transport.pauseProducing()
+            self._paused.add(transport)
+        if not self.pool.started:
+            self._start()
+        
+        self.submits += 1
+        entry = [None, defer.Deferred(), time.time()]
+        self._queue.append(entry)
+        threads.deferToThreadPool(reactor, self.pool, _build_header, x, coinb_nonce, ntime, nonce, self.pow_func).addBoth(self._got_result, entry)
+        return entry[1]
+    
+    def _got_result(self, result, entry):
+        entry[0] = result,
+        ready = []
+        while self._queue and self._queue[0][0] is not None:
+            ready.append(self._queue.popleft())
+        if self._paused and len(self._queue) <= self.MAX_QUEUED//2:
+            for transport in self._paused:
+                transport.resumeProducing()
+            self._paused.clear()
+        for (result,), df, start in ready:
+            self.latency_monitor.add(dict(latency=time.time() - start, count=1))
+            df.callback(result) # failures are passed on to the errback chain as well
+    
+    def get_stats(self):
+        totals, dt = self.latency_monitor.get_totals()
+        return dict(
+            queue_depth=len(self._queue),
+            max_queued=self.MAX_QUEUED,
+            paused_connections=len(self._paused),
+            submits=self.submits,
+            refused=self.refused,
+            mean_latency=totals['latency']/totals['count'] if totals.get('count') else None,
+        )
 
+class StratumJobNotifier(object):
+    '''
+    Pushes new work to every stratum connection when new_work_event fires.
+    Each connection is given a unique extranonce1 carved out of the
+    worker bridge's coinbase nonce, so one job (and one encoded
+    mining.notify) is built per distinct request and template and shared by
+    every connection that makes it. Connections are serviced in batches
+    (highest difficulty first) so that the reactor can handle other events
+    between them.
+    '''
+    
+    BATCH_SIZE = 100
+    
+    def __init__(self, wb):
+        self.wb = wb
+        
+        self.EXTRANONCE2_SIZE = (self.wb.COINBASE_NONCE_LENGTH+1)//2
+        self.EXTRANONCE1_SIZE = self.wb.COINBASE_NONCE_LENGTH - self.EXTRANONCE2_SIZE
+        self._extranonce1s = set()
+        self._next_extranonce1 = 0
+        
+        self.handler_map = expiring_dict.ExpiringDict(300)
+        self.validator = SubmitValidator(self.wb.net.POW_FUNC)
+        self._jobs = {}
+        self._jobs_key = None
+        
+        self.providers = set()
+        self._pending = []
+        self._started = None
+        self._block_notify_time = None
+        self._call = None
+        self._shared_key = self._shared = None
+        
+        self.wb.new_work_event.watch(self._new_work)
+    
+    def allocate_extranonce1(self):
+        if len(self._extranonce1s) >= 2**(8*self.EXTRANONCE1_SIZE):
+            raise ValueError('no free extranonce1')
+        while self._next_extranonce1 in self._extranonce1s:
+            self._next_extranonce1 = (self._next_extranonce1 + 1) % 2**(8*self.EXTRANONCE1_SIZE)
+        extranonce1 = self._next_extranonce1
+        self._extranonce1s.add(extranonce1)
+        return pack.IntType(8*self.EXTRANONCE1_SIZE).pack(extranonce1)
+    
+    def free_extranonce1(self, extranonce1):
+        self._extranonce1s.discard(pack.IntType(8*self.EXTRANONCE1_SIZE).unpack(extranonce1))
+    
+    def get_shared_params(self, x):
+        key = x['previous_block'], x['version'], x['bits'].bits, x['timestamp'], x['merkle_link']['branch']
+        if key != self._shared_key:
+            self._shared_key = key
+            self._shared = (
+                json.dumps(getwork._swap4(pack.IntType(256).pack(x['previous_block'])).encode('hex')), # prevhash
+                ', '.join(json.dumps(v) for v in [
+                    [pack.IntType(256).pack(s).encode('hex') for s in x['merkle_link']['branch']], # merkle_branch
+                    getwork._swap4(pack.IntType(32).pack(x['version'])).encode('hex'), # version
+                    getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).encode('hex'), # nbits
+                    getwork._swap4(pack.IntType(32).pack(x['timestamp'])).encode('hex'), # ntime
+                    True, # clean_jobs
+                ]),
+            )
+        return self._shared
+    
+    def get_job(self, *args):
+        # current_work can change (e.g. new transactions) without new_work_event firing, so compare it by identity like WorkerBridge._get_template does
+        key = self.wb.new_work_event.times, self.wb.current_work.value
+        if self._jobs_key is None or self._jobs_key[0] != key[0] or self._jobs_key[1] is not key[1]:
+            self._jobs = {}
+            self._jobs_key = key
+        
+        if args not in self._jobs:
+            x, got_response = self.wb.get_work(*args)
+            jobid = str(random.randrange(2**128))
+            prevhash, rest = self.get_shared_params(x)
+            params = '[%s, %s, %s, %s, %s]' % (
+                json.dumps(jobid), # jobid
+                prevhash, # prevhash
+                json.dumps(x['coinb1'].encode('hex')), # coinb1
+                json.dumps(x['coinb2'].encode('hex')), # coinb2
+                rest, # merkle_branch, version, nbits, ntime, clean_jobs
+            )
+            self.handler_map[jobid] = x, got_response
+            self._jobs[args] = jobid, x, params
+        return self._jobs[args]
+    
+    def _new_work(self):
+        self._started = time.time()
+        self._block_notify_time = self.wb.pop_block_notify_time()
+        # connections with the lowest share target have the most hashrate working on stale jobs
+        self._pending = sorted(self.providers, key=lambda provider: provider.share_target)
+        if self._call is None:
+            self._call = reactor.callLater(0, self._send_batch)
+    
+    def _send_batch(self):
+        self._call = None
+        batch, self._pending = self._pending[:self.BATCH_SIZE], self._pending[self.BATCH_SIZE:]
+        for provider in batch:
+            if provider in self.providers:
+                provider._send_work()
+                if self._block_notify_time is not None:
+                    self.wb.work_timing['block_notify_latency'] = time.time() - self._block_notify_time
+                    self._block_notify_time = None
+        if self._pending:
+            self._call = reactor.callLater(0, self._send_batch)
+        else:
+            self.wb.work_timing['stratum_notify_time'] = time.time() - self._started
+    
+    def get_stats(self):
+        vardiffs = [provider.vardiff for provider in self.providers if provider.vardiff is not None]
+        rates = [vardiff.submit_rate for vardiff in vardiffs if vardiff.submit_rate is not None]
+        return dict(
+            connections=len(self.providers),
+            vardiff_connections=len(vardiffs),
+            submits=sum(vardiff.submits for vardiff in vardiffs),
+            retargets=sum(vardiff.retargets for vardiff in vardiffs),
+            submit_rate=sum(rates),
+            target_submit_rate=len(vardiffs)/VarDiff.TARGET_INTERVAL,
+            max_connection_submit_rate=max(rates) if rates else None,
+            validation=self.validator.get_stats(),
+        )
+    
+    def add(self, provider):
+        self.providers.add(provider)
+    
+    def remove(self, provider):
+        self.providers.discard(provider)
 
 class StratumRPCMiningProvider(object):
-    def __init__(self, wb, other, transport):
+    def __init__(self, wb, other, transport, notifier, send_notification):
         self.wb = wb
         self.other = other
         self.transport = transport
+        self.notifier = notifier
+        self.send_notification = send_notification
         
         self.username = None
-        self.handler_map = expiring_dict.ExpiringDict(300)
+        self.share_target = 2**256
+        self.vardiff = None
+        self.extranonce1 = self.notifier.allocate_extranonce1()
         
-        self.watch_id = self.wb.new_work_event.watch(self._send_work)
+        self.notifier.add(self)
     
     def rpc_subscribe(self, miner_version=None, session_id=None):
         reactor.callLater(0, self._send_work)
         
         return [
             ["mining.notify", "ae6812eb4cd7735a302a8a9dd95cf71f"], # subscription details
-            "", # extranonce1
-            self.wb.COINBASE_NONCE_LENGTH, # extranonce2_size
+            self.extranonce1.encode('hex'), # extranonce1
+            self.notifier.EXTRANONCE2_SIZE, # extranonce2_size
         ]
     
     def rpc_authorize(self, username, password):
@@ -35,50 +326,50 @@ class StratumRPCMiningProvider(object):
     
     def _send_work(self):
         try:
-            x, got_response = self.wb.get_work(*self.wb.preprocess_request('' if self.username is None else self.username))
+            jobid, x, params = self.notifier.get_job(*self.wb.preprocess_request('' if self.username is None else self.username))
         except:
             log.err()
             self.transport.loseConnection()
             return
-        jobid = str(random.randrange(2**128))
-        self.other.svc_mining.rpc_set_difficulty(bitcoin_data.target_to_difficulty(x['share_target'])*self.wb.net.DUMB_SCRYPT_DIFF).addErrback(lambda err: None)
-        self.other.svc_mining.rpc_notify(
-            jobid, # jobid
-            getwork._swap4(pack.IntType(256).pack(x['previous_block'])).encode('hex'), # prevhash
-            x['coinb1'].encode('hex'), # coinb1
-            x['coinb2'].encode('hex'), # coinb2
-            [pack.IntType(256).pack(s).encode('hex') for s in x['merkle_link']['branch']], # merkle_branch
-            getwork._swap4(pack.IntType(32).pack(x['version'])).encode('hex'), # version
-            getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).encode('hex'), # nbits
-            getwork._swap4(pack.IntType(32).pack(x['timestamp'])).encode('hex'), # ntime
-            True, # clean_jobs
-        ).addErrback(lambda err: None)
-        self.handler_map[jobid] = x, got_response
+        if x.get('share_target_range') is None: # difficulty was fixed by the miner
+            self.vardiff = None
+            self.share_target = x['share_target']
+        else:
+            if self.vardiff is None:
+                self.vardiff = VarDiff(x['share_target'], x['share_target_range'])
+            else:
+                self.vardiff.set_range(x['share_target_range'])
+            self.share_target = self.vardiff.target
+        self.other.svc_mining.rpc_set_difficulty(bitcoin_data.target_to_difficulty(self.share_target)*self.wb.net.DUMB_SCRYPT_DIFF).addErrback(lambda err: None)
+        self.send_notification('mining.notify', params)
     
     def rpc_submit(self, worker_name, job_id, extranonce2, ntime, nonce):
-        if job_id not in self.handler_map:
+        if job_id not in self.notifier.handler_map:
             print >>sys.stderr, '''Couldn't link returned work's job id with its handler. This should only happen if this process was recently restarted!'''
             return False
-        x, got_response = self.handler_map[job_id]
-        coinb_nonce = extranonce2.decode('hex')
+        x, got_response = self.notifier.handler_map[job_id]
+        coinb_nonce = self.extranonce1 + extranonce2.decode('hex')
         assert len(coinb_nonce) == self.wb.COINBASE_NONCE_LENGTH
-        new_packed_gentx = x['coinb1'] + coinb_nonce + x['coinb2']
-        header = dict(
-            version=x['version'],
-            previous_block=x['previous_block'],
-            merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), x['merkle_link']),
-            timestamp=pack.IntType(32).unpack(getwork._swap4(ntime.decode('hex'))),
-            bits=x['bits'],
-            nonce=pack.IntType(32).unpack(getwork._swap4(nonce.decode('hex'))),
-        )
-        return got_response(header, worker_name, coinb_nonce)
+        pseudoshare_target = self.vardiff.get_accept_target() if self.vardiff is not None else None
+        # taken before validation, so that block latencies include time spent queued and work that changes while the
+        # submission is queued doesn't make it dead on arrival
+        found_time, new_work_times = time.time(), self.wb.new_work_event.times
+        df = self.notifier.validator.validate(self.transport, x, coinb_nonce, ntime, nonce)
+        @df.addCallback
+        def _((header, header_hash, pow_hash)):
+            res = got_response(header, worker_name, coinb_nonce, pseudoshare_target, header_hash=header_hash, pow_hash=pow_hash, found_time=found_time, new_work_times=new_work_times)
+            if self.vardiff is not None and self.vardiff.got_submit() is not None:
+                self._send_work()
+            return res
+        return df
     
     def close(self):
-        self.wb.new_work_event.unwatch(self.watch_id)
+        self.notifier.remove(self)
+        self.notifier.free_extranonce1(self.extranonce1)
 
 class StratumProtocol(jsonrpc.LineBasedPeer):
     def connectionMade(self):
-        self.svc_mining = StratumRPCMiningProvider(self.factory.wb, self.other, self.transport)
+        self.svc_mining = StratumRPCMiningProvider(self.factory.wb, self.other, self.transport, self.factory.notifier, self.send_notification)
     
     def connectionLost(self, reason):
         self.svc_mining.close()
@@ -88,3 +379,4 @@ class StratumServerFactory(protocol.ServerFactory):
     
     def __init__(self, wb):
         self.wb = wb
+        self.notifier = StratumJobNotifier(wb)
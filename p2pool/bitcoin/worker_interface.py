@@ -1,11 +1,12 @@
 from __future__ import division
 
 import StringIO
+import collections
 import json
 import random
 import sys
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 import p2pool
 from p2pool.bitcoin import data as bitcoin_data, getwork
@@ -34,11 +35,55 @@ class WorkerBridge(object):
     def get_work(self, request):
         raise NotImplementedError()
 
+class LongPollDispatcher(object):
+    '''
+    Holds long-polling requests until new work arrives, then wakes them
+    BATCH_SIZE per reactor iteration instead of all in one callback chain.
+    Requests whose clients disconnect while waiting are skipped.
+    '''
+    
+    BATCH_SIZE = 100
+    
+    def __init__(self, new_work_event):
+        self._waiters = []
+        self._releasing = collections.deque()
+        self._call = None
+        
+        new_work_event.watch(self._new_work)
+    
+    def __len__(self):
+        return len(self._waiters) + len(self._releasing)
+    
+    def wait(self, request=None):
+        entry = [defer.Deferred(), True]
+        if request is not None:
+            request.notifyFinish().addErrback(lambda fail: entry.__setitem__(1, False))
+        self._waiters.append(entry)
+        return entry[0]
+    
+    def _new_work(self):
+        self._releasing.extend(self._waiters)
+        self._waiters = []
+        if self._call is None:
+            self._call = reactor.callLater(0, self._release)
+    
+    def _release(self):
+        self._call = None
+        released = 0
+        while self._releasing and released < self.BATCH_SIZE:
+            df, alive = self._releasing.popleft()
+            if alive:
+                df.callback(None)
+                released += 1
+        if self._releasing:
+            self._call = reactor.callLater(0, self._release)
+
 class WorkerInterface(object):
     def __init__(self, worker_bridge):
         self.worker_bridge = worker_bridge
         
-        self.worker_views = {}
+        self.worker_views = expiring_dict.ExpiringDict(600)
+        self.long_poll_dispatcher = LongPollDispatcher(self.worker_bridge.new_work_event)
         
         self.merkle_root_to_handler = expiring_dict.ExpiringDict(300)
     
@@ -78,7 +123,7 @@ class WorkerInterface(object):
             else:
                 if p2pool.DEBUG:
                     print 'POLL %i WAITING' % (id,)
-                yield self.worker_bridge.new_work_event.get_deferred()
+                yield self.long_poll_dispatcher.wait(request)
             self.worker_views[request_id] = self.worker_bridge.new_work_event.times
         
         x, handler = self.worker_bridge.get_work(*self.worker_bridge.preprocess_request(request.getUser() if request.getUser() is not None else ''))
@@ -114,6 +159,7 @@ class CachingWorkerBridge(object):
         self.COINBASE_NONCE_LENGTH = (inner.COINBASE_NONCE_LENGTH+1)//2
         self.new_work_event = inner.new_work_event
         self.preprocess_request = inner.preprocess_request
+        self.work_timing = inner.work_timing
         
         self._my_bits = (self._inner.COINBASE_NONCE_LENGTH - self.COINBASE_NONCE_LENGTH)*8
         
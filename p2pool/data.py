@@ -108,27 +108,26 @@ class Share(object):
     gentx_before_refhash = pack.VarStrType().pack(DONATION_SCRIPT) + pack.IntType(64).pack(0) + pack.VarStrType().pack('\x6a\x28' + pack.IntType(256).pack(0) + pack.IntType(64).pack(0))[:3]
     
     @classmethod
-    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None):
-        previous_share = tracker.items[share_data['previous_share_hash']] if share_data['previous_share_hash'] is not None else None
+    def prepare_transaction(cls, tracker, previous_share_hash, block_target, desired_other_transaction_hashes_and_fees, net, known_txs=None):
+        '''Computes the parts of generate_transaction that only depend on the previous share and the block template'''
+        previous_share = tracker.items[previous_share_hash] if previous_share_hash is not None else None
         
-        height, last = tracker.get_height_and_last(share_data['previous_share_hash'])
+        height, last = tracker.get_height_and_last(previous_share_hash)
         assert height >= net.REAL_CHAIN_LENGTH or last is None
         if height < net.TARGET_LOOKBEHIND:
             pre_target3 = net.MAX_TARGET
         else:
-            attempts_per_second = get_pool_attempts_per_second(tracker, share_data['previous_share_hash'], net.TARGET_LOOKBEHIND, min_work=True, integer=True)
+            attempts_per_second = get_pool_attempts_per_second(tracker, previous_share_hash, net.TARGET_LOOKBEHIND, min_work=True, integer=True)
             pre_target = 2**256//(net.SHARE_PERIOD*attempts_per_second) - 1 if attempts_per_second else 2**256-1
             pre_target2 = math.clip(pre_target, (previous_share.max_target*9//10, previous_share.max_target*11//10))
             pre_target3 = math.clip(pre_target2, (net.MIN_TARGET, net.MAX_TARGET))
-        max_bits = bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3)
-        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
         
         new_transaction_hashes = []
         new_transaction_size = 0
         transaction_hash_refs = []
         other_transaction_hashes = []
         
-        past_shares = list(tracker.get_chain(share_data['previous_share_hash'], min(height, 100)))
+        past_shares = list(tracker.get_chain(previous_share_hash, min(height, 100)))
         tx_hash_to_this = {}
         for i, share in enumerate(past_shares):
             for j, tx_hash in enumerate(share.new_transaction_hashes):
@@ -151,11 +150,6 @@ class Share(object):
         included_transactions = set(other_transaction_hashes)
         removed_fees = [fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash not in included_transactions]
         definite_fees = sum(0 if fee is None else fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash in included_transactions)
-        if None not in removed_fees:
-            share_data = dict(share_data, subsidy=share_data['subsidy'] - sum(removed_fees))
-        else:
-            assert base_subsidy is not None
-            share_data = dict(share_data, subsidy=base_subsidy + definite_fees)
         
         weights, total_weight, donation_weight = tracker.get_cumulative_weights(previous_share.share_data['previous_share_hash'] if previous_share is not None else None,
             max(0, min(height, net.REAL_CHAIN_LENGTH) - 1),
@@ -163,6 +157,43 @@ class Share(object):
         )
         assert total_weight == sum(weights.itervalues()) + donation_weight, (total_weight, sum(weights.itervalues()) + donation_weight)
         
+        return dict(
+            previous_share=previous_share,
+            height=height,
+            last=last,
+            pre_target3=pre_target3,
+            new_transaction_hashes=new_transaction_hashes,
+            transaction_hash_refs=transaction_hash_refs,
+            other_transaction_hashes=other_transaction_hashes,
+            removed_fees=removed_fees,
+            definite_fees=definite_fees,
+            weights=weights,
+            total_weight=total_weight,
+        )
+    
+    @classmethod
+    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, prepared=None):
+        if prepared is None:
+            prepared = cls.prepare_transaction(tracker, share_data['previous_share_hash'], block_target, desired_other_transaction_hashes_and_fees, net, known_txs)
+        previous_share = prepared['previous_share']
+        height, last = prepared['height'], prepared['last']
+        pre_target3 = prepared['pre_target3']
+        max_bits = bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3)
+        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
+        
+        new_transaction_hashes = prepared['new_transaction_hashes']
+        transaction_hash_refs = prepared['transaction_hash_refs']
+        other_transaction_hashes = prepared['other_transaction_hashes']
+        
+        removed_fees = prepared['removed_fees']
+        if None not in removed_fees:
+            share_data = dict(share_data, subsidy=share_data['subsidy'] - sum(removed_fees))
+        else:
+            assert base_subsidy is not None
+            share_data = dict(share_data, subsidy=base_subsidy + prepared['definite_fees'])
+        
+        weights, total_weight = prepared['weights'], prepared['total_weight']
+        
         amounts = dict((script, share_data['subsidy']*(199*weight)//(200*total_weight)) for script, weight in weights.iteritems()) # 99.5% goes according to weights prior to this share
         this_script = bitcoin_data.pubkey_hash_to_script2(share_data['pubkey_hash'])
         amounts[this_script] = amounts.get(this_script, 0) + share_data['subsidy']//200 # 0.5% goes to block finder
@@ -1,3 +1,7 @@
+from __future__ import division
+
+import collections
+import itertools
 import random
 import sys
 import time
@@ -7,10 +11,182 @@ from twisted.python import log
 
 from p2pool import data as p2pool_data, p2p
 from p2pool.bitcoin import data as bitcoin_data, helper, height_tracker
-from p2pool.util import deferral, variable
+from p2pool.util import deferral, math, variable
 
 
+class ShareDownloader(object):
+    '''
+    Fetches the shares the tracker wants (node.desired_var). For each missing
+    parent, the hashes of the chain below it are asked from one peer, and the
+    resulting stretch is then downloaded in segments from every peer at once,
+    with several requests in flight per peer. Each peer's segment size follows
+    how fast its replies come back, and requests that take too long are handed
+    to other peers.
+    '''
+    
+    MAX_REQUESTS_PER_PEER = 4
+    INITIAL_BATCH = 20 # shares per request
+    MIN_BATCH = 5
+    MAX_BATCH = 1000
+    TARGET_LATENCY = 1 # seconds a request should take; batches grow when replies are faster and shrink when slower
+    REQUEST_TIMEOUT = 10 # seconds before a request's shares are asked from another peer
+    MAX_ATTEMPTS = 3 # requests for a segment before it's dropped until the tracker wants it again
+    RETRY_DELAY = 5 # seconds before a share that no peer returned is requested again
+    
+    def __init__(self, p2p_node):
+        self.p2p_node = p2p_node
+        self.node = p2p_node.node
+        
+        self.queue = collections.deque() # (hashes, known): consecutive missing share hashes, child first; only the first is known if not known
+        self.wanted = set() # hashes that are being looked up, queued, or requested
+        self.attempts = {} # first hash of segment -> failed requests
+        self.retry_times = {} # hash -> time it may be requested again
+        self.peer_batches = {} # peer nonce -> shares per request
+        self.peer_requests = {} # peer nonce -> requests in flight
+        self.stats = dict(requests=0, shares=0, timeouts=0)
+    
+    def start(self):
+        self._stop_thinking = deferral.run_repeatedly(self._think)
+        self._watch_id = self.node.desired_var.changed.watch(lambda desired: self._think())
+    
+    def stop(self):
+        self._stop_thinking()
+        self.node.desired_var.changed.unwatch(self._watch_id)
+    
+    def _think(self):
+        t = reactor.seconds()
+        self.retry_times = dict((share_hash, retry_time) for share_hash, retry_time in self.retry_times.iteritems() if retry_time > t)
+        if self.p2p_node.peers:
+            for peer_addr, share_hash in self.node.desired_var.value or []:
+                if share_hash not in self.wanted and share_hash not in self.retry_times and share_hash not in self.node.tracker.items:
+                    self._find_missing(peer_addr, share_hash)
+        self._dispatch()
+        return 1
+    
+    @defer.inlineCallbacks
+    def _find_missing(self, peer_addr, share_hash):
+        self.wanted.add(share_hash)
+        hashes = None
+        peers = [peer for peer in self.p2p_node.peers.itervalues() if peer.share_hashes]
+        if peers:
+            # prefer the peer that sent the child, as it must have had the parent
+            peer = ([peer for peer in peers if peer.addr == peer_addr] or [random.choice(peers)])[0]
+            try:
+                hashes = yield peer.get_share_hashes(hash=share_hash, count=2*self.node.net.CHAIN_LENGTH)
+            except defer.TimeoutError:
+                print 'Share hash request timed out!'
+            except:
+                log.err(None, 'in ShareDownloader._find_missing:')
+        self.wanted.discard(share_hash)
+        
+        if hashes and hashes[0] == share_hash:
+            missing = list(itertools.takewhile(lambda h: h not in self.node.tracker.items and h not in self.wanted, hashes))
+            if missing:
+                self._enqueue(missing, True)
+        elif share_hash not in self.node.tracker.items:
+            # peer doesn't know the chain below share_hash or doesn't answer hashesreq, so download it blindly
+            self._enqueue([share_hash], False)
+        self._dispatch()
+    
+    def _enqueue(self, hashes, known):
+        self.wanted.update(hashes)
+        self.queue.append((hashes, known))
+    
+    def _dispatch(self):
+        while self.queue:
+            peers = [peer for peer in self.p2p_node.peers.itervalues() if self.peer_requests.get(peer.nonce, 0) < self.MAX_REQUESTS_PER_PEER]
+            if not peers:
+                return
+            peer = min(peers, key=lambda peer: (self.peer_requests.get(peer.nonce, 0), random.random()))
+            batch = self.peer_batches.setdefault(peer.nonce, self.INITIAL_BATCH)
+            
+            hashes, known = self.queue.popleft()
+            if known and len(hashes) > batch:
+                self.queue.appendleft((hashes[batch:], known))
+                hashes = hashes[:batch]
+            if all(share_hash in self.node.tracker.items for share_hash in hashes):
+                self.wanted.difference_update(hashes)
+                continue
+            self._request(peer, hashes, known, batch)
+    
+    @defer.inlineCallbacks
+    def _request(self, peer, hashes, known, batch):
+        self.peer_requests[peer.nonce] = self.peer_requests.get(peer.nonce, 0) + 1
+        self.stats['requests'] += 1
+        
+        timed_out = []
+        def timeout():
+            # give the segment to another peer, but still use this peer's reply if it comes
+            timed_out.append(True)
+            self.stats['timeouts'] += 1
+            self.peer_batches[peer.nonce] = self.MIN_BATCH
+            self._retry(hashes, known)
+            self._dispatch()
+        timer = reactor.callLater(self.REQUEST_TIMEOUT, timeout)
+        
+        print 'Requesting %i shares starting at %s from %s' % (len(hashes) if known else batch, p2pool_data.format_hash(hashes[0]), '%s:%i' % peer.addr)
+        start = reactor.seconds()
+        try:
+            shares = yield peer.get_shares(
+                hashes=[hashes[0]],
+                parents=(len(hashes) if known else batch) - 1,
+                stops=[] if known else list(set(self.node.tracker.heads) | set(
+                    self.node.tracker.get_nth_parent_hash(head, min(max(0, self.node.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.node.tracker.heads
+                ))[:100],
+            )
+        except peer.ShareReplyError:
+            shares = None
+            self.peer_batches[peer.nonce] = max(self.MIN_BATCH, batch//2)
+        except defer.TimeoutError:
+            shares = None
+            print 'Share request timed out!'
+        except:
+            shares = None
+            log.err(None, 'in ShareDownloader._request:')
+        else:
+            # fast replies earn bigger batches, slow ones smaller
+            latency = max(reactor.seconds() - start, 0.001)
+            self.peer_batches[peer.nonce] = int(math.clip(batch*math.clip(self.TARGET_LATENCY/latency, (.5, 2)), (self.MIN_BATCH, self.MAX_BATCH)))
+        finally:
+            if not timed_out:
+                timer.cancel()
+            self.peer_requests[peer.nonce] -= 1
+            if not self.peer_requests[peer.nonce] and peer.nonce not in self.p2p_node.peers:
+                del self.peer_requests[peer.nonce]
+                self.peer_batches.pop(peer.nonce, None)
+        
+        if shares:
+            self.stats['shares'] += len(shares)
+            self.p2p_node.handle_shares([(share, []) for share in shares], peer)
+        
+        if not timed_out:
+            if shares:
+                self.attempts.pop(hashes[0], None)
+                self.wanted.difference_update(hashes)
+                missing = [share_hash for share_hash in hashes if share_hash not in self.node.tracker.items] if known else []
+                if missing:
+                    self._enqueue(missing, known)
+            else:
+                self._retry(hashes, known)
+        self._dispatch()
+    
+    def _retry(self, hashes, known):
+        self.wanted.difference_update(hashes)
+        attempts = self.attempts.pop(hashes[0], 0) + 1
+        if attempts >= self.MAX_ATTEMPTS or not known:
+            self.retry_times[hashes[0]] = reactor.seconds() + self.RETRY_DELAY
+            return
+        missing = [share_hash for share_hash in hashes if share_hash not in self.node.tracker.items and share_hash not in self.wanted]
+        if missing:
+            self.attempts[missing[0]] = attempts
+            self._enqueue(missing, known)
+
 class P2PNode(p2p.Node):
+    FULL_RELAY_PEERS = 3 # number of peers that get new shares pushed in full instead of announced
+    SHARE_REQUEST_TIMEOUT = 10 # seconds before a share announced by another peer is requested again
+    MAX_SHARE_HASHES = 20000 # per hashesreply, about 640 kB
+    MAX_SHARE_REPLY_SIZE = 4000000 # bytes of shares per sharereq, split over several sharereplies
+    
     def __init__(self, node, **kwargs):
         self.node = node
         p2p.Node.__init__(self,
@@ -19,6 +195,19 @@ class P2PNode(p2p.Node):
             known_txs_var=node.known_txs_var,
             mining_txs_var=node.mining_txs_var,
         **kwargs)
+        
+        self.full_relay_peers = [] # nonces, most recently first to relay a new share last
+        self._requested_share_hashes = {} # hash -> time want_shares was sent
+        self.share_downloader = ShareDownloader(self)
+    
+    def stop(self):
+        self.share_downloader.stop()
+        return p2p.Node.stop(self)
+    
+    def lost_conn(self, conn, reason):
+        p2p.Node.lost_conn(self, conn, reason)
+        if conn.nonce in self.full_relay_peers:
+            self.full_relay_peers.remove(conn.nonce)
     
     def handle_shares(self, shares, peer):
         if len(shares) > 5:
@@ -32,19 +221,26 @@ class P2PNode(p2p.Node):
             
             if share.hash in self.node.tracker.items:
                 #print 'Got duplicate share, ignoring. Hash: %s' % (p2pool_data.format_hash(share.hash),)
+                if peer is not None:
+                    peer.traffic_stats['duplicate_shares_in'] += 1
                 continue
             
             new_count += 1
+            self._requested_share_hashes.pop(share.hash, None)
             
             #print 'Received share %s from %r' % (p2pool_data.format_hash(share.hash), share.peer_addr)
             
             self.node.tracker.add(share)
         
-        new_known_txs = dict(self.node.known_txs_var.value)
-        new_known_txs.update(all_new_txs)
-        self.node.known_txs_var.set(new_known_txs)
+        self.node.known_txs_var.add(all_new_txs)
         
         if new_count:
+            if peer is not None and peer.nonce in self.peers:
+                # peers that are first to give us new shares are the closest to the rest of the network
+                if peer.nonce in self.full_relay_peers:
+                    self.full_relay_peers.remove(peer.nonce)
+                self.full_relay_peers.append(peer.nonce)
+                del self.full_relay_peers[:-self.FULL_RELAY_PEERS]
             self.node.set_best_share()
         
         if len(shares) > 5:
@@ -67,73 +263,104 @@ class P2PNode(p2p.Node):
             self.handle_shares([(share, []) for share in shares], peer)
     
     def handle_get_shares(self, hashes, parents, stops, peer):
-        parents = min(parents, 1000//len(hashes))
         stops = set(stops)
         shares = []
+        size = 0
         for share_hash in hashes:
             for share in self.node.tracker.get_chain(share_hash, min(parents + 1, self.node.tracker.get_height(share_hash))):
                 if share.hash in stops:
                     break
+                size += share.share_type.packed_size(share.contents)
+                if shares and size > self.MAX_SHARE_REPLY_SIZE:
+                    break
                 shares.append(share)
+            if shares and size > self.MAX_SHARE_REPLY_SIZE:
+                break
         if len(shares) > 0:
             print 'Sending %i shares to %s:%i' % (len(shares), peer.addr[0], peer.addr[1])
         return shares
     
+    def handle_get_share_hashes(self, share_hash, count, peer):
+        if share_hash not in self.node.tracker.items:
+            return []
+        return [share.hash for share in self.node.tracker.get_chain(share_hash, min(count, self.MAX_SHARE_HASHES, self.node.tracker.get_height(share_hash)))]
+    
     def handle_bestblock(self, header, peer):
         if self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header)) > header['bits'].target:
             raise p2p.PeerMisbehavingError('received block header fails PoW test')
         self.node.handle_header(header)
     
+    def got_remembered_txs(self, tx_hashes, peer):
+        self.node._ref_txs(tx_hashes)
+    
+    def lost_remembered_txs(self, tx_hashes, peer):
+        self.node._unref_txs(tx_hashes)
+    
+    def handle_have_shares(self, hashes, peer):
+        t = time.time()
+        if len(self._requested_share_hashes) > 1000:
+            self._requested_share_hashes = dict((share_hash, request_time) for share_hash, request_time in self._requested_share_hashes.iteritems() if request_time > t - self.SHARE_REQUEST_TIMEOUT)
+        wanted = [share_hash for share_hash in hashes if share_hash not in self.node.tracker.items and
+            self._requested_share_hashes.get(share_hash, 0) <= t - self.SHARE_REQUEST_TIMEOUT]
+        if not wanted:
+            return
+        for share_hash in wanted:
+            self._requested_share_hashes[share_hash] = t
+        peer.send_want_shares(hashes=wanted)
+    
+    def _can_relay(self, share, known_txs):
+        # shares received without their new transactions (e.g. through sharereq) can't be passed on
+        return share.VERSION < 13 or all(tx_hash in known_txs for tx_hash in share.share_info['new_transaction_hashes'])
+    
+    def handle_want_shares(self, hashes, peer):
+        known_txs = self.node.known_txs_var.value
+        shares = [self.node.tracker.items[share_hash] for share_hash in hashes if share_hash in self.node.tracker.items]
+        shares = [share for share in shares if self._can_relay(share, known_txs)]
+        if shares:
+            peer.sendShares(shares, self.node.tracker, known_txs, include_txs_with=[share.hash for share in shares])
+    
+    def handle_get_share_txs(self, share_hash, indexes, peer):
+        known_txs = self.node.known_txs_var.value
+        share = self.node.tracker.items.get(share_hash, None)
+        if share is None: # already pruned
+            tx_hashes = []
+        else:
+            if any(not 0 <= i < len(share.new_transaction_hashes) for i in indexes):
+                raise p2p.PeerMisbehavingError('requested share transaction index out of range')
+            tx_hashes = [share.new_transaction_hashes[i] for i in indexes]
+            if not all(tx_hash in known_txs for tx_hash in tx_hashes):
+                tx_hashes = [] # already forgotten
+        peer.send_sharetxs(hash=share_hash, txs=[known_txs[tx_hash] for tx_hash in tx_hashes])
+    
     def broadcast_share(self, share_hash):
-        shares = []
-        for share in self.node.tracker.get_chain(share_hash, min(5, self.node.tracker.get_height(share_hash))):
-            if share.hash in self.shared_share_hashes:
-                break
-            self.shared_share_hashes.add(share.hash)
-            shares.append(share)
+        '''
+        Relays share_hash and up to 4 of its parents to every peer that isn't
+        known to have them yet. The peers that most recently were first to
+        give us new shares, as well as peers that don't advertise
+        SERVICE_SHARE_INV, get full shares; the rest get them announced by hash and
+        ask for the ones they're missing.
+        '''
+        known_txs = self.node.known_txs_var.value
+        shares = [share for share in self.node.tracker.get_chain(share_hash, min(5, self.node.tracker.get_height(share_hash))) if self._can_relay(share, known_txs)]
         
         for peer in self.peers.itervalues():
-            peer.sendShares([share for share in shares if share.peer_addr != peer.addr], self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash])
+            peer_shares = []
+            for share in shares:
+                if share.hash in peer.remote_share_hashes:
+                    break
+                if share.peer_addr != peer.addr:
+                    peer_shares.append(share)
+            if not peer_shares:
+                continue
+            if not peer.share_inv or peer.nonce in self.full_relay_peers:
+                peer.sendShares(peer_shares, self.node.tracker, known_txs, include_txs_with=[share_hash])
+            else:
+                peer.announce_shares(peer_shares)
     
     def start(self):
         p2p.Node.start(self)
         
-        self.shared_share_hashes = set(self.node.tracker.items)
-        self.node.tracker.removed.watch_weakref(self, lambda self, share: self.shared_share_hashes.discard(share.hash))
-        
-        @apply
-        @defer.inlineCallbacks
-        def download_shares():
-            while True:
-                desired = yield self.node.desired_var.get_when_satisfies(lambda val: len(val) != 0)
-                peer_addr, share_hash = random.choice(desired)
-                
-                if len(self.peers) == 0:
-                    yield deferral.sleep(1)
-                    continue
-                peer = random.choice(self.peers.values())
-                
-                print 'Requesting parent share %s from %s' % (p2pool_data.format_hash(share_hash), '%s:%i' % peer.addr)
-                try:
-                    shares = yield peer.get_shares(
-                        hashes=[share_hash],
-                        parents=random.randrange(500), # randomize parents so that we eventually get past a too large block of shares
-                        stops=list(set(self.node.tracker.heads) | set(
-                            self.node.tracker.get_nth_parent_hash(head, min(max(0, self.node.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.node.tracker.heads
-                        ))[:100],
-                    )
-                except defer.TimeoutError:
-                    print 'Share request timed out!'
-                    continue
-                except:
-                    log.err(None, 'in download_shares:')
-                    continue
-                
-                if not shares:
-                    yield deferral.sleep(1) # sleep so we don't keep rerequesting the same share nobody has
-                    continue
-                self.handle_shares([(share, []) for share in shares], peer)
-        
+        self.share_downloader.start()
         
         @self.node.best_block_header.changed.watch
         def _(header):
@@ -157,10 +384,14 @@ class P2PNode(p2p.Node):
         
 
 class Node(object):
-    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net):
+    BACKEND_STALE_TIME = 60 # seconds without new work from a backend before its templates are passed over
+    
+    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net, backup_backends=[], max_known_txs_size=50*1000*1000):
         self.factory = factory
         self.bitcoind = bitcoind
         self.net = net
+        # (p2p factory, rpc proxy) pairs; the first is the primary, which is also used for headers and transactions
+        self.backends = [(factory, bitcoind)] + list(backup_backends)
         
         self.tracker = p2pool_data.OkayTracker(self.net)
         
@@ -172,6 +403,21 @@ class Node(object):
                 self.tracker.verified.add(self.tracker.items[share_hash])
         
         self.p2p_node = None # overwritten externally
+        
+        self._current_payouts_key = self._current_payouts = None
+        
+        self.max_known_txs_size = max_known_txs_size # bytes
+        self.known_txs_size = 0
+        self._known_txs_info = {} # hash -> (time first seen, packed size)
+        self._trim_known_txs_call = None
+        self.evicted_tx_count = 0
+        self._tx_refs = {} # hash -> number of references from the block template, recent shares and peers
+        self._unreferenced_tx_hashes = set() # known txs with no references, dropped by forget_old_txs
+        self._share_window = {} # hash -> new_transaction_hashes of the last 120 shares of the best chain
+        
+        self.block_notified = variable.Event()
+        self._block_notify = None # (block_hash, time) of the latest notification not yet reflected in work
+        self.block_notify_count = self.block_notify_dupe_count = 0
     
     @defer.inlineCallbacks
     def start(self):
@@ -181,16 +427,38 @@ class Node(object):
         # BITCOIND WORK
         
         self.bitcoind_work = variable.Variable((yield helper.getwork(self.bitcoind)))
+        self.backend_works = [variable.Variable(self.bitcoind_work.value)] + [variable.Variable(None) for backend in self.backends[1:]]
+        new_block = variable.Event()
+        for factory, bitcoind in self.backends:
+            factory.new_block.watch(new_block.happened)
         @defer.inlineCallbacks
-        def work_poller():
+        def work_poller(backend_work, bitcoind):
+            wakeup = variable.Event()
+            new_block.watch(lambda *args: wakeup.happened())
+            self.block_notified.watch(wakeup.happened)
+            flag = None
             while stop_signal.times == 0:
-                flag = self.factory.new_block.get_deferred()
+                # notifications arriving while a request is in flight all collapse into one more request. the
+                # deferred is only replaced once it has fired, so quiet sources (e.g. no -blocknotify) don't pile up observers
+                if flag is None or flag.called:
+                    flag = wakeup.get_deferred()
                 try:
-                    self.bitcoind_work.set((yield helper.getwork(self.bitcoind, self.bitcoind_work.value['use_getblocktemplate'])))
+                    last_work = self.bitcoind_work.value
+                    work = yield helper.getwork(bitcoind, (backend_work.value or last_work)['use_getblocktemplate'], last_work)
+                    backend_work.set(work)
+                    if self._get_best_work() is work:
+                        if last_work is not self.bitcoind_work.value:
+                            # work from another backend was used in the meantime, so the delta is against the wrong template
+                            work = dict(work,
+                                added_transaction_hashes=[tx_hash for tx_hash in work['transaction_hashes'] if tx_hash not in self.bitcoind_work.value['transactions_by_hash']],
+                                removed_transaction_hashes=[tx_hash for tx_hash in self.bitcoind_work.value['transaction_hashes'] if tx_hash not in work['transactions_by_hash']],
+                            )
+                        self.bitcoind_work.set(work)
                 except:
                     log.err()
                 yield defer.DeferredList([flag, deferral.sleep(15)], fireOnOneCallback=True)
-        work_poller()
+        for backend_work, (factory, bitcoind) in zip(self.backend_works, self.backends):
+            work_poller(backend_work, bitcoind)
         
         # PEER WORK
         
@@ -221,12 +489,32 @@ class Node(object):
         
         # BEST SHARE
         
-        self.known_txs_var = variable.Variable({}) # hash -> tx
-        self.mining_txs_var = variable.Variable({}) # hash -> tx
+        self.known_txs_var = variable.DictVariable() # hash -> tx
+        self.mining_txs_var = variable.DictVariable() # hash -> tx
+        # keep known_txs within its memory budget and track which transactions are unreferenced
+        @self.known_txs_var.added.watch
+        def _(added):
+            now = time.time()
+            for tx_hash, tx in added.iteritems():
+                size = bitcoin_data.tx_type.packed_size(tx)
+                self._known_txs_info[tx_hash] = now, size
+                self.known_txs_size += size
+                if tx_hash not in self._tx_refs:
+                    self._unreferenced_tx_hashes.add(tx_hash)
+            if self.known_txs_size > self.max_known_txs_size and self._trim_known_txs_call is None:
+                self._trim_known_txs_call = reactor.callLater(0, self._trim_known_txs)
+        @self.known_txs_var.removed.watch
+        def _(removed):
+            for tx_hash in removed:
+                self.known_txs_size -= self._known_txs_info.pop(tx_hash)[1]
+                self._unreferenced_tx_hashes.discard(tx_hash)
+        self.mining_txs_var.added.watch(self._ref_txs)
+        self.mining_txs_var.removed.watch(self._unref_txs)
         self.get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(self.bitcoind, self.factory, lambda: self.bitcoind_work.value['previous_block'], self.net)
         
         self.best_share_var = variable.Variable(None)
         self.desired_var = variable.Variable(None)
+        self.best_share_var.changed.watch(lambda _: self._update_share_window())
         self.bitcoind_work.changed.watch(lambda _: self.set_best_share())
         self.set_best_share()
         
@@ -234,29 +522,31 @@ class Node(object):
         
         # update mining_txs according to getwork results
         @self.bitcoind_work.changed.run_and_watch
-        def _(_=None):
-            new_mining_txs = {}
-            new_known_txs = dict(self.known_txs_var.value)
-            for tx_hash, tx in zip(self.bitcoind_work.value['transaction_hashes'], self.bitcoind_work.value['transactions']):
-                new_mining_txs[tx_hash] = tx
-                new_known_txs[tx_hash] = tx
-            self.mining_txs_var.set(new_mining_txs)
-            self.known_txs_var.set(new_known_txs)
+        def _(work=None):
+            if work is None:
+                # first call: nothing is applied yet and work may already be a delta against an earlier template
+                work = self.bitcoind_work.value
+                added_hashes, removed_hashes = work['transaction_hashes'], []
+            else:
+                # only the template's changes are applied, the rest of its transactions were added when they first showed up
+                added_hashes, removed_hashes = work['added_transaction_hashes'], work['removed_transaction_hashes']
+            added = dict((tx_hash, work['transactions_by_hash'][tx_hash]) for tx_hash in added_hashes)
+            self.mining_txs_var.remove(removed_hashes)
+            self.mining_txs_var.add(added)
+            # template transactions that went missing from known_txs since they were added are put back as well
+            self.known_txs_var.add(dict((tx_hash, tx) for tx_hash, tx in work['transactions_by_hash'].iteritems() if tx_hash not in self.known_txs_var.value))
         # add p2p transactions from bitcoind to known_txs
-        @self.factory.new_tx.watch
-        def _(tx):
-            new_known_txs = dict(self.known_txs_var.value)
-            new_known_txs[bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))] = tx
-            self.known_txs_var.set(new_known_txs)
+        self.factory.new_txs.watch(self.known_txs_var.add)
+        stop_signal.watch(lambda: self._trim_known_txs_call.cancel() if self._trim_known_txs_call is not None else None)
         # forward transactions seen to bitcoind
-        @self.known_txs_var.transitioned.watch
+        @self.known_txs_var.added.watch
         @defer.inlineCallbacks
-        def _(before, after):
+        def _(added):
             yield deferral.sleep(random.expovariate(1/1))
             if self.factory.conn.value is None:
                 return
-            for tx_hash in set(after) - set(before):
-                self.factory.conn.value.send_tx(tx=after[tx_hash])
+            for tx in added.itervalues():
+                self.factory.conn.value.send_tx(tx=tx)
         
         @self.tracker.verified.added.watch
         def _(share):
@@ -267,23 +557,12 @@ class Node(object):
             if block is None:
                 print >>sys.stderr, 'GOT INCOMPLETE BLOCK FROM PEER! %s bitcoin: %s%064x' % (p2pool_data.format_hash(share.hash), self.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, share.header_hash)
                 return
-            helper.submit_block(block, True, self.factory, self.bitcoind, self.bitcoind_work, self.net)
+            self.submit_block(block, True)
             print
             print 'GOT BLOCK FROM PEER! Passing to bitcoind! %s bitcoin: %s%064x' % (p2pool_data.format_hash(share.hash), self.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, share.header_hash)
             print
         
-        def forget_old_txs():
-            new_known_txs = {}
-            if self.p2p_node is not None:
-                for peer in self.p2p_node.peers.itervalues():
-                    new_known_txs.update(peer.remembered_txs)
-            new_known_txs.update(self.mining_txs_var.value)
-            for share in self.tracker.get_chain(self.best_share_var.value, min(120, self.tracker.get_height(self.best_share_var.value))):
-                for tx_hash in share.new_transaction_hashes:
-                    if tx_hash in self.known_txs_var.value:
-                        new_known_txs[tx_hash] = self.known_txs_var.value[tx_hash]
-            self.known_txs_var.set(new_known_txs)
-        t = deferral.RobustLoopingCall(forget_old_txs)
+        t = deferral.RobustLoopingCall(self.forget_old_txs)
         t.start(10)
         stop_signal.watch(t.stop)
         
@@ -291,6 +570,127 @@ class Node(object):
         t.start(5)
         stop_signal.watch(t.stop)
     
+    def _get_best_work(self):
+        works = [backend_work.value for backend_work in self.backend_works if backend_work.value is not None]
+        fresh_works = [work for work in works if work['last_update'] > time.time() - self.BACKEND_STALE_TIME]
+        return max(fresh_works or works, key=lambda work: (work['height'], -work['latency']))
+    
+    def submit_block(self, block, ignore_failure, packed_block=None, pow_hash=None):
+        '''
+        Sends block to every backend over P2P, then over RPC. block is only
+        packed once. Returns a Deferred that fires with True as soon as any
+        backend accepts the block, or with False once all have rejected it or
+        failed. submitblock isn't batched, so it goes out immediately.
+        '''
+        if packed_block is None:
+            packed_block = bitcoin_data.block_type.pack(block)
+        for factory, bitcoind in self.backends:
+            helper.submit_block_p2p(block, factory, self.net, packed_block)
+        block_hex = packed_block.encode('hex')
+        res = defer.Deferred()
+        def got_result(success):
+            if success and not res.called:
+                res.callback(True)
+        defer.DeferredList([
+            helper.submit_block_rpc(block, ignore_failure, bitcoind, backend_work if backend_work.value is not None else self.bitcoind_work, self.net, block_hex, pow_hash).addCallback(got_result)
+        for backend_work, (factory, bitcoind) in zip(self.backend_works, self.backends)], consumeErrors=True).addCallback(
+            lambda _: None if res.called else res.callback(False))
+        return res
+    
+    def notify_block(self, block_hash=None):
+        '''
+        Called when bitcoind announces a new block (e.g. through -blocknotify)
+        to fetch new work immediately instead of waiting for the P2P inv.
+        '''
+        self.block_notify_count += 1
+        if block_hash is not None:
+            if block_hash == self.bitcoind_work.value['previous_block'] or (self._block_notify is not None and self._block_notify[0] == block_hash):
+                self.block_notify_dupe_count += 1
+                return
+            self._block_notify = block_hash, time.time()
+        self.block_notified.happened()
+    
+    def pop_block_notify_time(self, block_hash):
+        '''Returns when block_hash was announced through notify_block, once'''
+        if self._block_notify is None or self._block_notify[0] != block_hash:
+            return None
+        res, self._block_notify = self._block_notify[1], None
+        return res
+    
+    def _ref_txs(self, tx_hashes):
+        for tx_hash in tx_hashes:
+            count = self._tx_refs.get(tx_hash, 0)
+            if not count:
+                self._unreferenced_tx_hashes.discard(tx_hash)
+            self._tx_refs[tx_hash] = count + 1
+    
+    def _unref_txs(self, tx_hashes):
+        for tx_hash in tx_hashes:
+            count = self._tx_refs.pop(tx_hash) - 1
+            if count:
+                self._tx_refs[tx_hash] = count
+            elif tx_hash in self.known_txs_var.value:
+                self._unreferenced_tx_hashes.add(tx_hash)
+    
+    def _update_share_window(self):
+        best = self.best_share_var.value
+        new_window = {}
+        if best is not None:
+            for share in self.tracker.get_chain(best, min(120, self.tracker.get_height(best))):
+                new_window[share.hash] = self._share_window[share.hash] if share.hash in self._share_window else share.new_transaction_hashes
+        for share_hash, tx_hashes in self._share_window.iteritems():
+            if share_hash not in new_window:
+                self._unref_txs(tx_hashes)
+        for share_hash, tx_hashes in new_window.iteritems():
+            if share_hash not in self._share_window:
+                self._ref_txs(tx_hashes)
+        self._share_window = new_window
+    
+    def forget_old_txs(self):
+        '''
+        Drops known transactions that nothing references anymore: not the
+        block template, not the last 120 shares and not any peer's remembered
+        transactions. References are counted as those change, so this only
+        costs O(dropped).
+        '''
+        tx_hashes, self._unreferenced_tx_hashes = self._unreferenced_tx_hashes, set()
+        self.known_txs_var.remove(tx_hashes)
+    
+    def _trim_known_txs(self):
+        '''
+        Drops unreferenced transactions from known_txs, oldest first, until
+        they fit in max_known_txs_size. Transactions in the block template,
+        referenced by recent shares or remembered for peers are needed to
+        build blocks and to check peers' shares, so they're kept even if that
+        leaves known_txs over budget (see get_known_txs_stats). Candidates come
+        from the reference counts, like in forget_old_txs. Peers are told
+        through losing_tx.
+        '''
+        self._trim_known_txs_call = None
+        if self.known_txs_size <= self.max_known_txs_size:
+            return
+        
+        evicted = []
+        size = self.known_txs_size
+        for tx_hash in sorted(self._unreferenced_tx_hashes, key=lambda tx_hash: self._known_txs_info[tx_hash][0]):
+            if size <= self.max_known_txs_size:
+                break
+            evicted.append(tx_hash)
+            size -= self._known_txs_info[tx_hash][1]
+        self.evicted_tx_count += len(evicted)
+        self.known_txs_var.remove(evicted)
+    
+    def get_known_txs_stats(self):
+        return dict(
+            count=len(self.known_txs_var.value),
+            size=self.known_txs_size,
+            max_size=self.max_known_txs_size,
+            occupancy=self.known_txs_size/self.max_known_txs_size,
+            mining_count=len(self.mining_txs_var.value),
+            evicted_count=self.evicted_tx_count,
+            over_budget=self.known_txs_size > self.max_known_txs_size, # referenced transactions alone don't fit
+        )
+    
     def set_best_share(self):
         best, desired, decorated_heads, bad_peer_addresses = self.tracker.think(self.get_height_rel_highest, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value)
         
@@ -304,8 +704,21 @@ class Node(object):
                         peer.badPeerHappened()
                         break
     
+    def _get_current_payouts(self):
+        # only changes with the best share or the block template, but is polled by the status thread and web interface
+        key = self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy']
+        if key != self._current_payouts_key:
+            txouts = p2pool_data.get_expected_payouts(self.tracker, self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy'], self.net)
+            addresses = dict((script, bitcoin_data.script2_to_address(script, self.net.PARENT)) for script in txouts)
+            self._current_payouts_key, self._current_payouts = key, (txouts, addresses)
+        return self._current_payouts
+    
     def get_current_txouts(self):
-        return p2pool_data.get_expected_payouts(self.tracker, self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy'], self.net)
+        return self._get_current_payouts()[0]
+    
+    def get_current_txout_addresses(self):
+        '''Returns script -> address (or None if the script isn't a standard one) for every current txout'''
+        return self._get_current_payouts()[1]
     
     def clean_tracker(self):
         best, desired, decorated_heads, bad_peer_addresses = self.tracker.think(self.get_height_rel_highest, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value)
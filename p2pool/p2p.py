@@ -1,5 +1,7 @@
 from __future__ import division
 
+import collections
+import hashlib
 import math
 import random
 import sys
@@ -24,10 +26,30 @@ def fragment(f, **kwargs):
         fragment(f, **dict((k, v[:len(v)//2]) for k, v in kwargs.iteritems()))
         fragment(f, **dict((k, v[len(v)//2:]) for k, v in kwargs.iteritems()))
 
+short_tx_id_type = pack.IntType(48)
+
+def get_short_tx_id(salt, tx_hash):
+    '''
+    Truncated salted hash standing in for tx_hash in compact shares. The salt
+    is the receiving node's packed nonce, so it can keep one index of its
+    known transactions for all of its peers.
+    '''
+    return short_tx_id_type.unpack(hashlib.sha256(salt + pack.IntType(256).pack(tx_hash)).digest()[:6])
+
 class Protocol(p2protocol.Protocol):
     VERSION = 1300
+    # services bits in version; features are only used with peers that advertise them
+    SERVICE_COMPACT_SHARES = 1 # peer understands cmpctshares
+    SERVICE_SHARE_INV = 2 # peer understands have_shares/want_shares
+    SERVICE_SHARE_HASHES = 4 # peer answers hashesreq
+    SERVICE_PARTIAL_SHAREREPLY = 8 # peer accepts sharereplies split into 'partial' parts
+    SERVICES = SERVICE_COMPACT_SHARES | SERVICE_SHARE_INV | SERVICE_SHARE_HASHES | SERVICE_PARTIAL_SHAREREPLY
     
     max_remembered_txs_size = 2500000
+    max_remote_share_hashes = 10000
+    max_want_shares = 5 # broadcast_share never offers more than this many at once
+    max_pending_compact_shares = 100
+    max_share_reply_parts = 100
     
     def __init__(self, node, incoming):
         p2protocol.Protocol.__init__(self, node.net.PREFIX, 1000000, node.traffic_happened)
@@ -36,6 +58,19 @@ class Protocol(p2protocol.Protocol):
         
         self.other_version = None
         self.connected2 = False
+        self.compact_shares = self.share_inv = self.share_hashes = self.partial_sharereplies = False
+        
+        self.traffic_stats = dict(
+            bytes_in=0,
+            bytes_out=0,
+            shares_in=0,
+            duplicate_shares_in=0,
+            shares_out=0,
+            share_hashes_in=0,
+            share_hashes_out=0,
+            compact_shares_in=0,
+            compact_txs_fetched=0,
+        )
     
     def connectionMade(self):
         self.factory.proto_made_connection(self)
@@ -46,7 +81,7 @@ class Protocol(p2protocol.Protocol):
         
         self.send_version(
             version=self.VERSION,
-            services=0,
+            services=self.SERVICES,
             addr_to=dict(
                 services=0,
                 address=self.transport.getPeer().host,
@@ -71,6 +106,12 @@ class Protocol(p2protocol.Protocol):
             timeout=15,
             on_timeout=self.disconnect,
         )
+        self.get_share_hashes = deferral.GenericDeferrer(
+            max_id=2**256,
+            func=lambda id, hash, count: self.send_hashesreq(id=id, hash=hash, count=count),
+            timeout=15,
+            on_timeout=self.disconnect,
+        )
         
         self.remote_tx_hashes = set() # view of peer's known_txs # not actually initially empty, but sending txs instead of tx hashes won't hurt
         self.remote_remembered_txs_size = 0
@@ -78,6 +119,27 @@ class Protocol(p2protocol.Protocol):
         self.remembered_txs = {} # view of peer's mining_txs
         self.remembered_txs_size = 0
         self.known_txs_cache = {}
+        
+        self.remote_share_hashes = set() # shares the peer is known to have, either from them or from us
+        self.remote_share_hashes_order = collections.deque() # remote_share_hashes, oldest first
+        self.pending_compact_shares = {} # share hash -> (entry, tx_hashes, txs) waiting on sharetxs
+        self.share_reply_parts = {} # sharereq id -> lists of shares from 'partial' sharereplies so far
+    
+    def dataReceived(self, data):
+        self.traffic_stats['bytes_in'] += len(data)
+        p2protocol.Protocol.dataReceived(self, data)
+    
+    def sendPayload(self, command, payload):
+        p2protocol.Protocol.sendPayload(self, command, payload)
+        self.traffic_stats['bytes_out'] += len(self._message_prefix) + 20 + len(payload)
+    
+    def add_remote_share_hashes(self, share_hashes):
+        for share_hash in share_hashes:
+            if share_hash not in self.remote_share_hashes:
+                self.remote_share_hashes.add(share_hash)
+                self.remote_share_hashes_order.append(share_hash)
+        while len(self.remote_share_hashes) > self.max_remote_share_hashes:
+            self.remote_share_hashes.remove(self.remote_share_hashes_order.popleft())
     
     def _connect_timeout(self):
         self.timeout_delayed = None
@@ -123,6 +185,10 @@ class Protocol(p2protocol.Protocol):
         self.other_version = version
         self.other_sub_version = sub_version[:512]
         self.other_services = services
+        self.compact_shares = bool(services & self.SERVICE_COMPACT_SHARES)
+        self.share_inv = bool(services & self.SERVICE_SHARE_INV)
+        self.share_hashes = bool(services & self.SERVICE_SHARE_HASHES)
+        self.partial_sharereplies = bool(services & self.SERVICE_PARTIAL_SHAREREPLY)
         
         if nonce == self.node.nonce:
             raise PeerMisbehavingError('was connected to self')
@@ -157,37 +223,36 @@ class Protocol(p2protocol.Protocol):
             random.expovariate(1/(100*len(self.node.peers) + 1))][-1])
         
         if best_share_hash is not None:
+            self.add_remote_share_hashes([best_share_hash])
             self.node.handle_share_hashes([best_share_hash], self)
         
-        def update_remote_view_of_my_known_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if added:
-                self.send_have_tx(tx_hashes=list(added))
-            if removed:
-                self.send_losing_tx(tx_hashes=list(removed))
-                
-                # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
-                key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
-                self.known_txs_cache[key] = dict((h, before[h]) for h in removed)
-                reactor.callLater(20, self.known_txs_cache.pop, key)
-        watch_id = self.node.known_txs_var.transitioned.watch(update_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.transitioned.unwatch(watch_id))
+        def update_remote_view_of_my_known_txs_added(added):
+            self.send_have_tx(tx_hashes=added.keys())
+        def update_remote_view_of_my_known_txs_removed(removed):
+            self.send_losing_tx(tx_hashes=removed.keys())
+            
+            # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
+            key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
+            self.known_txs_cache[key] = removed
+            reactor.callLater(20, self.known_txs_cache.pop, key)
+        watch_id = self.node.known_txs_var.added.watch(update_remote_view_of_my_known_txs_added)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_var.added.unwatch(watch_id))
+        watch_id2 = self.node.known_txs_var.removed.watch(update_remote_view_of_my_known_txs_removed)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_var.removed.unwatch(watch_id2))
         
         self.send_have_tx(tx_hashes=self.node.known_txs_var.value.keys())
         
-        def update_remote_view_of_my_mining_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if added:
-                self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(after[x]) for x in added)
-                assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
-                fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[after[x] for x in added if x not in self.remote_tx_hashes])
-            if removed:
-                self.send_forget_tx(tx_hashes=list(removed))
-                self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(before[x]) for x in removed)
-        watch_id2 = self.node.mining_txs_var.transitioned.watch(update_remote_view_of_my_mining_txs)
-        self.connection_lost_event.watch(lambda: self.node.mining_txs_var.transitioned.unwatch(watch_id2))
+        def update_remote_view_of_my_mining_txs_added(added):
+            self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(tx) for tx in added.itervalues())
+            assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
+            fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[tx for x, tx in added.iteritems() if x not in self.remote_tx_hashes])
+        def update_remote_view_of_my_mining_txs_removed(removed):
+            self.send_forget_tx(tx_hashes=removed.keys())
+            self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(tx) for tx in removed.itervalues())
+        watch_id3 = self.node.mining_txs_var.added.watch(update_remote_view_of_my_mining_txs_added)
+        self.connection_lost_event.watch(lambda: self.node.mining_txs_var.added.unwatch(watch_id3))
+        watch_id4 = self.node.mining_txs_var.removed.watch(update_remote_view_of_my_mining_txs_removed)
+        self.connection_lost_event.watch(lambda: self.node.mining_txs_var.removed.unwatch(watch_id4))
         
         self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(x) for x in self.node.mining_txs_var.value.values())
         assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
@@ -278,10 +343,16 @@ class Protocol(p2protocol.Protocol):
                 txs = None
             
             result.append((share, txs))
-            
+        
+        self.add_remote_share_hashes(share.hash for share, txs in result)
+        self.traffic_stats['shares_in'] += len(result)
         self.node.handle_shares(result, self)
     
     def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
+        if self.compact_shares:
+            self.sendCompactShares(shares)
+            return
+        
         tx_hashes = set()
         for share in shares:
             if share.VERSION >= 13:
@@ -306,11 +377,122 @@ class Protocol(p2protocol.Protocol):
         fragment(self.send_remember_tx, tx_hashes=[x for x in hashes_to_send if x in self.remote_tx_hashes], txs=[known_txs[x] for x in hashes_to_send if x not in self.remote_tx_hashes])
         
         fragment(self.send_shares, shares=[share.as_share() for share in shares])
+        self.add_remote_share_hashes(share.hash for share in shares)
+        self.traffic_stats['shares_out'] += len(shares)
         
         self.send_forget_tx(tx_hashes=hashes_to_send)
         
         self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
     
+    def sendCompactShares(self, shares):
+        '''Sends shares with their new transactions as short ids, the peer fetches the ones it doesn't know with getsharetxs'''
+        salt = pack.IntType(64).pack(self.nonce)
+        fragment(self.send_cmpctshares, shares=[dict(
+            hash=share.hash,
+            type=share.VERSION,
+            contents=share.share_type.pack(dict(share.contents, share_info=dict(share.share_info, new_transaction_hashes=[]))),
+            short_ids=[get_short_tx_id(salt, tx_hash) for tx_hash in share.share_info['new_transaction_hashes']],
+        ) for share in shares])
+        self.add_remote_share_hashes(share.hash for share in shares)
+        self.traffic_stats['shares_out'] += len(shares)
+    
+    message_cmpctshares = pack.ComposedType([
+        ('shares', pack.ListType(pack.ComposedType([
+            ('hash', pack.IntType(256)),
+            ('type', pack.VarIntType()),
+            ('contents', pack.VarStrType()), # share contents with new_transaction_hashes left empty
+            ('short_ids', pack.ListType(short_tx_id_type)),
+        ]))),
+    ])
+    def handle_cmpctshares(self, shares):
+        result = []
+        for entry in shares:
+            if entry['type'] < p2pool_data.Share.VERSION: continue
+            if entry['type'] != p2pool_data.Share.VERSION:
+                raise ValueError('unknown share type: %r' % (entry['type'],))
+            
+            known_txs = self.node.known_txs_var.value
+            tx_hashes = [self.node.resolve_short_tx_id(short_id) for short_id in entry['short_ids']]
+            txs = [known_txs[tx_hash] if tx_hash is not None else None for tx_hash in tx_hashes]
+            if None not in tx_hashes:
+                share = self._rebuild_compact_share(entry, tx_hashes, complete=False)
+                if share is not None:
+                    result.append((share, txs))
+                    continue
+                # a short id matched the wrong transaction, fetch all of them
+                tx_hashes, txs = [None]*len(tx_hashes), [None]*len(txs)
+            self._request_compact_share_txs(entry, tx_hashes, txs)
+        
+        self._got_compact_shares(result)
+    
+    def _rebuild_compact_share(self, entry, tx_hashes, complete):
+        contents = p2pool_data.Share.share_type.unpack(entry['contents'])
+        if contents['share_info']['new_transaction_hashes']:
+            raise PeerMisbehavingError('compact share included transaction hashes')
+        contents['share_info']['new_transaction_hashes'] = tx_hashes
+        try:
+            share = p2pool_data.Share(self.node.net, self.addr, contents)
+        except PeerMisbehavingError:
+            if complete:
+                raise
+            return None
+        if share.hash != entry['hash']:
+            if complete:
+                raise PeerMisbehavingError('compact share hash mismatch')
+            return None
+        return share
+    
+    def _request_compact_share_txs(self, entry, tx_hashes, txs):
+        if entry['hash'] in self.pending_compact_shares:
+            return
+        if len(self.pending_compact_shares) >= self.max_pending_compact_shares:
+            print 'Too many compact shares waiting for transactions from %s:%i, dropping share %s' % (self.addr[0], self.addr[1], p2pool_data.format_hash(entry['hash']))
+            return
+        indexes = [i for i, tx_hash in enumerate(tx_hashes) if tx_hash is None]
+        self.pending_compact_shares[entry['hash']] = entry, tx_hashes, txs
+        self.traffic_stats['compact_txs_fetched'] += len(indexes)
+        self.send_getsharetxs(hash=entry['hash'], indexes=indexes)
+    
+    def _got_compact_shares(self, result):
+        if not result:
+            return
+        self.add_remote_share_hashes(share.hash for share, txs in result)
+        self.traffic_stats['shares_in'] += len(result)
+        self.traffic_stats['compact_shares_in'] += len(result)
+        self.node.handle_shares(result, self)
+    
+    message_getsharetxs = pack.ComposedType([
+        ('hash', pack.IntType(256)),
+        ('indexes', pack.ListType(pack.VarIntType())),
+    ])
+    def handle_getsharetxs(self, hash, indexes):
+        self.node.handle_get_share_txs(hash, indexes, self)
+    
+    message_sharetxs = pack.ComposedType([
+        ('hash', pack.IntType(256)),
+        ('txs', pack.ListType(bitcoin_data.tx_type)), # empty if the peer couldn't provide them
+    ])
+    def handle_sharetxs(self, hash, txs):
+        if hash not in self.pending_compact_shares:
+            raise PeerMisbehavingError('sent transactions for a share that was not requested')
+        entry, tx_hashes, share_txs = self.pending_compact_shares.pop(hash)
+        indexes = [i for i, tx_hash in enumerate(tx_hashes) if tx_hash is None]
+        if not txs:
+            print 'Peer %s:%i could not provide transactions for share %s' % (self.addr[0], self.addr[1], p2pool_data.format_hash(hash))
+            return
+        if len(txs) != len(indexes):
+            raise PeerMisbehavingError('wrong number of share transactions')
+        
+        salt = pack.IntType(64).pack(self.node.nonce)
+        for i, tx in zip(indexes, txs):
+            tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+            if get_short_tx_id(salt, tx_hash) != entry['short_ids'][i]:
+                raise PeerMisbehavingError('share transaction does not match its short id')
+            tx_hashes[i] = tx_hash
+            share_txs[i] = tx
+        
+        self._got_compact_shares([(self._rebuild_compact_share(entry, tx_hashes, complete=True), share_txs)])
+    
     
     message_sharereq = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -320,25 +502,94 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_sharereq(self, id, hashes, parents, stops):
         shares = self.node.handle_get_shares(hashes, parents, stops, self)
+        
+        # split into replies that each fit in a message
+        parts = [[]]
+        size = 0
+        for share in shares:
+            wrapped_share = share.as_share()
+            share_size = p2pool_data.share_type.packed_size(wrapped_share)
+            if parts[-1] and size + share_size > self._max_payload_length - 100:
+                parts.append([])
+                size = 0
+            parts[-1].append(wrapped_share)
+            size += share_size
+        if not self.partial_sharereplies:
+            parts = parts[:1] # other peers only take a single reply, so send what fits
+        
         try:
-            self.send_sharereply(id=id, result='good', shares=[share.as_share() for share in shares])
+            for i, part in enumerate(parts):
+                self.send_sharereply(id=id, result='partial' if i != len(parts) - 1 else 'good', shares=part)
         except p2protocol.TooLong:
             self.send_sharereply(id=id, result='too long', shares=[])
+        else:
+            sent_count = sum(len(part) for part in parts)
+            self.add_remote_share_hashes(share.hash for share in shares[:sent_count])
+            self.traffic_stats['shares_out'] += sent_count
     
     message_sharereply = pack.ComposedType([
         ('id', pack.IntType(256)),
-        ('result', pack.EnumType(pack.VarIntType(), {0: 'good', 1: 'too long', 2: 'unk2', 3: 'unk3', 4: 'unk4', 5: 'unk5', 6: 'unk6'})),
+        ('result', pack.EnumType(pack.VarIntType(), {0: 'good', 1: 'too long', 2: 'partial', 3: 'unk3', 4: 'unk4', 5: 'unk5', 6: 'unk6'})), # 'partial' is followed by more replies with the same id
         ('shares', pack.ListType(p2pool_data.share_type)),
     ])
     class ShareReplyError(Exception): pass
     def handle_sharereply(self, id, result, shares):
-        if result == 'good':
+        if result in ['good', 'partial']:
             res = [p2pool_data.load_share(share, self.node.net, self.addr) for share in shares if share['type'] >= p2pool_data.Share.VERSION]
+            self.add_remote_share_hashes(share.hash for share in res)
+            self.traffic_stats['shares_in'] += len(res)
+            if result == 'partial':
+                if not self.get_shares.got_progress(id):
+                    return
+                parts = self.share_reply_parts.setdefault(id, [])
+                parts.append(res)
+                if len(parts) > self.max_share_reply_parts:
+                    raise PeerMisbehavingError('too many partial share replies')
+                return
+            res = [share for part in self.share_reply_parts.pop(id, []) for share in part] + res
         else:
+            self.share_reply_parts.pop(id, None)
             res = failure.Failure(self.ShareReplyError(result))
         self.get_shares.got_response(id, res)
     
     
+    message_hashesreq = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('hash', pack.IntType(256)),
+        ('count', pack.VarIntType()),
+    ])
+    def handle_hashesreq(self, id, hash, count):
+        self.send_hashesreply(id=id, hashes=self.node.handle_get_share_hashes(hash, count, self))
+    
+    message_hashesreply = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('hashes', pack.ListType(pack.IntType(256))), # hash and its parents, child first; empty if unknown
+    ])
+    def handle_hashesreply(self, id, hashes):
+        self.get_share_hashes.got_response(id, hashes)
+    
+    
+    message_have_shares = pack.ComposedType([
+        ('hashes', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_have_shares(self, hashes):
+        self.add_remote_share_hashes(hashes)
+        self.traffic_stats['share_hashes_in'] += len(hashes)
+        self.node.handle_have_shares(hashes, self)
+    
+    def announce_shares(self, shares):
+        '''Offers shares by hash, the peer asks for the ones it's missing with want_shares'''
+        self.send_have_shares(hashes=[share.hash for share in shares])
+        self.add_remote_share_hashes(share.hash for share in shares)
+        self.traffic_stats['share_hashes_out'] += len(shares)
+    
+    message_want_shares = pack.ComposedType([
+        ('hashes', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_want_shares(self, hashes):
+        self.node.handle_want_shares(hashes[:self.max_want_shares], self)
+    
+    
     message_bestblock = pack.ComposedType([
         ('header', bitcoin_data.block_header_type),
     ])
@@ -367,54 +618,65 @@ class Protocol(p2protocol.Protocol):
         ('txs', pack.ListType(bitcoin_data.tx_type)),
     ])
     def handle_remember_tx(self, tx_hashes, txs):
-        for tx_hash in tx_hashes:
-            if tx_hash in self.remembered_txs:
-                print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
-                self.disconnect()
-                return
-            
-            if tx_hash in self.node.known_txs_var.value:
-                tx = self.node.known_txs_var.value[tx_hash]
-            else:
-                for cache in self.known_txs_cache.itervalues():
-                    if tx_hash in cache:
-                        tx = cache[tx_hash]
-                        print 'Transaction %064x rescued from peer latency cache!' % (tx_hash,)
-                        break
+        remembered = []
+        try:
+            for tx_hash in tx_hashes:
+                if tx_hash in self.remembered_txs:
+                    print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
+                    self.disconnect()
+                    return
+                
+                if tx_hash in self.node.known_txs_var.value:
+                    tx = self.node.known_txs_var.value[tx_hash]
                 else:
-                    print >>sys.stderr, 'Peer referenced unknown transaction %064x, disconnecting' % (tx_hash,)
+                    for cache in self.known_txs_cache.itervalues():
+                        if tx_hash in cache:
+                            tx = cache[tx_hash]
+                            print 'Transaction %064x rescued from peer latency cache!' % (tx_hash,)
+                            break
+                    else:
+                        print >>sys.stderr, 'Peer referenced unknown transaction %064x, disconnecting' % (tx_hash,)
+                        self.disconnect()
+                        return
+                
+                self.remembered_txs[tx_hash] = tx
+                self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
+                remembered.append(tx_hash)
+            new_known_txs = {}
+            warned = False
+            for tx in txs:
+                tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+                if tx_hash in self.remembered_txs:
+                    print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
                     self.disconnect()
                     return
-            
-            self.remembered_txs[tx_hash] = tx
-            self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
-        new_known_txs = dict(self.node.known_txs_var.value)
-        warned = False
-        for tx in txs:
-            tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
-            if tx_hash in self.remembered_txs:
-                print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
-                self.disconnect()
-                return
-            
-            if tx_hash in self.node.known_txs_var.value and not warned:
-                print 'Peer sent entire transaction %064x that was already received' % (tx_hash,)
-                warned = True
-            
-            self.remembered_txs[tx_hash] = tx
-            self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
-            new_known_txs[tx_hash] = tx
-        self.node.known_txs_var.set(new_known_txs)
+                
+                if tx_hash in self.node.known_txs_var.value and not warned:
+                    print 'Peer sent entire transaction %064x that was already received' % (tx_hash,)
+                    warned = True
+                
+                self.remembered_txs[tx_hash] = tx
+                self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
+                remembered.append(tx_hash)
+                new_known_txs[tx_hash] = tx
+            self.node.known_txs_var.add(new_known_txs)
+        finally:
+            self.node.got_remembered_txs(remembered, self)
         if self.remembered_txs_size >= self.max_remembered_txs_size:
             raise PeerMisbehavingError('too much transaction data stored')
     message_forget_tx = pack.ComposedType([
         ('tx_hashes', pack.ListType(pack.IntType(256))),
     ])
     def handle_forget_tx(self, tx_hashes):
-        for tx_hash in tx_hashes:
-            self.remembered_txs_size -= 100 + bitcoin_data.tx_type.packed_size(self.remembered_txs[tx_hash])
-            assert self.remembered_txs_size >= 0
-            del self.remembered_txs[tx_hash]
+        forgotten = []
+        try:
+            for tx_hash in tx_hashes:
+                self.remembered_txs_size -= 100 + bitcoin_data.tx_type.packed_size(self.remembered_txs[tx_hash])
+                assert self.remembered_txs_size >= 0
+                del self.remembered_txs[tx_hash]
+                forgotten.append(tx_hash)
+        finally:
+            self.node.lost_remembered_txs(forgotten, self)
     
     
     def connectionLost(self, reason):
@@ -427,10 +689,15 @@ class Protocol(p2protocol.Protocol):
             if self.node.advertise_ip:
                 self._stop_thread2()
             self.connected2 = False
+        if self.remembered_txs:
+            self.node.lost_remembered_txs(self.remembered_txs.keys(), self)
+            self.remembered_txs = {}
+            self.remembered_txs_size = 0
         self.factory.proto_lost_connection(self, reason)
         if p2pool.DEBUG:
             print "Peer connection lost:", self.addr, reason
         self.get_shares.respond_all(reason)
+        self.get_share_hashes.respond_all(reason)
     
     @defer.inlineCallbacks
     def do_ping(self):
@@ -582,20 +849,27 @@ class SingleClientFactory(protocol.ReconnectingClientFactory):
         self.node.lost_conn(proto, reason)
 
 class Node(object):
-    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.Variable({}), mining_txs_var=variable.Variable({}), advertise_ip=True):
+    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=None, mining_txs_var=None, advertise_ip=True):
         self.best_share_hash_func = best_share_hash_func
         self.port = port
         self.net = net
         self.addr_store = dict(addr_store)
         self.connect_addrs = connect_addrs
         self.preferred_storage = preferred_storage
-        self.known_txs_var = known_txs_var
-        self.mining_txs_var = mining_txs_var
+        self.known_txs_var = known_txs_var if known_txs_var is not None else variable.DictVariable()
+        self.mining_txs_var = mining_txs_var if mining_txs_var is not None else variable.DictVariable()
         self.advertise_ip = advertise_ip
         
         self.traffic_happened = variable.Event()
         self.nonce = random.randrange(2**64)
         self.peers = {}
+        
+        self.short_id_salt = pack.IntType(64).pack(self.nonce)
+        self.short_tx_ids = {} # short id -> set of known tx hashes with it, for resolving compact shares
+        self._index_short_tx_ids(self.known_txs_var.value)
+        self.known_txs_var.added.watch(self._index_short_tx_ids)
+        self.known_txs_var.removed.watch(self._unindex_short_tx_ids)
+        
         self.bans = {} # address -> end_time
         self.clientfactory = ClientFactory(self, desired_outgoing_conns, max_outgoing_attempts)
         self.serverfactory = ServerFactory(self, max_incoming_conns)
@@ -654,6 +928,25 @@ class Node(object):
         print 'Lost peer %s:%i - %s' % (conn.addr[0], conn.addr[1], reason.getErrorMessage())
     
     
+    def _index_short_tx_ids(self, added):
+        for tx_hash in added:
+            self.short_tx_ids.setdefault(get_short_tx_id(self.short_id_salt, tx_hash), set()).add(tx_hash)
+    
+    def _unindex_short_tx_ids(self, removed):
+        for tx_hash in removed:
+            short_id = get_short_tx_id(self.short_id_salt, tx_hash)
+            tx_hashes = self.short_tx_ids[short_id]
+            tx_hashes.discard(tx_hash)
+            if not tx_hashes:
+                del self.short_tx_ids[short_id]
+    
+    def resolve_short_tx_id(self, short_id):
+        tx_hashes = self.short_tx_ids.get(short_id)
+        if tx_hashes is None or len(tx_hashes) != 1:
+            return None # unknown or ambiguous
+        tx_hash, = tx_hashes
+        return tx_hash
+    
     def got_addr(self, (host, port), services, timestamp):
         if (host, port) in self.addr_store:
             old_services, old_first_seen, old_last_seen = self.addr_store[host, port]
@@ -671,9 +964,27 @@ class Node(object):
     def handle_get_shares(self, hashes, parents, stops, peer):
         print 'handle_get_shares', (hashes, parents, stops, peer)
     
+    def handle_get_share_hashes(self, share_hash, count, peer):
+        print 'handle_get_share_hashes', (share_hash, count, peer)
+    
     def handle_bestblock(self, header, peer):
         print 'handle_bestblock', header
     
+    def handle_have_shares(self, hashes, peer):
+        print 'handle_have_shares', (hashes, peer)
+    
+    def handle_want_shares(self, hashes, peer):
+        print 'handle_want_shares', (hashes, peer)
+    
+    def handle_get_share_txs(self, share_hash, indexes, peer):
+        print 'handle_get_share_txs', (share_hash, indexes, peer)
+    
+    def got_remembered_txs(self, tx_hashes, peer):
+        pass
+    
+    def lost_remembered_txs(self, tx_hashes, peer):
+        pass
+    
     def get_good_peers(self, max_count):
         t = time.time()
         return [x[0] for x in sorted(self.addr_store.iteritems(), key=lambda (k, (services, first_seen, last_seen)):
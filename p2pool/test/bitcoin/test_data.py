@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from p2pool.bitcoin import data, networks
@@ -76,3 +77,12 @@ class Test(unittest.TestCase):
             0x13375a426de15631af9afdf00c490e87cc5aab823c327b9856004d0b198d72db,
             0x67d76a64fa9b6c5d39fde87356282ef507b3dec1eead4b54e739c74e02e81db4,
         ]) == 0x37a43a3b812e4eb665975f46393b4360008824aab180f27d642de8c28073bc44
+    
+    def test_merkle_tree_append(self):
+        hashes = [random.randrange(2**256) for i in xrange(50)]
+        tree = data.MerkleTree([None])
+        for i in xrange(len(hashes)):
+            tree.append(hashes[i:i+1])
+            assert tree.get_link(0) == data.calculate_merkle_link([None] + hashes[:i+1], 0)
+            assert data.check_merkle_link(42, tree.get_link(0)) == data.merkle_hash([42] + hashes[:i+1])
+        assert data.MerkleTree(hashes).get_root() == data.merkle_hash(hashes)
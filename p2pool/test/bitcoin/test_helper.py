@@ -0,0 +1,58 @@
+import random
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.bitcoin import data as bitcoin_data, helper
+
+def make_tx(i):
+    return dict(
+        version=1,
+        tx_ins=[dict(previous_output=dict(hash=random.randrange(2**256), index=0), script='\x00'*100, sequence=None) for j in xrange(2)],
+        tx_outs=[dict(value=i, script='\x76\xa9\x14' + '\x00'*20 + '\x88\xac') for j in xrange(2)],
+        lock_time=0,
+    )
+
+class FakeBitcoind(object):
+    def __init__(self, txs):
+        self.set_txs(txs)
+    
+    def set_txs(self, txs):
+        self.txs = txs
+        self.template = dict(
+            version=2,
+            previousblockhash='%064x' % (2**200,),
+            transactions=[dict(data=bitcoin_data.tx_type.pack(tx).encode('hex'), hash='%064x' % (bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)),), fee=1) for tx in txs],
+            coinbaseaux=dict(flags=''),
+            coinbasevalue=5000000000,
+            curtime=1400000000,
+            bits='1d00ffff',
+            height=1000,
+        )
+    
+    def rpc_getblocktemplate(self, param):
+        return defer.succeed(self.template)
+    
+    def rpc_getblock(self, block_hash_hex):
+        return defer.succeed(dict(height=999))
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_getwork_delta(self):
+        random.seed(0)
+        txs = [make_tx(i) for i in xrange(4000)]
+        bitcoind = FakeBitcoind(txs)
+        
+        work = yield helper.getwork(bitcoind, True)
+        assert len(work['added_transaction_hashes']) == 4000 and work['removed_transaction_hashes'] == []
+        
+        # a new block confirms 40 transactions and 40 new ones arrive
+        bitcoind.set_txs(txs[40:] + [make_tx(i) for i in xrange(40)])
+        work2 = yield helper.getwork(bitcoind, True, work)
+        
+        assert work2['transaction_hashes'] == [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in bitcoind.txs]
+        assert work2['transactions'] == bitcoind.txs
+        assert work2['added_transaction_hashes'] == work2['transaction_hashes'][-40:]
+        assert sorted(work2['removed_transaction_hashes']) == sorted(work['transaction_hashes'][:40])
+        # unchanged transactions aren't unpacked again
+        assert all(work2['transactions_by_hash'][tx_hash] is work['transactions_by_hash'][tx_hash] for tx_hash in work['transaction_hashes'][40:])
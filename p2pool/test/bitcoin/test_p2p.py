@@ -1,4 +1,5 @@
 from twisted.internet import defer, reactor
+from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from p2pool.bitcoin import data, networks, p2p
@@ -18,3 +19,37 @@ class Test(unittest.TestCase):
         finally:
             factory.stopTrying()
             c.disconnect()
+    
+    @defer.inlineCallbacks
+    def test_tx_ingestion(self):
+        factory = p2p.ClientFactory(networks.nets['apollocoin'])
+        conn = factory.buildProtocol(None)
+        conn.makeConnection(proto_helpers.StringTransport())
+        conn.transport.clear()
+        sent = []
+        conn.sendPacket = lambda command, payload2: sent.append((command, payload2))
+        
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='')], lock_time=0) for i in xrange(100)]
+        tx_hashes = [data.hash256(data.tx_type.pack(tx)) for tx in txs]
+        
+        # one getdata per inv, and txs that are already in flight aren't asked for again
+        conn.handle_inv(invs=[dict(type='tx', hash=tx_hash) for tx_hash in tx_hashes[:60]])
+        conn.handle_inv(invs=[dict(type='tx', hash=tx_hash) for tx_hash in tx_hashes])
+        assert [command for command, payload2 in sent] == ['getdata', 'getdata']
+        assert [x['hash'] for x in sent[0][1]['requests']] == tx_hashes[:60]
+        assert [x['hash'] for x in sent[1][1]['requests']] == tx_hashes[60:]
+        
+        # txs arriving together are delivered as one batch
+        batches = []
+        factory.new_txs.watch(batches.append)
+        for tx in txs:
+            conn.handle_tx(tx=tx)
+        yield deferral.sleep(factory.TX_BATCH_DELAY*2)
+        assert batches == [dict(zip(tx_hashes, txs))]
+        assert not factory._tx_requests
+        
+        # the set of requests in flight is bounded
+        factory.MAX_TX_REQUESTS = 10
+        for tx_hash in tx_hashes:
+            factory.start_tx_request(tx_hash)
+        assert factory._tx_requests.keys() == tx_hashes[-10:]
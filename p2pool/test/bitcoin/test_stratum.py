@@ -0,0 +1,211 @@
+from __future__ import division
+
+import json
+import random
+import time
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.bitcoin import data as bitcoin_data, getwork, stratum
+from p2pool.util import deferral, jsonrpc, math, pack, variable
+
+class FakeWorkerBridge(object):
+    COINBASE_NONCE_LENGTH = 8
+    
+    def __init__(self):
+        self.net = math.Object(DUMB_SCRYPT_DIFF=1, POW_FUNC=bitcoin_data.hash256)
+        self.new_work_event = variable.Event()
+        self.current_work = variable.Variable(dict(transactions=[]))
+        self.work_timing = {}
+        self.get_work_calls = 0
+        self.responses = []
+        self.response_new_work_times = []
+        self.block_notify_time = None
+    
+    def pop_block_notify_time(self):
+        res, self.block_notify_time = self.block_notify_time, None
+        return res
+    
+    def preprocess_request(self, username):
+        return username,
+    
+    def get_work(self, username):
+        self.get_work_calls += 1
+        def got_response(header, user, coinbase_nonce, pseudoshare_target=None, header_hash=None, pow_hash=None, found_time=None, new_work_times=None):
+            self.responses.append((username, user, coinbase_nonce))
+            self.response_new_work_times.append(new_work_times)
+            return pow_hash
+        return dict(
+            previous_block=2**200,
+            version=2,
+            bits=math.Object(bits=0x1d00ffff),
+            timestamp=1400000000,
+            merkle_link=dict(branch=[1, 2, 3], index=0),
+            share_target=2**240 // (1 + len(username)),
+            coinb1='coinb1' + username,
+            coinb2='coinb2',
+        ), got_response
+
+class FakeProxy(object):
+    def __getattr__(self, attr):
+        return self
+    def __call__(self, *args):
+        return defer.succeed(None)
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_fanout(self):
+        wb = FakeWorkerBridge()
+        notifier = stratum.StratumJobNotifier(wb)
+        notifier.BATCH_SIZE = 7
+        sent = []
+        providers = []
+        for i in xrange(30):
+            provider = stratum.StratumRPCMiningProvider(wb, FakeProxy(), None, notifier, lambda method, params, i=i: sent.append((i, method, json.loads(params))))
+            provider.username = 'x'*(i//2)
+            providers.append(provider)
+        providers[0].close()
+        
+        for j in xrange(2):
+            del sent[:]
+            if j == 1:
+                wb.block_notify_time = time.time() - 1
+            wb.new_work_event.happened()
+            yield deferral.sleep(0)
+            assert 0 < len(sent) <= notifier.BATCH_SIZE # other connections get serviced on later iterations
+            while notifier._pending or notifier._call is not None:
+                yield deferral.sleep(0)
+        
+        assert wb.get_work_calls == 2*15 # one job per distinct request and template
+        assert sorted(i for i, method, params in sent) == range(1, 30)
+        assert wb.work_timing['stratum_notify_time'] >= 0
+        assert 1 <= wb.work_timing['block_notify_latency'] < 2
+        for i, method, params in sent:
+            assert method == 'mining.notify'
+            assert len(params) == 9
+            assert params[2] == ('coinb1' + 'x'*(i//2)).encode('hex')
+            assert params[1] == sent[0][2][1] and params[3:] == sent[0][2][3:]
+            assert params[4] == ['01' + '00'*31, '02' + '00'*31, '03' + '00'*31]
+            assert params[8] is True
+            assert params[0] in notifier.handler_map
+        # first batch went to the connections with the highest difficulty
+        assert [i//2 for i, method, params in sent[:notifier.BATCH_SIZE]] == [14, 14, 13, 13, 12, 12, 11]
+        
+        # a template change that doesn't trigger new_work_event still isn't answered with cached jobs
+        assert notifier.get_job('x') is notifier.get_job('x') and wb.get_work_calls == 2*15
+        wb.current_work.set(dict(transactions=[1]))
+        notifier.get_job('x')
+        assert wb.get_work_calls == 2*15 + 1
+        
+        notifier.handler_map.stop()
+    
+    @defer.inlineCallbacks
+    def test_extranonce1(self):
+        wb = FakeWorkerBridge()
+        notifier = stratum.StratumJobNotifier(wb)
+        notifier.handler_map.stop()
+        providers = [stratum.StratumRPCMiningProvider(wb, FakeProxy(), None, notifier, lambda method, params: None) for i in xrange(100)]
+        
+        subscriptions = [provider.rpc_subscribe()[1:] for provider in providers]
+        assert len(set(extranonce1 for extranonce1, extranonce2_size in subscriptions)) == len(providers)
+        for extranonce1, extranonce2_size in subscriptions:
+            assert len(extranonce1.decode('hex')) + extranonce2_size == wb.COINBASE_NONCE_LENGTH
+        
+        freed = providers[10].extranonce1
+        providers[10].close()
+        notifier._next_extranonce1 = 0
+        assert notifier.allocate_extranonce1() == freed
+        
+        jobid, x, params = notifier.get_job('')
+        yield providers[3].rpc_submit('worker', jobid, '00'*4, '00'*4, '00'*4)
+        yield providers[4].rpc_submit('worker', jobid, '00'*4, '00'*4, '00'*4)
+        assert wb.responses == [('', 'worker', providers[3].extranonce1 + '\0'*4), ('', 'worker', providers[4].extranonce1 + '\0'*4)]
+        
+        # new work arriving while a submission is queued for validation doesn't make it dead on arrival
+        df = providers[5].rpc_submit('worker', jobid, '00'*4, '00'*4, '00'*4)
+        wb.new_work_event.happened()
+        yield df
+        notifier.validator.stop()
+        assert wb.response_new_work_times == [0, 0, 0]
+    
+    def test_vardiff(self):
+        random.seed(0)
+        target_range = 2**256//2**40, 2**256//2**4
+        for hash_rate in [1e5, 1e7, 1e9]:
+            vardiff = stratum.VarDiff(2**256//2**20, target_range, now=0)
+            now = 0
+            for i in xrange(2000):
+                now += random.expovariate(hash_rate/bitcoin_data.target_to_average_attempts(vardiff.target))
+                vardiff.got_submit(now)
+            # settled within the hysteresis band around the target submit interval
+            interval = bitcoin_data.target_to_average_attempts(vardiff.target)/hash_rate
+            assert vardiff.TARGET_INTERVAL/vardiff.HYSTERESIS/2 < interval < vardiff.TARGET_INTERVAL*vardiff.HYSTERESIS*2, (hash_rate, interval)
+            assert vardiff.retargets < 20
+        
+        # never goes outside of its bounds, even with no submissions at all
+        vardiff = stratum.VarDiff(2**256//2**20, target_range, now=0)
+        for now in xrange(0, 10000, 10):
+            vardiff.check(now)
+        assert vardiff.target == target_range[1]
+        
+        # small deviations from the target rate don't cause a retarget
+        vardiff = stratum.VarDiff(2**256//2**20, target_range, now=0)
+        for i in xrange(1000):
+            assert vardiff.got_submit(i*vardiff.TARGET_INTERVAL*1.2) is None
+    
+    @defer.inlineCallbacks
+    def test_vardiff_session(self):
+        wb = FakeWorkerBridge()
+        get_work = wb.get_work
+        wb.get_work = lambda username: (lambda (x, got_response): (dict(x, share_target_range=(2**256//2**40, 2**256//2**4)), got_response))(get_work(username))
+        notifier = stratum.StratumJobNotifier(wb)
+        notifier.handler_map.stop()
+        difficulties = []
+        sent = []
+        class Proxy(FakeProxy):
+            def rpc_set_difficulty(self, difficulty):
+                difficulties.append(difficulty)
+                return defer.succeed(None)
+        provider = stratum.StratumRPCMiningProvider(wb, Proxy(), None, notifier, lambda method, params: sent.append(json.loads(params)))
+        provider._send_work()
+        assert provider.vardiff is not None and len(difficulties) == 1
+        for i in xrange(provider.vardiff.RETARGET_SUBMITS):
+            yield provider.rpc_submit('worker', sent[-1][0], '00'*4, '00'*4, '00'*4)
+        notifier.validator.stop()
+        # submitting far too quickly raises the difficulty and resends work
+        assert len(difficulties) == 2 and difficulties[1] > difficulties[0]
+        assert len(sent) == 2
+        stats = notifier.get_stats()
+        assert stats['connections'] == stats['vardiff_connections'] == 1
+        assert stats['submits'] == provider.vardiff.RETARGET_SUBMITS and stats['retargets'] == 1
+    
+    @defer.inlineCallbacks
+    def test_submit_validator(self):
+        wb = FakeWorkerBridge()
+        notifier = stratum.StratumJobNotifier(wb)
+        notifier.handler_map.stop()
+        validator = notifier.validator
+        validator.MAX_QUEUED = 10
+        class Transport(object):
+            paused = 0
+            def pauseProducing(self):
+                self.paused += 1
+            def resumeProducing(self):
+                self.paused -= 1
+        transport = Transport()
+        jobid, x, params = notifier.get_job('')
+        
+        dfs = [validator.validate(transport, x, '\0'*8, '00'*4, pack.IntType(32).pack(i).encode('hex')) for i in xrange(20)]
+        assert transport.paused == 1 # reading stops once the queue is full
+        self.assertRaises(jsonrpc.Error, validator.validate, transport, x, '\0'*8, '00'*4, '00'*4)
+        
+        order = []
+        for i, df in enumerate(dfs):
+            df.addCallback(lambda (header, header_hash, pow_hash), i=i: order.append((i, header['nonce'], header_hash == pow_hash == bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header)))))
+        yield defer.DeferredList(dfs)
+        assert order == [(i, pack.IntType(32).unpack(getwork._swap4(pack.IntType(32).pack(i))), True) for i in xrange(20)] # delivered in submission order
+        assert transport.paused == 0
+        stats = notifier.get_stats()['validation']
+        assert stats['queue_depth'] == 0 and stats['submits'] == 20 and stats['refused'] == 1 and stats['mean_latency'] >= 0
+        validator.stop()
@@ -0,0 +1,79 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.bitcoin import getwork, worker_interface
+from p2pool.util import deferral, math
+
+class FakeWorkerBridge(worker_interface.WorkerBridge):
+    COINBASE_NONCE_LENGTH = 8
+    
+    def __init__(self):
+        worker_interface.WorkerBridge.__init__(self)
+        self.net = None
+        self.work_timing = {}
+        self.get_work_calls = 0
+    
+    def get_work(self, request):
+        self.get_work_calls += 1
+        return dict(
+            version=2,
+            previous_block=self.new_work_event.times,
+            merkle_link=dict(branch=[], index=0),
+            coinb1='coinb1',
+            coinb2='coinb2',
+            timestamp=1400000000,
+            bits=math.Object(bits=0x1d00ffff, target=2**224),
+            share_target=2**240,
+        ), lambda header, user, coinbase_nonce: True
+
+class FakeRequest(object):
+    def __init__(self, ip):
+        self.ip = ip
+        self.headers = {}
+        self.finish_df = defer.Deferred()
+    
+    def setHeader(self, key, value):
+        self.headers[key] = value
+    
+    def getHeader(self, key):
+        return None
+    
+    def getUser(self):
+        return 'user'
+    
+    def getClientIP(self):
+        return self.ip
+    
+    def notifyFinish(self):
+        return self.finish_df
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_long_poll_load(self):
+        wb = FakeWorkerBridge()
+        wi = worker_interface.WorkerInterface(worker_interface.CachingWorkerBridge(wb))
+        dispatcher = wi.long_poll_dispatcher
+        
+        requests = [FakeRequest('10.0.%i.%i' % (i//256, i%256)) for i in xrange(2000)]
+        results = {}
+        for i, request in enumerate(requests):
+            wi._getwork(request, None, long_poll=True).addCallback(lambda res, i=i: results.__setitem__(i, res))
+        requests[0].finish_df.errback(Exception('client went away'))
+        assert len(dispatcher) == 2000 and not results
+        
+        wb.new_work_event.happened()
+        iterations = 0
+        while len(results) < 1999:
+            yield deferral.sleep(0)
+            iterations += 1
+            assert len(results) <= iterations*dispatcher.BATCH_SIZE # bounded number of responses per reactor iteration
+        yield deferral.sleep(0)
+        
+        assert 0 not in results and len(dispatcher) == 0
+        assert wb.get_work_calls == 1 # every waiter shared one work generation
+        merkle_roots = set(getwork.decode_data(res['data'])['merkle_root'] for res in results.itervalues())
+        assert len(merkle_roots) == 1999
+        assert len(wi.worker_views) == 1999
+        
+        wi.worker_views.stop()
+        wi.merkle_root_to_handler.stop()
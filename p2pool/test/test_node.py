@@ -3,13 +3,14 @@ from __future__ import division
 import base64
 import random
 import tempfile
+import time
 
 from twisted.internet import defer, reactor
 from twisted.python import failure
 from twisted.trial import unittest
 from twisted.web import client, resource, server
 
-from p2pool import data, node, work
+from p2pool import data, node, web, work
 from p2pool.bitcoin import data as bitcoin_data, networks, worker_interface
 from p2pool.util import deferral, jsonrpc, math, variable
 
@@ -25,10 +26,13 @@ class bitcoind(object): # can be used as p2p factory, p2p protocol, or rpc jsonr
             'bits': bitcoin_data.FloatingInteger(bits=0x1a0513c5, target=0x513c50000000000000000000000000000000000000000000000L),
         }}
         
+        self.template_calls = 0
+        self.submitted_blocks = 0
+        
         self.conn = variable.Variable(self)
         self.new_headers = variable.Event()
         self.new_block = variable.Event()
-        self.new_tx = variable.Event()
+        self.new_txs = variable.Event()
     
     # p2p factory
     
@@ -40,6 +44,9 @@ class bitcoind(object): # can be used as p2p factory, p2p protocol, or rpc jsonr
     def send_block(self, block):
         pass
     
+    def send_packed_block(self, packed_block):
+        pass
+    
     def send_tx(self, tx):
         pass
     
@@ -61,21 +68,22 @@ class bitcoind(object): # can be used as p2p factory, p2p protocol, or rpc jsonr
     
     def rpc_getblocktemplate(self, param):
         if param['mode'] == 'template':
-            pass
+            self.template_calls += 1
         elif param['mode'] == 'submit':
+            self.submitted_blocks += 1
             result = param['data']
             block = bitcoin_data.block_type.unpack(result.decode('hex'))
             if sum(tx_out['value'] for tx_out in block['txs'][0]['tx_outs']) != sum(tx['tx_outs'][0]['value'] for tx in block['txs'][1:]) + 5000000000:
                 print 'invalid fee'
             if block['header']['previous_block'] != self.blocks[-1]:
                 return False
-            if bitcoin_data.hash256(result.decode('hex')) > block['header']['bits'].target:
+            if parent_net.POW_FUNC(bitcoin_data.block_header_type.pack(block['header'])) > block['header']['bits'].target:
                 return False
             header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(block['header']))
             self.blocks.append(header_hash)
             self.headers[header_hash] = block['header']
             reactor.callLater(0, self.new_block.happened)
-            return True
+            return None # like bitcoind, None means accepted
         else:
             raise jsonrpc.Error_for_code(-1)('invalid request')
         
@@ -123,9 +131,18 @@ class mm_provider(object):
             "chainid" : 1
         }
 
+# apollocoin with testnet-like limits, so the fake bitcoind's easy targets are accepted
+parent_net = math.Object(**dict(networks.nets['apollocoin'].__dict__,
+    NAME='apollocoin_testnet',
+    ADDRESS_VERSION=111,
+    SUBSIDY_FUNC=lambda height: 50*100000000 >> (height + 1)//840000,
+    SANE_TARGET_RANGE=(2**256//1000000000 - 1, 2**256 - 1),
+    DUST_THRESHOLD=1e8,
+))
+
 mynet = math.Object(
     NAME='mynet',
-    PARENT=networks.nets['litecoin_testnet'],
+    PARENT=parent_net,
     SHARE_PERIOD=5, # seconds
     CHAIN_LENGTH=20*60//3, # shares
     REAL_CHAIN_LENGTH=20*60//3, # shares
@@ -165,6 +182,7 @@ class MiniNode(object):
     
     @defer.inlineCallbacks
     def stop(self):
+        self.wb.stop()
         yield self.web_port.stopListening()
         yield self.n.p2p_node.stop()
         yield self.n.stop()
@@ -183,6 +201,30 @@ class Test(unittest.TestCase):
         yield n.start()
         
         wb = work.WorkerBridge(node=n, my_pubkey_hash=42, donation_percentage=2, merged_urls=[('http://127.0.0.1:%i' % (mm_port.getHost().port,), '')], worker_fee=3)
+        
+        # parsed usernames are cached, but the worker fee is still applied to each request
+        address = bitcoin_data.pubkey_hash_to_address(1234, mynet.PARENT)
+        details = [wb.get_user_details(address + '+5/7') for i in xrange(10000)]
+        assert len(wb._user_details_cache) == 1
+        assert set(details) == set([
+            (address, 1234, bitcoin_data.difficulty_to_target(7), bitcoin_data.difficulty_to_target(5)),
+            (address, 42, bitcoin_data.difficulty_to_target(7), bitcoin_data.difficulty_to_target(5)),
+        ])
+        assert 150 < sum(1 for user, pubkey_hash, _, _ in details if pubkey_hash == 42) < 450
+        assert wb.get_user_details('invalid')[1] == 42
+        
+        # block notifications refresh work right away, and repeated ones are dropped
+        notify_port = reactor.listenTCP(0, server.Site(web.BlockNotifyResource(n)), interface='127.0.0.1')
+        template_calls = bitd.template_calls
+        yield client.getPage('http://127.0.0.1:%i/%064x' % (notify_port.getHost().port, n.bitcoind_work.value['previous_block']))
+        assert bitd.template_calls == template_calls
+        for i in xrange(3):
+            yield client.getPage('http://127.0.0.1:%i/%064x' % (notify_port.getHost().port, 2**200))
+        assert bitd.template_calls == template_calls + 1
+        assert (n.block_notify_count, n.block_notify_dupe_count) == (4, 3)
+        assert n.pop_block_notify_time(2**200) is not None and n.pop_block_notify_time(2**200) is None
+        yield notify_port.stopListening()
+        
         web_root = resource.Resource()
         worker_interface.WorkerInterface(wb).attach_to(web_root)
         port = reactor.listenTCP(0, server.Site(web_root))
@@ -201,7 +243,67 @@ class Test(unittest.TestCase):
         
         assert len(n.tracker.items) == 100
         assert n.tracker.verified.get_height(n.best_share_var.value) == 100
+        assert wb.block_submissions and all(0 <= x['p2p_latency'] <= x['rpc_latency'] for x in wb.block_submissions)
+        
+        # known_txs stays within its budget by dropping the oldest unreferenced transactions
+        assert n.known_txs_size == sum(bitcoin_data.tx_type.packed_size(tx) for tx in n.known_txs_var.value.itervalues())
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='x'*100)], lock_time=0) for i in xrange(100)]
+        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs]
+        n.max_known_txs_size = n.known_txs_size + 10*bitcoin_data.tx_type.packed_size(txs[0])
+        for i in [0, 50]:
+            bitd.new_txs.happened(dict(zip(tx_hashes, txs)[i:i+50]))
+            yield deferral.sleep(.01)
+        assert n.known_txs_size <= n.max_known_txs_size
+        assert set(n.mining_txs_var.value) == set(n.bitcoind_work.value['transaction_hashes'])
+        assert set(n.mining_txs_var.value) <= set(n.known_txs_var.value)
+        assert len(set(tx_hashes) & set(n.known_txs_var.value)) == 10 and set(tx_hashes[50:]) >= set(tx_hashes) & set(n.known_txs_var.value)
+        assert n.get_known_txs_stats()['evicted_count'] == 90 and not n.get_known_txs_stats()['over_budget']
         
+        # referenced transactions are kept even when they alone don't fit; only unreferenced ones go
+        referenced = set(n.known_txs_var.value) - set(tx_hashes)
+        more_txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='y'*100)], lock_time=0) for i in xrange(10)]
+        n.max_known_txs_size = 1
+        bitd.new_txs.happened(dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in more_txs))
+        yield deferral.sleep(.01)
+        assert set(n.known_txs_var.value) == referenced and set(n.mining_txs_var.value) <= referenced
+        assert n.get_known_txs_stats()['evicted_count'] == 110 and n.get_known_txs_stats()['over_budget']
+        
+        # a transaction gains a reference (as when a peer remembers it) and is then safe from eviction until it loses it
+        n.max_known_txs_size = n.known_txs_size + 2*bitcoin_data.tx_type.packed_size(txs[0])
+        bitd.new_txs.happened(dict(zip(tx_hashes, txs)[:2]))
+        yield deferral.sleep(.01)
+        assert set(tx_hashes[:2]) <= set(n.known_txs_var.value) and n._unreferenced_tx_hashes == set(tx_hashes[:2])
+        n._ref_txs([tx_hashes[0]])
+        assert n._unreferenced_tx_hashes == set([tx_hashes[1]])
+        n.max_known_txs_size = 1
+        n.known_txs_var.add({tx_hashes[2]: txs[2]})
+        yield deferral.sleep(.01)
+        assert set(n.known_txs_var.value) == referenced | set([tx_hashes[0]]) and not n._unreferenced_tx_hashes
+        n._unref_txs([tx_hashes[0]])
+        assert n._unreferenced_tx_hashes == set([tx_hashes[0]])
+        n.known_txs_var.add({tx_hashes[3]: txs[3]})
+        yield deferral.sleep(.01)
+        assert set(n.known_txs_var.value) == referenced and not n._unreferenced_tx_hashes
+        assert n.get_known_txs_stats()['evicted_count'] == 114
+        
+        # reference counts follow the block template and the share window, so unreferenced transactions can be dropped directly
+        refs = {}
+        for tx_hash in list(n.mining_txs_var.value) + [tx_hash for share in n.tracker.get_chain(n.best_share_var.value, min(120, n.tracker.get_height(n.best_share_var.value))) for tx_hash in share.new_transaction_hashes]:
+            refs[tx_hash] = refs.get(tx_hash, 0) + 1
+        assert n._tx_refs == refs
+        n.forget_old_txs()
+        assert not set(tx_hashes) & set(n.known_txs_var.value)
+        assert set(n.mining_txs_var.value) <= set(n.known_txs_var.value) <= set(refs)
+        
+        # template transactions that went missing from known_txs are added back with the next template
+        tx_hash = iter(n.mining_txs_var.value).next()
+        n.known_txs_var.remove([tx_hash])
+        n.notify_block()
+        yield deferral.sleep(1)
+        assert tx_hash in n.known_txs_var.value
+
+        yield proxy.close()
+        yield deferral.sleep(1) # let the server notice the keep-alive connection closing
         wb.stop()
         n.stop()
         
@@ -216,6 +318,169 @@ class Test(unittest.TestCase):
         yield mm_port.stopListening()
     #test_node.timeout = 15
     
+    @defer.inlineCallbacks
+    def test_backup_bitcoind(self):
+        bitd, bitd2 = bitcoind(), bitcoind()
+        n = node.Node(bitd, bitd, [], [], mynet, [(bitd2, bitd2)])
+        yield n.start()
+        assert all(backend_work.value is not None for backend_work in n.backend_works)
+        
+        # blocks go to every backend
+        assert (yield n.submit_block(dict(
+            header=dict(version=2, previous_block=bitd.blocks[-1], merkle_root=0, timestamp=0, bits=n.bitcoind_work.value['bits'], nonce=0),
+            txs=[dict(version=1, tx_ins=[], tx_outs=[dict(value=5000000000, script='')], lock_time=0)],
+        ), True))
+        assert bitd.submitted_blocks == bitd2.submitted_blocks == 1
+        
+        # a rejected block is reported as such
+        assert not (yield n.submit_block(dict(
+            header=dict(version=2, previous_block=1, merkle_root=0, timestamp=0, bits=n.bitcoind_work.value['bits'], nonce=0),
+            txs=[dict(version=1, tx_ins=[], tx_outs=[dict(value=5000000000, script='')], lock_time=0)],
+        ), True))
+        assert bitd.submitted_blocks == bitd2.submitted_blocks == 2
+        
+        # if the primary hangs, the backup's templates are used once the primary's go stale
+        hung_df = defer.Deferred()
+        bitd.rpc_getblocktemplate = lambda param: hung_df
+        n.BACKEND_STALE_TIME = 0.5
+        yield deferral.sleep(1)
+        n.notify_block()
+        assert n.bitcoind_work.value is n.backend_works[1].value
+        assert n.backend_works[0].value['last_update'] < time.time() - 1
+        
+        n.stop()
+        del bitd.rpc_getblocktemplate
+        hung_df.errback(defer.TimeoutError())
+        yield deferral.sleep(20) # waiting for work_poller to retry and exit
+        self.flushLoggedErrors(defer.TimeoutError)
+    
+    @defer.inlineCallbacks
+    def test_share_relay(self):
+        bitd = bitcoind()
+        
+        a = yield MiniNode.start(mynet, bitd, bitd, [], [])
+        b = yield MiniNode.start(mynet, bitd, bitd, [a.n.p2p_node.serverfactory.listen_port.getHost().port], [])
+        
+        yield deferral.sleep(3)
+        
+        proxy = jsonrpc.HTTPProxy('http://127.0.0.1:' + str(a.web_port.getHost().port),
+            headers=dict(Authorization='Basic ' + base64.b64encode('user/0:password')))
+        for i in xrange(20):
+            blah = yield proxy.rpc_getwork()
+            yield proxy.rpc_getwork(blah['data'])
+            yield deferral.sleep(.1)
+        yield proxy.close()
+        
+        yield deferral.sleep(3)
+        
+        # b never relayed a share to a first, so a only announces shares to it, and b asks for each once
+        assert b.n.best_share_var.value == a.n.best_share_var.value
+        assert len(b.n.tracker.items) == 20
+        peer_a, = b.n.p2p_node.peers.values()
+        peer_b, = a.n.p2p_node.peers.values()
+        assert peer_b.traffic_stats['share_hashes_out'] == peer_a.traffic_stats['share_hashes_in'] == 20
+        assert peer_b.traffic_stats['shares_out'] == peer_a.traffic_stats['shares_in'] == 20
+        assert peer_a.traffic_stats['duplicate_shares_in'] == 0 and peer_a.traffic_stats['shares_out'] == 0
+        assert peer_b.traffic_stats['bytes_out'] == peer_a.traffic_stats['bytes_in']
+        
+        # b already knew every transaction, so shares were rebuilt from short ids alone
+        assert peer_a.compact_shares and peer_b.compact_shares
+        assert peer_a.traffic_stats['compact_shares_in'] == 20 and peer_a.traffic_stats['compact_txs_fetched'] == 0
+        
+        # a transaction b doesn't know is fetched from a
+        share = [share for share in a.n.tracker.items.itervalues() if share.new_transaction_hashes][0]
+        lost_tx_hash = share.new_transaction_hashes[0]
+        b.n.known_txs_var.remove([lost_tx_hash])
+        peer_b.sendCompactShares([share])
+        yield deferral.sleep(1)
+        assert peer_a.traffic_stats['compact_txs_fetched'] == 1
+        assert peer_a.traffic_stats['duplicate_shares_in'] == 1
+        assert lost_tx_hash in b.n.known_txs_var.value
+        
+        # the shares a peer is known to have are forgotten oldest first
+        peer_a.max_remote_share_hashes = 25
+        peer_a.add_remote_share_hashes(xrange(10))
+        assert len(peer_a.remote_share_hashes) == 25 and peer_a.remote_share_hashes >= set(xrange(10))
+        peer_a.add_remote_share_hashes(xrange(10, 30))
+        assert peer_a.remote_share_hashes == set(xrange(5, 30))
+        
+        # want_shares is only answered for as many shares as are ever offered at once
+        shares_out = peer_a.traffic_stats['shares_out']
+        peer_b.send_want_shares(hashes=list(b.n.tracker.items))
+        yield deferral.sleep(1)
+        assert peer_a.traffic_stats['shares_out'] == shares_out + peer_a.max_want_shares
+        
+        # peers that don't advertise have_shares/want_shares support get full shares
+        assert peer_b.share_inv and peer_b.share_hashes and peer_b.partial_sharereplies
+        peer_b.share_inv = False
+        share_hashes_out, shares_out = peer_b.traffic_stats['share_hashes_out'], peer_b.traffic_stats['shares_out']
+        proxy = jsonrpc.HTTPProxy('http://127.0.0.1:' + str(a.web_port.getHost().port),
+            headers=dict(Authorization='Basic ' + base64.b64encode('user/0:password')))
+        blah = yield proxy.rpc_getwork()
+        yield proxy.rpc_getwork(blah['data'])
+        yield proxy.close()
+        yield deferral.sleep(1)
+        assert b.n.best_share_var.value == a.n.best_share_var.value
+        assert peer_b.traffic_stats['share_hashes_out'] == share_hashes_out and peer_b.traffic_stats['shares_out'] == shares_out + 1
+        
+        yield b.stop()
+        yield a.stop()
+        del a, b, peer_a, peer_b
+        import gc
+        gc.collect()
+        
+        yield deferral.sleep(20) # waiting for work_poller to exit
+    
+    @defer.inlineCallbacks
+    def test_sync(self):
+        SHARES = 200
+        
+        bitd = bitcoind()
+        
+        a = yield MiniNode.start(mynet, bitd, bitd, [], [])
+        b = yield MiniNode.start(mynet, bitd, bitd, [a.n.p2p_node.serverfactory.listen_port.getHost().port], [])
+        
+        yield deferral.sleep(3)
+        
+        for i in xrange(SHARES):
+            proxy = jsonrpc.HTTPProxy('http://127.0.0.1:' + str(random.choice([a, b]).web_port.getHost().port),
+                headers=dict(Authorization='Basic ' + base64.b64encode('user/0:password')))
+            blah = yield proxy.rpc_getwork()
+            yield proxy.rpc_getwork(blah['data'])
+            yield proxy.close()
+            yield deferral.sleep(.05)
+        
+        yield deferral.sleep(3)
+        assert a.n.best_share_var.value == b.n.best_share_var.value
+        
+        # a new node downloads the chain from both peers at once
+        start = time.time()
+        c = yield MiniNode.start(mynet, bitd, bitd, [a.n.p2p_node.serverfactory.listen_port.getHost().port, b.n.p2p_node.serverfactory.listen_port.getHost().port], [])
+        while c.n.best_share_var.value != a.n.best_share_var.value:
+            assert time.time() < start + 60, 'sync timed out'
+            yield deferral.sleep(.1)
+        
+        assert c.n.tracker.get_height(c.n.best_share_var.value) == a.n.tracker.get_height(a.n.best_share_var.value)
+        assert len(c.n.p2p_node.peers) == 2 and all(peer.traffic_stats['shares_in'] for peer in c.n.p2p_node.peers.itervalues())
+        
+        # replies too big for one message are split into parts instead of refused
+        a.n.p2p_node.peers[c.n.p2p_node.nonce]._max_payload_length = 50000
+        peer_a = c.n.p2p_node.peers[a.n.p2p_node.nonce]
+        shares = yield peer_a.get_shares(hashes=[c.n.best_share_var.value], parents=SHARES - 1, stops=[])
+        assert [share.hash for share in shares] == [share.hash for share in c.n.tracker.get_chain(c.n.best_share_var.value, SHARES)]
+        assert sum(data.share_type.packed_size(share.as_share()) for share in shares) > 2*50000
+        assert not peer_a.share_reply_parts
+        del peer_a
+        
+        yield c.stop()
+        yield b.stop()
+        yield a.stop()
+        del a, b, c
+        import gc
+        gc.collect()
+        
+        yield deferral.sleep(20) # waiting for work_poller to exit
+    
     @defer.inlineCallbacks
     def test_nodes(self):
         N = 3
@@ -234,6 +499,7 @@ class Test(unittest.TestCase):
                 headers=dict(Authorization='Basic ' + base64.b64encode('user/0:password')))
             blah = yield proxy.rpc_getwork()
             yield proxy.rpc_getwork(blah['data'])
+            yield proxy.close()
             yield deferral.sleep(.05)
             print i
             print type(nodes[0].n.tracker.items[nodes[0].n.best_share_var.value])
@@ -1,4 +1,4 @@
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.trial import unittest
 
 from p2pool.util import deferral, expiring_dict
@@ -30,3 +30,30 @@ class Test(unittest.TestCase):
         e[1]
         yield deferral.sleep(2.25)
         assert 1 not in e
+    
+    @defer.inlineCallbacks
+    def test_shared_timer(self):
+        es = [expiring_dict.ExpiringDict(1 + i % 3) for i in xrange(5000)]
+        for i, e in enumerate(es):
+            e[i] = i
+        # one reactor timer serves every dict
+        assert len([call for call in reactor.getDelayedCalls() if call.func == expiring_dict.expiry_service._fire]) == 1
+        yield deferral.sleep(1.5)
+        assert sum(len(e) for e in es) == 5000 - 5000//3 - (5000 % 3 > 0)
+        es[1].stop()
+        yield deferral.sleep(3)
+        assert sum(len(e) for e in es) == 1
+        assert expiring_dict.expiry_service._call is None
+    
+    def test_collected(self):
+        self.addCleanup(setattr, expiring_dict, 'expiry_service', expiring_dict.expiry_service)
+        service = expiring_dict.expiry_service = expiring_dict.ExpiryService()
+        es = [expiring_dict.ExpiringDict(100 + i) for i in xrange(1000)]
+        for i, e in enumerate(es):
+            e[i] = i
+        assert len(service._heap) == 1000
+        del es[1:]
+        # collected dicts are dropped lazily, and only from the top of the heap
+        assert len(service._heap) == 1000 and service._call_time == es[0].expiry_deque[0].contents[0]
+        del es, e
+        assert not service._heap and service._call is None
@@ -0,0 +1,151 @@
+import json
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool.util import deferral, jsonrpc
+
+class FakeBitcoind(object):
+    def __init__(self):
+        self.blocks = 100
+        self.slow_calls = self.max_slow_calls = 0
+    
+    def rpc_getblockcount(self, request):
+        return self.blocks
+    
+    def rpc_getinfo(self, request):
+        return dict(version=80600, blocks=self.blocks, errors='')
+    
+    def rpc_submitblock(self, request, block_hex):
+        return None
+    
+    def rpc_fail(self, request):
+        raise jsonrpc.Error_for_code(-5)(u'Block not found')
+    
+    @defer.inlineCallbacks
+    def rpc_slow(self, request):
+        self.slow_calls += 1
+        self.max_slow_calls = max(self.max_slow_calls, self.slow_calls)
+        yield deferral.sleep(1)
+        self.slow_calls -= 1
+        defer.returnValue(True)
+
+class NonBatchingHTTPServer(jsonrpc.HTTPServer):
+    @defer.inlineCallbacks
+    def render_POST(self, request):
+        data = request.content.read()
+        if data.startswith('['):
+            data = json.dumps(dict(result=None, error=dict(code=-32700, message=u'Parse error'), id=None))
+        else:
+            data = yield jsonrpc._handle(data, self._provider, preargs=[request])
+        request.setHeader('Content-Type', 'application/json')
+        request.write(data)
+
+class CountingSite(server.Site):
+    connections = 0
+    
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_http_proxy(self):
+        root = resource.Resource()
+        root.putChild('', jsonrpc.HTTPServer(FakeBitcoind()))
+        site = CountingSite(root)
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        
+        proxy = jsonrpc.HTTPProxy('http://127.0.0.1:%i/' % (port.getHost().port,), timeout=0.5, pool_size=2)
+        for i in xrange(20):
+            assert (yield proxy.rpc_getblockcount()) == 100
+        assert site.connections == 1 # sequential calls all reused one connection
+        res = yield defer.gatherResults([proxy.rpc_getinfo() for i in xrange(10)])
+        assert all(x['blocks'] == 100 for x in res)
+        assert site.connections <= 10
+        
+        try:
+            yield proxy.rpc_fail()
+        except jsonrpc.Error, e:
+            assert e.code == -5
+        else:
+            assert False
+        
+        try:
+            yield proxy.rpc_slow()
+        except defer.TimeoutError:
+            pass
+        else:
+            assert False
+        
+        stats = proxy.get_stats()
+        assert stats['calls'] == 32 and stats['failures'] == 1
+        assert stats['mean_latency'] > 0 and set(stats['mean_latency_by_method']) == set(['getblockcount', 'getinfo', 'fail'])
+        
+        yield proxy.close()
+        yield deferral.sleep(1.5) # let the slow call finish on the server side
+        yield port.stopListening()
+    
+    @defer.inlineCallbacks
+    def test_connection_limit(self):
+        bitd = FakeBitcoind()
+        root = resource.Resource()
+        root.putChild('', jsonrpc.HTTPServer(bitd))
+        site = CountingSite(root)
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        
+        proxy = jsonrpc.HTTPProxy('http://127.0.0.1:%i/' % (port.getHost().port,), timeout=5, pool_size=2)
+        proxy._client.batch_supported = False # so that every call is a request of its own
+        res = yield defer.gatherResults([proxy.rpc_slow() for i in xrange(5)])
+        assert res == [True]*5
+        assert bitd.max_slow_calls == 2 and site.connections == 2
+        
+        yield proxy.close()
+        yield port.stopListening()
+    
+    @defer.inlineCallbacks
+    def test_batch(self):
+        root = resource.Resource()
+        root.putChild('', jsonrpc.HTTPServer(FakeBitcoind()))
+        root.putChild('old', NonBatchingHTTPServer(FakeBitcoind()))
+        port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+        
+        proxy = jsonrpc.HTTPProxy('http://127.0.0.1:%i/' % (port.getHost().port,), timeout=0.5)
+        dfs = [proxy.rpc_getblockcount() for i in xrange(250)]
+        fail_df = proxy.rpc_fail()
+        assert (yield defer.gatherResults(dfs)) == [100]*250
+        try:
+            yield fail_df
+        except jsonrpc.Error, e:
+            assert e.code == -5
+        else:
+            assert False
+        stats = proxy.get_stats()
+        assert stats['calls'] == 251 and stats['requests'] == 3 and stats['batches'] == 3
+        
+        res = yield proxy.call_batch([('getinfo', []), ('fail', []), ('getblockcount', [])])
+        assert res[0]['blocks'] == 100 and res[1].check(jsonrpc.Error) and res[2] == 100
+        assert proxy.get_stats()['requests'] == 4
+        
+        assert (yield proxy.rpc_getblockcount()) == 100 # lone calls aren't wrapped in a batch
+        assert proxy.get_stats()['batches'] == 4
+        
+        # latency-critical calls skip the batch, and so aren't timed out along with a slow one
+        dfs = [proxy.rpc_slow(), proxy.rpc_getblockcount(), proxy.rpc_submitblock('00')]
+        assert (yield dfs[2]) is None and not dfs[0].called
+        assert proxy.get_stats()['requests'] == 7 and proxy.get_stats()['batches'] == 5
+        res = yield defer.DeferredList(dfs[:2], consumeErrors=True)
+        assert res[0][1].check(defer.TimeoutError) and res[1][1].check(defer.TimeoutError)
+        yield deferral.sleep(1) # let the slow call finish on the server side
+        yield proxy.close()
+        
+        old_proxy = jsonrpc.HTTPProxy('http://127.0.0.1:%i/old' % (port.getHost().port,), timeout=0.5)
+        res = yield defer.gatherResults([old_proxy.rpc_getblockcount() for i in xrange(5)])
+        assert res == [100]*5
+        assert not old_proxy._client.batch_supported
+        res = yield defer.gatherResults([old_proxy.rpc_getblockcount() for i in xrange(5)])
+        assert res == [100]*5
+        yield old_proxy.close()
+        
+        yield port.stopListening()
@@ -36,3 +36,35 @@ class Test(unittest.TestCase):
             for x in xrange(n + 1):
                 left, right = math.binomial_conf_interval(x, n)
                 assert 0 <= left <= x/n <= right <= 1, (left, right, x, n)
+    
+    def test_bucket_rate_monitor(self):
+        m = math.BucketRateMonitor(600, 60)
+        assert m.get_totals(0) == ({}, 0)
+        m.add(dict(a=100), 0) # first datum only marks the start
+        for t in xrange(1, 1201):
+            m.add(dict(a=1, b=t), t)
+            totals, dt = m.get_totals(t)
+            assert dt == min(t, t - (t//10 - 59)*10)
+            assert totals['a'] == sum(1 for t2 in xrange(1, t + 1) if t2 >= t - dt)
+        assert m.get_totals(5005) == ({}, 595)
+    
+    def test_decaying_rates(self):
+        r = math.DecayingRates(100)
+        for t in xrange(0, 2000, 2):
+            r.add('x', 10, t)
+            if t == 500:
+                r.add('y', 1, t)
+        assert abs(r.get_rate('x', 1998) - 5) < 0.1
+        assert r.get_rate('y', 1998) == 0
+        assert r.get_rate('z', 1998) == 0
+        # rate is unbiased shortly after the first datum
+        r.add('z', 1e6, 0)
+        r.add('z', 1e6, 1)
+        assert abs(r.get_rate('z', 1) - 1e6) < 1e4
+        assert set(r.get_rates(1998)) == set(['x', 'y', 'z'])
+        assert set(r.get_rates(1e6)) == set()
+        # keys whose rates are never read as a whole are still dropped as data comes in
+        r.add('x', 10, 2e6)
+        r.add('y', 10, 2e6)
+        r.add('x', 10, 3e6)
+        assert set(r.values) == set(['x'])
@@ -0,0 +1,113 @@
+import hashlib
+import random
+import struct
+
+from twisted.trial import unittest
+
+from p2pool.util import datachunker, p2protocol, pack
+
+prefix = 'f9beb4d9'.decode('hex')
+
+class FakeTransport(object):
+    class peer(object):
+        host = '127.0.0.1'
+    
+    def getPeer(self):
+        return self.peer
+
+class MyProtocol(p2protocol.Protocol):
+    def __init__(self):
+        p2protocol.Protocol.__init__(self, prefix, 1000)
+        self.transport = FakeTransport()
+        self.received = []
+    
+    message_data = pack.ComposedType([
+        ('data', pack.VarStrType()),
+    ])
+    
+    def packetReceived(self, command, payload2):
+        self.received.append((command, payload2['data']))
+    
+    def badPeerHappened(self):
+        self.received.append('bad')
+
+class OldProtocol(MyProtocol):
+    '''The generator based framing parser that was used before, for comparison'''
+    
+    def __init__(self):
+        MyProtocol.__init__(self)
+        self.dataReceived2 = datachunker.DataChunker(self.dataReceiver())
+    
+    def dataReceived(self, data):
+        self.dataReceived2(data)
+    
+    def dataReceiver(self):
+        while True:
+            start = ''
+            while start != self._message_prefix:
+                start = (start + (yield 1))[-len(self._message_prefix):]
+            
+            command = (yield 12).rstrip('\0')
+            length, = struct.unpack('<I', (yield 4))
+            if length > self._max_payload_length:
+                continue
+            checksum = yield 4
+            payload = yield length
+            
+            if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+                self.badPeerHappened()
+                continue
+            
+            type_ = getattr(self, 'message_' + command, None)
+            if type_ is None:
+                continue
+            
+            self.packetReceived(command, type_.unpack(payload, self.ignore_trailing_payload))
+
+def make_message(command, data, bad_checksum=False):
+    payload = MyProtocol.message_data.pack(dict(data=data))
+    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    if bad_checksum:
+        checksum = chr(ord(checksum[0]) ^ 1) + checksum[1:]
+    return prefix + struct.pack('<12sI', command, len(payload)) + checksum + payload
+
+def make_stream(count):
+    parts = []
+    for i in xrange(count):
+        kind = random.randrange(10)
+        if kind == 0:
+            parts.append(''.join(chr(random.randrange(256)) for j in xrange(random.randrange(20)))) # garbage
+        elif kind == 1:
+            parts.append(prefix + struct.pack('<12sI', 'data', 1001)) # oversize
+        elif kind == 2:
+            parts.append(make_message('data', 'x'*random.randrange(100), bad_checksum=True))
+        elif kind == 3:
+            parts.append(make_message('unknown', 'x'*random.randrange(100)))
+        else:
+            parts.append(make_message('data', ''.join(chr(random.randrange(256)) for j in xrange(random.randrange(900)))))
+    return ''.join(parts)
+
+def feed(protocol, stream, piece_size_func):
+    pos = 0
+    while pos < len(stream):
+        size = piece_size_func()
+        protocol.dataReceived(stream[pos:pos + size])
+        pos += size
+
+class Test(unittest.TestCase):
+    def test_same_as_old(self):
+        random.seed(0)
+        for i in xrange(20):
+            stream = make_stream(100)
+            old, new = OldProtocol(), MyProtocol()
+            feed(old, stream, lambda: random.choice([1, 7, 100, 3000]))
+            feed(new, stream, lambda: random.choice([1, 7, 100, 3000]))
+            assert new.received == old.received
+            assert 'bad' in new.received
+    
+    def test_many_messages(self):
+        stream = ''.join(make_message('data', 'x'*random.randrange(100)) for i in xrange(20000))
+        old, new = OldProtocol(), MyProtocol()
+        feed(old, stream, lambda: 4096)
+        feed(new, stream, lambda: 4096)
+        assert len(new.received) == 20000 and new.received == old.received
@@ -0,0 +1,21 @@
+from twisted.trial import unittest
+
+from p2pool.util import variable
+
+class Test(unittest.TestCase):
+    def test_dict_variable(self):
+        v = variable.DictVariable(dict(a=1))
+        events = []
+        v.added.watch(lambda added: events.append(('added', added)))
+        v.removed.watch(lambda removed: events.append(('removed', removed)))
+        value = v.value
+        
+        v.add(dict(a=1, b=2))
+        v.remove(['a', 'c'])
+        v.add({})
+        v.set(dict(b=2, d=4))
+        assert v.value is value and v.value == dict(b=2, d=4)
+        assert events == [('added', dict(b=2)), ('removed', dict(a=1)), ('added', dict(d=4))]
+        
+        v.set(dict(e=5))
+        assert events[-2:] == [('added', dict(e=5)), ('removed', dict(b=2, d=4))]
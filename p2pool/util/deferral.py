@@ -123,6 +123,17 @@ class GenericDeferrer(object):
         timer.cancel()
         df.callback(resp)
     
+    def got_progress(self, id):
+        '''
+        Restarts the timeout of a query whose response comes in several parts,
+        returns whether the query is still waiting
+        '''
+        if id not in self.map:
+            return False
+        df, timer = self.map[id]
+        timer.reset(self.timeout)
+        return True
+    
     def respond_all(self, resp):
         while self.map:
             id, (df, timer) = self.map.popitem()
@@ -1,9 +1,11 @@
 from __future__ import division
 
+import heapq
+import itertools
 import time
 import weakref
 
-from p2pool.util import deferral
+from twisted.internet import reactor
 
 class Node(object):
     def __init__(self, contents, prev=None, next=None):
@@ -97,6 +99,60 @@ class LinkedList(object):
         return node.contents
 
 
+class ExpiryService(object):
+    '''
+    Runs expiry for every ExpiringDict from a single reactor timer. Each dict
+    with entries has one heap item holding the time its oldest entry is due;
+    the timer is only armed for the earliest of those, so idle dicts cost
+    nothing no matter how many exist.
+    '''
+    
+    def __init__(self):
+        self._heap = [] # (timestamp, tiebreaker, weakref to ExpiringDict)
+        self._counter = itertools.count()
+        self._call = None
+        self._call_time = None
+    
+    def schedule(self, d, timestamp):
+        heapq.heappush(self._heap, (timestamp, self._counter.next(), weakref.ref(d, self._forget)))
+        self._arm()
+    
+    def _forget(self, d_ref):
+        # the collected dict's item stays in the heap and is skipped when it's popped, like ones for stopped dicts
+        self._arm()
+    
+    def _arm(self):
+        while self._heap and (self._heap[0][2]() is None or not self._heap[0][2]()._scheduled):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            if self._call is not None and self._call.active():
+                self._call.cancel()
+            self._call = self._call_time = None
+            return
+        timestamp = self._heap[0][0]
+        if self._call is not None and not self._call.active():
+            self._call = self._call_time = None
+        if self._call is not None:
+            if self._call_time <= timestamp:
+                return
+            self._call.cancel()
+        self._call = reactor.callLater(max(0, timestamp - time.time()), self._fire)
+        self._call_time = timestamp
+    
+    def _fire(self):
+        self._call = self._call_time = None
+        t = time.time()
+        while self._heap and self._heap[0][0] <= t:
+            timestamp, _, d_ref = heapq.heappop(self._heap)
+            d = d_ref()
+            if d is None or not d._scheduled:
+                continue
+            d._scheduled = False
+            d.expire()
+        self._arm()
+
+expiry_service = ExpiryService()
+
 class ExpiringDict(object):
     def __init__(self, expiry_time, get_touches=True):
         self.expiry_time = expiry_time
@@ -105,12 +161,20 @@ class ExpiringDict(object):
         self.expiry_deque = LinkedList()
         self.d = dict() # key -> node, value
         
-        self_ref = weakref.ref(self, lambda _: expire_loop.stop() if expire_loop.running else None)
-        self._expire_loop = expire_loop = deferral.RobustLoopingCall(lambda: self_ref().expire())
-        expire_loop.start(1)
+        self._scheduled = False
+        self._stopped = False
     
     def stop(self):
-        self._expire_loop.stop()
+        self._stopped = True
+        if self._scheduled:
+            self._scheduled = False
+            expiry_service._arm()
+    
+    def _schedule(self):
+        if self._scheduled or self._stopped or not self.d:
+            return
+        self._scheduled = True
+        expiry_service.schedule(self, self.expiry_deque[0].contents[0])
     
     def __repr__(self):
         return 'ExpiringDict' + repr(self.__dict__)
@@ -127,6 +191,7 @@ class ExpiringDict(object):
         
         new_value = old_value if value is self._nothing else value
         self.d[key] = self.expiry_deque.append((time.time() + self.expiry_time, key)), new_value
+        self._schedule()
         return new_value
     
     def expire(self):
@@ -137,6 +202,7 @@ class ExpiringDict(object):
                 break
             del self.d[key]
             node.delete()
+        self._schedule()
     
     def __contains__(self, key):
         return key in self.d
@@ -1,14 +1,16 @@
 from __future__ import division
 
+import StringIO
 import json
+import time
 import weakref
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.protocols import basic
 from twisted.python import failure, log
-from twisted.web import client, error
+from twisted.web import client, error, http_headers
 
-from p2pool.util import deferral, deferred_resource, memoize
+from p2pool.util import deferral, deferred_resource, math, memoize
 
 class Error(Exception):
     def __init__(self, code, message, data=None):
@@ -102,37 +104,196 @@ def _handle(data, provider, preargs=(), response_handler=None):
 
 # HTTP
 
-@defer.inlineCallbacks
-def _http_do(url, headers, timeout, method, params):
-    id_ = 0
-    
-    try:
-        data = yield client.getPage(
-            url=url,
-            method='POST',
-            headers=dict(headers, **{'Content-Type': 'application/json'}),
-            postdata=json.dumps({
-                'jsonrpc': '2.0',
-                'method': method,
-                'params': params,
-                'id': id_,
-            }),
-            timeout=timeout,
-        )
-    except error.Error, e:
+class HTTPClient(object):
+    '''
+    Makes JSON-RPC calls to one URL over at most pool_size concurrent,
+    persistent HTTP/1.1 connections instead of connecting for every call.
+    Requests beyond that wait for one of the others to finish.
+    
+    Calls made during the same reactor tick are coalesced into a single
+    JSON-RPC 2.0 batch request. If the server turns out not to understand
+    batches, calls are sent one at a time from then on. The timeout covers
+    a whole request, so UNBATCHED_METHODS, whose latency matters, are sent
+    immediately in requests of their own instead of waiting for the tick
+    and sharing a batch's timeout.
+    '''
+    
+    MAX_BATCH_SIZE = 100
+    UNBATCHED_METHODS = frozenset(['getblocktemplate', 'getmemorypool', 'submitblock'])
+    
+    def __init__(self, url, headers={}, timeout=5, pool_size=2):
+        self.url = url
+        self.headers = http_headers.Headers(dict((k, [v]) for k, v in dict(headers, **{'Content-Type': 'application/json'}).iteritems()))
+        self.timeout = timeout
+        
+        self.pool = client.HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = pool_size
+        self._semaphore = defer.DeferredSemaphore(pool_size) # the pool alone only limits idle connections
+        self.agent = client.Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        
+        self.batch_supported = True
+        self._queue = []
+        self._flush_call = None
+        
+        self.latency_monitor = math.BucketRateMonitor(10*60)
+        self.calls = 0
+        self.failures = 0
+        self.requests = 0
+        self.batches = 0
+    
+    def __call__(self, method, params):
+        self.calls += 1
+        start = time.time()
+        df = defer.Deferred()
+        if method in self.UNBATCHED_METHODS:
+            self._send([(method, params, df)])
+        else:
+            self._queue.append((method, params, df))
+            if self._flush_call is None:
+                self._flush_call = reactor.callLater(0, self._flush)
+        def done(res):
+            if isinstance(res, failure.Failure) and not res.check(Error):
+                self.failures += 1
+            else:
+                self.latency_monitor.add({'latency': time.time() - start, 'count': 1, ('latency', method): time.time() - start, ('count', method): 1})
+            return res
+        return df.addBoth(done)
+    
+    def call_batch(self, calls):
+        '''
+        calls is a list of (method, params) pairs. Returns a Deferred that
+        fires with a list of results, with Failures in place of results for
+        calls that errored.
+        '''
+        return defer.DeferredList([self(method, params) for method, params in calls], consumeErrors=True).addCallback(
+            lambda res: [result for success, result in res])
+    
+    def _flush(self):
+        self._flush_call = None
+        queue, self._queue = self._queue, []
+        if not self.batch_supported:
+            for call in queue:
+                self._send([call])
+            return
+        for i in xrange(0, len(queue), self.MAX_BATCH_SIZE):
+            self._send(queue[i:i + self.MAX_BATCH_SIZE])
+    
+    def _send(self, calls):
+        self._semaphore.run(self._send_now, calls)
+    
+    def _send_now(self, calls):
+        calls = [(method, params, df) for method, params, df in calls if not df.called] # skip calls cancelled while queued
+        if not calls:
+            return
+        self.requests += 1
+        if len(calls) == 1:
+            (method, params, _), = calls
+            req_df = self._do(method, params).addCallback(lambda result: [result])
+        else:
+            self.batches += 1
+            req_df = self._do_batch([(method, params) for method, params, df in calls])
+        timeout_call = reactor.callLater(self.timeout, req_df.cancel)
+        def done(res):
+            if timeout_call.active():
+                timeout_call.cancel()
+            elif isinstance(res, failure.Failure) and res.check(defer.CancelledError):
+                res = failure.Failure(defer.TimeoutError('%s timed out after %s seconds' % (', '.join(sorted(set(method for method, params, df in calls))), self.timeout)))
+            for i, (method, params, df) in enumerate(calls):
+                if df.called:
+                    continue
+                if isinstance(res, failure.Failure):
+                    df.errback(res)
+                elif isinstance(res[i], failure.Failure):
+                    df.errback(res[i])
+                else:
+                    df.callback(res[i])
+        return req_df.addBoth(done)
+    
+    @deferral.inlineCallbacks
+    def _post(self, obj):
+        response = yield self.agent.request('POST', self.url, self.headers, client.FileBodyProducer(StringIO.StringIO(json.dumps(obj))))
+        data = yield client.readBody(response)
+        
         try:
-            resp = json.loads(e.response)
+            resp = json.loads(data)
         except:
-            raise e
-    else:
-        resp = json.loads(data)
-    
-    if resp['id'] != id_:
-        raise ValueError('invalid id')
-    if 'error' in resp and resp['error'] is not None:
-        raise Error_for_code(resp['error']['code'])(resp['error']['message'], resp['error'].get('data', None))
-    defer.returnValue(resp['result'])
-HTTPProxy = lambda url, headers={}, timeout=5: Proxy(lambda method, params: _http_do(url, headers, timeout, method, params))
+            if not 200 <= response.code < 300:
+                raise error.Error(response.code, response.phrase, data)
+            raise
+        defer.returnValue(resp)
+    
+    @staticmethod
+    def _get_result(resp):
+        if 'error' in resp and resp['error'] is not None:
+            return failure.Failure(Error_for_code(resp['error']['code'])(resp['error']['message'], resp['error'].get('data', None)))
+        return resp['result']
+    
+    @deferral.inlineCallbacks
+    def _do(self, method, params):
+        id_ = 0
+        
+        resp = yield self._post({
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': id_,
+        })
+        
+        if resp['id'] != id_:
+            raise ValueError('invalid id')
+        result = self._get_result(resp)
+        if isinstance(result, failure.Failure):
+            result.raiseException()
+        defer.returnValue(result)
+    
+    @deferral.inlineCallbacks
+    def _do_batch(self, calls):
+        resp = yield self._post([{
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': id_,
+        } for id_, (method, params) in enumerate(calls)])
+        
+        if not isinstance(resp, list):
+            # server doesn't understand batches - fall back to separate requests
+            self.batch_supported = False
+            res = yield defer.DeferredList([self._do(method, params) for method, params in calls], consumeErrors=True)
+            defer.returnValue([result for success, result in res])
+        
+        results = dict((x['id'], self._get_result(x)) for x in resp if isinstance(x, dict) and 'id' in x)
+        if set(results) != set(xrange(len(calls))):
+            raise ValueError('invalid ids in batch response')
+        defer.returnValue([results[id_] for id_ in xrange(len(calls))])
+    
+    def get_stats(self):
+        totals, dt = self.latency_monitor.get_totals()
+        return dict(
+            calls=self.calls,
+            failures=self.failures,
+            requests=self.requests,
+            batches=self.batches,
+            mean_latency=totals['latency']/totals['count'] if totals.get('count') else None,
+            mean_latency_by_method=dict((key[1], totals[key]/totals['count', key[1]]) for key in totals if isinstance(key, tuple) and key[0] == 'latency'),
+        )
+    
+    def close(self):
+        # a connection only returns to the pool after the reactor has finished with its last response
+        return task.deferLater(reactor, 0, self.pool.closeCachedConnections)
+
+class HTTPProxy(Proxy):
+    def __init__(self, url, headers={}, timeout=5, pool_size=2):
+        self._client = HTTPClient(url, headers, timeout, pool_size)
+        Proxy.__init__(self, self._client)
+    
+    def call_batch(self, calls):
+        return self._client.call_batch(calls)
+    
+    def get_stats(self):
+        return self._client.get_stats()
+    
+    def close(self):
+        return self._client.close()
 
 class HTTPServer(deferred_resource.DeferredResource):
     def __init__(self, provider):
@@ -141,7 +302,16 @@ class HTTPServer(deferred_resource.DeferredResource):
     
     @defer.inlineCallbacks
     def render_POST(self, request):
-        data = yield _handle(request.content.read(), self._provider, preargs=[request])
+        data = request.content.read()
+        try:
+            reqs = json.loads(data)
+        except Exception:
+            reqs = None # let _handle report the parse error
+        if isinstance(reqs, list) and reqs:
+            res = yield defer.gatherResults([_handle(json.dumps(req), self._provider, preargs=[request]) for req in reqs])
+            data = '[%s]' % (', '.join(res),)
+        else:
+            data = yield _handle(data, self._provider, preargs=[request])
         assert data is not None
         request.setHeader('Content-Type', 'application/json')
         request.setHeader('Content-Length', len(data))
@@ -160,5 +330,9 @@ class LineBasedPeer(basic.LineOnlyReceiver):
         })))
         self.other = Proxy(self._matcher)
     
+    def send_notification(self, method, params_json):
+        # params_json is already encoded so that callers can reuse shared fragments
+        self.sendLine('{"jsonrpc": "2.0", "method": %s, "params": %s, "id": null}' % (json.dumps(method), params_json))
+    
     def lineReceived(self, line):
         _handle(line, self, response_handler=self._matcher.got_response).addCallback(lambda line2: self.sendLine(line2) if line2 is not None else None)
@@ -207,35 +207,106 @@ def string_to_natural(s, alphabet=None):
         assert not s.startswith(alphabet[0])
         return sum(alphabet.index(char) * len(alphabet)**i for i, char in enumerate(reversed(s)))
 
-class RateMonitor(object):
-    def __init__(self, max_lookback_time):
+class BucketRateMonitor(object):
+    '''
+    Keeps per-key totals of the values added over the last
+    max_lookback_time seconds, summed into fixed-width time buckets held in
+    a ring. The first values added only mark the start time. Adding and
+    querying cost O(buckets) at most, no matter how many values were added.
+    '''
+    
+    def __init__(self, max_lookback_time, bucket_count=60):
         self.max_lookback_time = max_lookback_time
+        self.bucket_width = max_lookback_time/bucket_count
         
-        self.datums = []
+        self.buckets = [None]*bucket_count # (bucket number, {key: total}) or None
+        self.totals = {}
+        self.current_bucket = None
         self.first_timestamp = None
     
-    def _prune(self):
-        start_time = time.time() - self.max_lookback_time
-        for i, (ts, datum) in enumerate(self.datums):
-            if ts > start_time:
-                self.datums[:] = self.datums[i:]
-                return
+    def _advance(self, now):
+        bucket = int(now//self.bucket_width)
+        if self.current_bucket is not None:
+            for old in xrange(max(self.current_bucket + 1, bucket - len(self.buckets) + 1), bucket + 1):
+                entry = self.buckets[old % len(self.buckets)]
+                if entry is not None:
+                    for key, value in entry[1].iteritems():
+                        self.totals[key] -= value
+                        if not self.totals[key]:
+                            del self.totals[key]
+                    self.buckets[old % len(self.buckets)] = None
+            if bucket - self.current_bucket >= len(self.buckets):
+                self.totals = {}
+        self.current_bucket = bucket
+        return bucket
     
-    def get_datums_in_last(self, dt=None):
-        if dt is None:
-            dt = self.max_lookback_time
-        assert dt <= self.max_lookback_time
-        self._prune()
-        now = time.time()
-        return [datum for ts, datum in self.datums if ts > now - dt], min(dt, now - self.first_timestamp) if self.first_timestamp is not None else 0
+    def get_totals(self, now=None):
+        '''Returns the totals of the values added in the last max_lookback_time seconds and the time they cover'''
+        now = time.time() if now is None else now
+        if self.first_timestamp is None:
+            return {}, 0
+        bucket = self._advance(now)
+        start = max(self.first_timestamp, (bucket - len(self.buckets) + 1)*self.bucket_width)
+        return dict(self.totals), now - start
     
-    def add_datum(self, datum):
-        self._prune()
-        t = time.time()
+    def add(self, values, now=None):
+        now = time.time() if now is None else now
         if self.first_timestamp is None:
-            self.first_timestamp = t
-        else:
-            self.datums.append((t, datum))
+            self.first_timestamp = now
+            return
+        bucket = self._advance(now)
+        entry = self.buckets[bucket % len(self.buckets)]
+        if entry is None:
+            entry = self.buckets[bucket % len(self.buckets)] = bucket, {}
+        for key, value in values.iteritems():
+            entry[1][key] = entry[1].get(key, 0) + value
+            self.totals[key] = self.totals.get(key, 0) + value
+
+class DecayingRates(object):
+    '''
+    Per-key rate estimates that decay exponentially with the given time
+    constant, so each key only stores its decayed total and the time of its
+    last update. Keys that haven't been updated for 20 time constants are
+    dropped, at most once per time constant as data is added and whenever
+    all rates are read.
+    '''
+    
+    def __init__(self, time_constant):
+        self.time_constant = time_constant
+        
+        self.values = {} # key -> (decayed total, last update, first update)
+        self._last_prune = None
+    
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        self._last_prune = now
+        for key, (total, last, first) in self.values.items():
+            if now - last > 20*self.time_constant:
+                del self.values[key]
+    
+    def add(self, key, amount, now=None):
+        now = time.time() if now is None else now
+        if self._last_prune is None or now - self._last_prune > self.time_constant:
+            self.prune(now)
+        if key not in self.values:
+            self.values[key] = 0, now, now
+            return # like BucketRateMonitor, the first datum only marks the start time
+        total, last, first = self.values[key]
+        self.values[key] = total*math.exp(-(now - last)/self.time_constant) + amount, now, first
+    
+    def get_rate(self, key, now=None):
+        if key not in self.values:
+            return 0
+        now = time.time() if now is None else now
+        total, last, first = self.values[key]
+        if now <= first:
+            return 0
+        return total*math.exp(-(now - last)/self.time_constant)/(self.time_constant*-math.expm1(-(now - first)/self.time_constant))
+    
+    def get_rates(self, now=None):
+        now = time.time() if now is None else now
+        self.prune(now)
+        return dict((key, self.get_rate(key, now)) for key in self.values)
 
 def merge_dicts(*dicts):
     res = {}
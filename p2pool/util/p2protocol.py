@@ -9,36 +9,72 @@ from twisted.internet import protocol
 from twisted.python import log
 
 import p2pool
-from p2pool.util import datachunker, variable
+from p2pool.util import variable
 
 class TooLong(Exception):
     pass
 
 class Protocol(protocol.Protocol):
+    _header_struct = struct.Struct('<12sI4s') # command, payload length, checksum; follows the message prefix
+    
     def __init__(self, message_prefix, max_payload_length, traffic_happened=variable.Event(), ignore_trailing_payload=False):
         self._message_prefix = message_prefix
         self._max_payload_length = max_payload_length
-        self.dataReceived2 = datachunker.DataChunker(self.dataReceiver())
         self.traffic_happened = traffic_happened
         self.ignore_trailing_payload = ignore_trailing_payload
+        
+        self._recv_buf = '' # data being parsed, starting at _recv_pos
+        self._recv_pos = 0
+        self._recv_chunks = [] # data received since _recv_buf was last built
+        self._recv_chunks_len = 0
+        self._recv_needed = len(message_prefix) # bytes past _recv_pos needed before parsing can make progress
     
     def dataReceived(self, data):
         self.traffic_happened.happened('p2p/in', len(data))
-        self.dataReceived2(data)
+        
+        # only join received data once there's enough of it, so a large message arriving in many pieces is copied once
+        self._recv_chunks.append(data)
+        self._recv_chunks_len += len(data)
+        if len(self._recv_buf) - self._recv_pos + self._recv_chunks_len < self._recv_needed:
+            return
+        if self._recv_pos == len(self._recv_buf) and len(self._recv_chunks) == 1:
+            self._recv_buf = data
+        else:
+            self._recv_buf = ''.join([self._recv_buf[self._recv_pos:]] + self._recv_chunks)
+        self._recv_pos = 0
+        self._recv_chunks = []
+        self._recv_chunks_len = 0
+        
+        self._parse_messages()
     
-    def dataReceiver(self):
+    def _parse_messages(self):
+        buf = self._recv_buf
+        prefix_len = len(self._message_prefix)
+        header_len = prefix_len + self._header_struct.size
+        pos = self._recv_pos
         while True:
-            start = ''
-            while start != self._message_prefix:
-                start = (start + (yield 1))[-len(self._message_prefix):]
+            start = buf.find(self._message_prefix, pos)
+            if start == -1:
+                # keep what could be the beginning of a prefix
+                pos = max(pos, len(buf) - prefix_len + 1)
+                needed = prefix_len
+                break
+            if len(buf) - start < header_len:
+                pos, needed = start, header_len
+                break
             
-            command = (yield 12).rstrip('\0')
-            length, = struct.unpack('<I', (yield 4))
+            command, length, checksum = self._header_struct.unpack_from(buf, start + prefix_len)
+            command = command.rstrip('\0')
             if length > self._max_payload_length:
                 print 'length too large'
+                pos = start + prefix_len + 16 # look for the next prefix right after the length field
                 continue
-            checksum = yield 4
-            payload = yield length
+            end = start + header_len + length
+            if len(buf) < end:
+                pos, needed = start, end - start
+                break
+            payload = buf[start + header_len:end]
+            pos = end
             
             if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
                 print 'invalid hash for', self.transport.getPeer().host, repr(command), length, checksum.encode('hex')
@@ -59,6 +95,10 @@ class Protocol(protocol.Protocol):
                 print 'RECV', command, payload[:100].encode('hex') + ('...' if len(payload) > 100 else '')
                 log.err(None, 'Error handling message: (see RECV line)')
                 self.disconnect()
+        
+        if pos == len(buf):
+            buf, pos = '', 0
+        self._recv_buf, self._recv_pos, self._recv_needed = buf, pos, needed
     
     def packetReceived(self, command, payload2):
         handler = getattr(self, 'handle_' + command, None)
@@ -82,16 +122,21 @@ class Protocol(protocol.Protocol):
         self.disconnect()
     
     def sendPacket(self, command, payload2):
-        if len(command) >= 12:
-            raise ValueError('command too long')
         type_ = getattr(self, 'message_' + command, None)
         if type_ is None:
             raise ValueError('invalid command')
         #print 'SEND', command, repr(payload2)[:500]
-        payload = type_.pack(payload2)
+        self.sendPayload(command, type_.pack(payload2))
+    
+    def sendPayload(self, command, payload):
+        '''Sends a payload that was already packed with message_<command>'''
+        if len(command) >= 12:
+            raise ValueError('command too long')
+        if getattr(self, 'message_' + command, None) is None:
+            raise ValueError('invalid command')
         if len(payload) > self._max_payload_length:
             raise TooLong('payload too long')
-        data = self._message_prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+        data = self._message_prefix + self._header_struct.pack(command, len(payload), hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]) + payload
         self.traffic_happened.happened('p2p/out', len(data))
         self.transport.write(data)
     
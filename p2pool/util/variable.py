@@ -83,3 +83,39 @@ class Variable(object):
     
     def get_not_none(self):
         return self.get_when_satisfies(lambda val: val is not None)
+
+class DictVariable(Variable):
+    '''
+    Variable holding a dict that is changed in place. add and remove cost
+    O(changed), and added/removed fire with a dict of the affected items,
+    so watchers can follow changes without diffing the whole value.
+    transitioned doesn't fire since the previous value isn't kept.
+    '''
+    
+    def __init__(self, value={}):
+        Variable.__init__(self, dict(value))
+        self.added = Event()
+        self.removed = Event()
+    
+    def set(self, value):
+        removed = dict((k, v) for k, v in self.value.iteritems() if k not in value)
+        added = dict((k, v) for k, v in value.iteritems() if k not in self.value)
+        self._apply(added, removed)
+    
+    def add(self, items):
+        self._apply(dict((k, v) for k, v in items.iteritems() if k not in self.value), {})
+    
+    def remove(self, keys):
+        self._apply({}, dict((k, self.value[k]) for k in keys if k in self.value))
+    
+    def _apply(self, added, removed):
+        if not added and not removed:
+            return
+        for k in removed:
+            del self.value[k]
+        self.value.update(added)
+        if added:
+            self.added.happened(added)
+        if removed:
+            self.removed.happened(removed)
+        self.changed.happened(self.value)
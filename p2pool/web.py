@@ -14,7 +14,7 @@ from twisted.web import resource, static
 import p2pool
 from bitcoin import data as bitcoin_data
 from . import data as p2pool_data, p2p
-from util import deferral, deferred_resource, graph, math, memory, pack, variable
+from util import deferral, deferred_resource, graph, jsonrpc, math, memory, pack, variable
 
 def _atomic_read(filename):
     try:
@@ -45,7 +45,33 @@ def _atomic_write(filename, data):
         os.remove(filename)
         os.rename(filename + '.new', filename)
 
-def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Event()):
+class BlockNotifyResource(resource.Resource):
+    '''
+    Lets bitcoind's -blocknotify tell us about new blocks, e.g. with
+    blocknotify=curl -s http://127.0.0.1:PORT/%s
+    '''
+    
+    isLeaf = True
+    
+    def __init__(self, node):
+        resource.Resource.__init__(self)
+        self.node = node
+    
+    def render_GET(self, request):
+        block_hash = request.path.strip('/')
+        if block_hash:
+            try:
+                block_hash = int(block_hash, 16)
+            except ValueError:
+                request.setResponseCode(400)
+                return 'invalid block hash\n'
+        else:
+            block_hash = None
+        self.node.notify_block(block_hash)
+        return 'ok\n'
+    render_POST = render_GET
+
+def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Event(), stratum_notifier=None):
     node = wb.node
     start_time = time.time()
     
@@ -85,10 +111,11 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             return 'need total argument. go to patron_sendmany/<TOTAL>'
         total = int(float(total)*1e8)
         trunc = int(float(trunc)*1e8)
+        addresses = node.get_current_txout_addresses()
         return json.dumps(dict(
-            (bitcoin_data.script2_to_address(script, node.net.PARENT), value/1e8)
+            (addresses[script], value/1e8)
             for script, value in get_current_scaled_txouts(total, trunc).iteritems()
-            if bitcoin_data.script2_to_address(script, node.net.PARENT) is not None
+            if addresses[script] is not None
         ))
     
     def get_global_stats():
@@ -160,6 +187,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             ),
             miner_hash_rates=miner_hash_rates,
             miner_dead_hash_rates=miner_dead_hash_rates,
+            miner_hash_rate_estimates=wb.local_user_hash_rates.get_rates(), # exponentially weighted, 10 minute time constant
             miner_last_difficulties=miner_last_difficulties,
             efficiency_if_miner_perfect=(1 - stale_orphan_shares/shares)/(1 - global_stale_prop) if shares else None, # ignores dead shares because those are miner's fault and indicated by pseudoshare rejection
             efficiency=(1 - (stale_orphan_shares+stale_doa_shares)/shares)/(1 - global_stale_prop) if shares else None,
@@ -206,7 +234,19 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     web_root.putChild('user_stales', WebInterface(lambda: dict((bitcoin_data.pubkey_hash_to_address(ph, node.net.PARENT), prop) for ph, prop in
         p2pool_data.get_user_stale_props(node.tracker, node.best_share_var.value, node.tracker.get_height(node.best_share_var.value)).iteritems())))
     web_root.putChild('fee', WebInterface(lambda: wb.worker_fee))
-    web_root.putChild('current_payouts', WebInterface(lambda: dict((bitcoin_data.script2_to_address(script, node.net.PARENT), value/1e8) for script, value in node.get_current_txouts().iteritems())))
+    web_root.putChild('work_timing', WebInterface(lambda: wb.work_timing))
+    web_root.putChild('block_submissions', WebInterface(lambda: list(wb.block_submissions)))
+    web_root.putChild('known_txs_stats', WebInterface(node.get_known_txs_stats))
+    web_root.putChild('block_notify_stats', WebInterface(lambda: dict(
+        notifications=node.block_notify_count,
+        duplicates=node.block_notify_dupe_count,
+        latency=wb.work_timing['block_notify_latency'],
+    )))
+    if isinstance(node.bitcoind, jsonrpc.HTTPProxy):
+        web_root.putChild('bitcoind_rpc_stats', WebInterface(node.bitcoind.get_stats))
+    if stratum_notifier is not None:
+        web_root.putChild('stratum_stats', WebInterface(stratum_notifier.get_stats))
+    web_root.putChild('current_payouts', WebInterface(lambda: dict((node.get_current_txout_addresses()[script], value/1e8) for script, value in node.get_current_txouts().iteritems())))
     web_root.putChild('patron_sendmany', WebInterface(get_patron_sendmany, 'text/plain'))
     web_root.putChild('global_stats', WebInterface(get_global_stats))
     web_root.putChild('local_stats', WebInterface(get_local_stats))
@@ -223,6 +263,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         ])
     ))))
     web_root.putChild('peer_versions', WebInterface(lambda: dict(('%s:%i' % peer.addr, peer.other_sub_version) for peer in node.p2p_node.peers.itervalues())))
+    web_root.putChild('peer_traffic_stats', WebInterface(lambda: dict(('%s:%i' % peer.addr, peer.traffic_stats) for peer in node.p2p_node.peers.itervalues())))
     web_root.putChild('payout_addr', WebInterface(lambda: bitcoin_data.pubkey_hash_to_address(wb.my_pubkey_hash, node.net.PARENT)))
     web_root.putChild('recent_blocks', WebInterface(lambda: [dict(
         ts=s.timestamp,
@@ -428,7 +469,8 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         current_txouts = node.get_current_txouts()
         hd.datastreams['current_payout'].add_datum(t, current_txouts.get(bitcoin_data.pubkey_hash_to_script2(wb.my_pubkey_hash), 0)*1e-8)
         miner_hash_rates, miner_dead_hash_rates = wb.get_local_rates()
-        current_txouts_by_address = dict((bitcoin_data.script2_to_address(script, node.net.PARENT), amount) for script, amount in current_txouts.iteritems())
+        current_txout_addresses = node.get_current_txout_addresses()
+        current_txouts_by_address = dict((current_txout_addresses[script], amount) for script, amount in current_txouts.iteritems())
         hd.datastreams['current_payouts'].add_datum(t, dict((user, current_txouts_by_address[user]*1e-8) for user in miner_hash_rates if user in current_txouts_by_address))
         
         hd.datastreams['peers'].add_datum(t, dict(
@@ -1,6 +1,7 @@
 from __future__ import division
 
 import base64
+import collections
 import random
 import re
 import sys
@@ -10,7 +11,7 @@ from twisted.internet import defer
 from twisted.python import log
 
 import bitcoin.getwork as bitcoin_getwork, bitcoin.data as bitcoin_data
-from bitcoin import helper, script, worker_interface
+from bitcoin import script, worker_interface
 from util import forest, jsonrpc, variable, deferral, math, pack
 import p2pool, p2pool.data as p2pool_data
 
@@ -19,7 +20,8 @@ class WorkerBridge(worker_interface.WorkerBridge):
     
     def __init__(self, node, my_pubkey_hash, donation_percentage, merged_urls, worker_fee):
         worker_interface.WorkerBridge.__init__(self)
-        self.recent_shares_ts_work = []
+        self.recent_shares_ts_work = collections.deque(maxlen=50)
+        self.block_submissions = collections.deque(maxlen=100) # found-to-submitted latencies of blocks found by our miners
         
         self.node = node
         self.my_pubkey_hash = my_pubkey_hash
@@ -30,14 +32,23 @@ class WorkerBridge(worker_interface.WorkerBridge):
         self.running = True
         self.pseudoshare_received = variable.Event()
         self.share_received = variable.Event()
-        self.local_rate_monitor = math.RateMonitor(10*60)
-        self.local_addr_rate_monitor = math.RateMonitor(10*60)
+        self.local_rate_monitor = math.BucketRateMonitor(10*60)
+        self.local_miner_rate_monitor = math.BucketRateMonitor(10*60) # keyed by ('work', user) and ('dead_work', user)
+        self.local_addr_rate_monitor = math.BucketRateMonitor(10*60)
+        self.local_user_hash_rates = math.DecayingRates(10*60)
+        self.local_addr_hash_rates = math.DecayingRates(10*60)
         
         self.removed_unstales_var = variable.Variable((0, 0, 0))
         self.removed_doa_unstales_var = variable.Variable(0)
         
         self.last_work_shares = variable.Variable( {} )
         
+        self._user_details_cache = {}
+        self._user_details_net = None
+        self._merkle_tree = bitcoin_data.MerkleTree([None])
+        self._template = self._template_key = None
+        self.work_timing = dict(template_build_time=None, get_work_time=None, stratum_notify_time=None, block_notify_latency=None)
+        
         self.my_share_hashes = set()
         self.my_doa_share_hashes = set()
         
@@ -63,10 +74,12 @@ class WorkerBridge(worker_interface.WorkerBridge):
         # MERGED WORK
         
         self.merged_work = variable.Variable({})
+        self._merged_proxies = []
         
         @defer.inlineCallbacks
         def set_merged_work(merged_url, merged_userpass):
             merged_proxy = jsonrpc.HTTPProxy(merged_url, dict(Authorization='Basic ' + base64.b64encode(merged_userpass)))
+            self._merged_proxies.append(merged_proxy)
             while self.running:
                 auxblock = yield deferral.retry('Error while calling merged getauxblock on %s:' % (merged_url,), 30)(merged_proxy.rpc_getauxblock)()
                 self.merged_work.set(math.merge_dicts(self.merged_work.value, {auxblock['chainid']: dict(
@@ -121,6 +134,12 @@ class WorkerBridge(worker_interface.WorkerBridge):
     
     def stop(self):
         self.running = False
+        for merged_proxy in self._merged_proxies:
+            merged_proxy.close()
+    
+    def pop_block_notify_time(self):
+        '''Returns when bitcoind notified us of the block current work builds on, if nothing has claimed it yet'''
+        return self.node.pop_block_notify_time(self.current_work.value['previous_block'])
     
     def get_stale_counts(self):
         '''Returns (orphans, doas), total, (orphans_recorded_in_chain, doas_recorded_in_chain)'''
@@ -138,6 +157,21 @@ class WorkerBridge(worker_interface.WorkerBridge):
         return (my_shares_not_in_chain - my_doa_shares_not_in_chain, my_doa_shares_not_in_chain), my_shares, (orphans_recorded_in_chain, doas_recorded_in_chain)
     
     def get_user_details(self, username):
+        if self._user_details_net is not self.node.net.PARENT:
+            self._user_details_cache = {}
+            self._user_details_net = self.node.net.PARENT
+        if username not in self._user_details_cache:
+            if len(self._user_details_cache) >= 10000:
+                self._user_details_cache = {}
+            self._user_details_cache[username] = self._parse_user_details(username)
+        user, pubkey_hash, desired_share_target, desired_pseudoshare_target = self._user_details_cache[username]
+        
+        if random.uniform(0, 100) < self.worker_fee or pubkey_hash is None:
+            pubkey_hash = self.my_pubkey_hash
+        
+        return user, pubkey_hash, desired_share_target, desired_pseudoshare_target
+    
+    def _parse_user_details(self, username):
         contents = re.split('([+/])', username)
         assert len(contents) % 2 == 1
         
@@ -159,13 +193,10 @@ class WorkerBridge(worker_interface.WorkerBridge):
                     if p2pool.DEBUG:
                         log.err()
         
-        if random.uniform(0, 100) < self.worker_fee:
-            pubkey_hash = self.my_pubkey_hash
-        else:
-            try:
-                pubkey_hash = bitcoin_data.address_to_pubkey_hash(user, self.node.net.PARENT)
-            except: # XXX blah
-                pubkey_hash = self.my_pubkey_hash
+        try:
+            pubkey_hash = bitcoin_data.address_to_pubkey_hash(user, self.node.net.PARENT)
+        except: # XXX blah
+            pubkey_hash = None
         
         return user, pubkey_hash, desired_share_target, desired_pseudoshare_target
     
@@ -179,7 +210,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
     
     def _estimate_local_hash_rate(self):
         if len(self.recent_shares_ts_work) == 50:
-            hash_rate = sum(work for ts, work in self.recent_shares_ts_work[1:])//(self.recent_shares_ts_work[-1][0] - self.recent_shares_ts_work[0][0])
+            hash_rate = (sum(work for ts, work in self.recent_shares_ts_work) - self.recent_shares_ts_work[0][1])//(self.recent_shares_ts_work[-1][0] - self.recent_shares_ts_work[0][0])
             if hash_rate > 0:
                 return hash_rate
         return None
@@ -187,23 +218,33 @@ class WorkerBridge(worker_interface.WorkerBridge):
     def get_local_rates(self):
         miner_hash_rates = {}
         miner_dead_hash_rates = {}
-        datums, dt = self.local_rate_monitor.get_datums_in_last()
-        for datum in datums:
-            miner_hash_rates[datum['user']] = miner_hash_rates.get(datum['user'], 0) + datum['work']/dt
-            if datum['dead']:
-                miner_dead_hash_rates[datum['user']] = miner_dead_hash_rates.get(datum['user'], 0) + datum['work']/dt
+        totals, dt = self.local_miner_rate_monitor.get_totals()
+        for key, total in totals.iteritems():
+            if key[0] == 'work':
+                miner_hash_rates[key[1]] = total/dt
+            elif key[0] == 'dead_work':
+                miner_dead_hash_rates[key[1]] = total/dt
         return miner_hash_rates, miner_dead_hash_rates
     
     def get_local_addr_rates(self):
-        addr_hash_rates = {}
-        datums, dt = self.local_addr_rate_monitor.get_datums_in_last()
-        for datum in datums:
-            addr_hash_rates[datum['pubkey_hash']] = addr_hash_rates.get(datum['pubkey_hash'], 0) + datum['work']/dt
-        return addr_hash_rates
+        totals, dt = self.local_addr_rate_monitor.get_totals()
+        return dict((pubkey_hash, total/dt) for pubkey_hash, total in totals.iteritems())
     
-    def get_work(self, pubkey_hash, desired_share_target, desired_pseudoshare_target):
-        if self.node.best_share_var.value is None and self.node.net.PERSIST:
-            raise jsonrpc.Error_for_code(-12345)(u'p2pool is downloading shares')
+    def _get_coinbase_merkle_link(self, other_transaction_hashes):
+        # other_transaction_hashes only changes with the template, and usually by having transactions appended
+        tree = self._merkle_tree
+        if len(tree) > len(other_transaction_hashes) + 1 or tree.hashes[1:] != other_transaction_hashes[:len(tree) - 1]:
+            tree = self._merkle_tree = bitcoin_data.MerkleTree([None])
+        tree.append(other_transaction_hashes[len(tree) - 1:])
+        return tree.get_link(0)
+    
+    def _get_template(self):
+        '''Returns the parts of work that are shared by all miners, rebuilding them when the best share, block template, or merged work changes'''
+        key = self.node.best_share_var.value, self.current_work.value, self.merged_work.value
+        if self._template is not None and self._template_key[0] == key[0] and all(a is b for a, b in zip(self._template_key[1:], key[1:])):
+            return self._template
+        
+        start = time.time()
         
         if self.merged_work.value:
             tree, size = bitcoin_data.make_auxpow_tree(self.merged_work.value)
@@ -244,6 +285,47 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 else:
                     share_type = previous_share_type
         
+        lookbehind = 3600//self.node.net.SHARE_PERIOD
+        if previous_share is not None and self.node.tracker.get_height(previous_share.hash) > lookbehind:
+            pool_attempts_per_second = p2pool_data.get_pool_attempts_per_second(self.node.tracker, self.node.best_share_var.value, lookbehind)
+        else:
+            pool_attempts_per_second = None
+        
+        prepared = share_type.prepare_transaction(
+            tracker=self.node.tracker,
+            previous_share_hash=self.node.best_share_var.value,
+            block_target=self.current_work.value['bits'].target,
+            desired_other_transaction_hashes_and_fees=zip(tx_hashes, self.current_work.value['transaction_fees']),
+            net=self.node.net,
+            known_txs=tx_map,
+        )
+        
+        self._template = dict(
+            mm_data=mm_data,
+            mm_later=mm_later,
+            tx_map=tx_map,
+            tx_hashes=tx_hashes,
+            share_type=share_type,
+            previous_share=previous_share,
+            pool_attempts_per_second=pool_attempts_per_second,
+            prepared=prepared,
+            merkle_link=self._get_coinbase_merkle_link(prepared['other_transaction_hashes']),
+            other_transactions=[tx_map[tx_hash] for tx_hash in prepared['other_transaction_hashes']],
+        )
+        self._template_key = key
+        self.work_timing['template_build_time'] = time.time() - start
+        return self._template
+    
+    def get_work(self, pubkey_hash, desired_share_target, desired_pseudoshare_target):
+        if self.node.best_share_var.value is None and self.node.net.PERSIST:
+            raise jsonrpc.Error_for_code(-12345)(u'p2pool is downloading shares')
+        
+        start = time.time()
+        template = self._get_template()
+        mm_data, mm_later = template['mm_data'], template['mm_later']
+        tx_map, tx_hashes = template['tx_map'], template['tx_hashes']
+        share_type, previous_share = template['share_type'], template['previous_share']
+        
         if desired_share_target is None:
             desired_share_target = 2**256-1
             local_hash_rate = self._estimate_local_hash_rate()
@@ -251,11 +333,9 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 desired_share_target = min(desired_share_target,
                     bitcoin_data.average_attempts_to_target(local_hash_rate * self.node.net.SHARE_PERIOD / 0.0167)) # limit to 1.67% of pool shares by modulating share difficulty
             
-            local_addr_rates = self.get_local_addr_rates()
-            lookbehind = 3600//self.node.net.SHARE_PERIOD
             block_subsidy = self.node.bitcoind_work.value['subsidy']
-            if previous_share is not None and self.node.tracker.get_height(previous_share.hash) > lookbehind:
-                expected_payout_per_block = local_addr_rates.get(pubkey_hash, 0)/p2pool_data.get_pool_attempts_per_second(self.node.tracker, self.node.best_share_var.value, lookbehind) \
+            if template['pool_attempts_per_second'] is not None:
+                expected_payout_per_block = self.local_addr_hash_rates.get_rate(pubkey_hash)/template['pool_attempts_per_second'] \
                     * block_subsidy*(1-self.donation_percentage/100) # XXX doesn't use global stale rate to compute pool hash
                 if expected_payout_per_block < self.node.net.PARENT.DUST_THRESHOLD:
                     desired_share_target = min(desired_share_target,
@@ -290,29 +370,35 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 net=self.node.net,
                 known_txs=tx_map,
                 base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.current_work.value['height']),
+                prepared=template['prepared'],
             )
         
         packed_gentx = bitcoin_data.tx_type.pack(gentx)
-        other_transactions = [tx_map[tx_hash] for tx_hash in other_transaction_hashes]
+        other_transactions = template['other_transactions']
         
         mm_later = [(dict(aux_work, target=aux_work['target'] if aux_work['target'] != 'p2pool' else share_info['bits'].target), index, hashes) for aux_work, index, hashes in mm_later]
         
+        def clip_target(target):
+            target = max(target, share_info['bits'].target)
+            for aux_work, index, hashes in mm_later:
+                target = max(target, aux_work['target'])
+            return math.clip(target, self.node.net.PARENT.SANE_TARGET_RANGE)
+        
         if desired_pseudoshare_target is None:
             target = bitcoin_data.difficulty_to_target(float(1.0 / self.node.net.PARENT.DUMB_SCRYPT_DIFF))
+            target_range = clip_target(0), clip_target(target) # bounds for per-connection difficulty adjustment
             local_hash_rate = self._estimate_local_hash_rate()
             if local_hash_rate is not None:
                 target = min(target,
                     bitcoin_data.average_attempts_to_target(local_hash_rate * 1)) # limit to 1 share response every second by modulating pseudoshare difficulty
         else:
             target = desired_pseudoshare_target
-        target = max(target, share_info['bits'].target)
-        for aux_work, index, hashes in mm_later:
-            target = max(target, aux_work['target'])
-        target = math.clip(target, self.node.net.PARENT.SANE_TARGET_RANGE)
+            target_range = None
+        target = clip_target(target)
         
         getwork_time = time.time()
         lp_count = self.new_work_event.times
-        merkle_link = bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0)
+        merkle_link = template['merkle_link']
         
         print 'New work for worker! Difficulty: %.06f Share difficulty: %.06f Total block value: %.6f %s including %i transactions' % (
             bitcoin_data.target_to_difficulty(target),
@@ -333,24 +419,41 @@ class WorkerBridge(worker_interface.WorkerBridge):
             timestamp=self.current_work.value['time'],
             bits=self.current_work.value['bits'],
             share_target=target,
+            share_target_range=target_range,
         )
         
+        self.work_timing['get_work_time'] = time.time() - start
+        
         received_header_hashes = set()
         
-        def got_response(header, user, coinbase_nonce):
+        def got_response(header, user, coinbase_nonce, pseudoshare_target=None, header_hash=None, pow_hash=None, found_time=None, new_work_times=None):
+            # header_hash and pow_hash may be passed in by callers that already computed them off the reactor thread,
+            # along with found_time and new_work_times, the time and new_work_event.times when the submission arrived
             assert len(coinbase_nonce) == self.COINBASE_NONCE_LENGTH
+            response_target = target if pseudoshare_target is None else clip_target(pseudoshare_target)
             new_packed_gentx = packed_gentx[:-self.COINBASE_NONCE_LENGTH-4] + coinbase_nonce + packed_gentx[-4:] if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else packed_gentx
-            new_gentx = bitcoin_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
+            get_new_gentx = lambda: bitcoin_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
             
-            header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header))
-            pow_hash = self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header))
+            if found_time is None:
+                found_time = time.time()
+            if header_hash is None or pow_hash is None:
+                header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header))
+                pow_hash = self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header))
             try:
                 if pow_hash <= header['bits'].target or p2pool.DEBUG:
-                    helper.submit_block(dict(header=header, txs=[new_gentx] + other_transactions), False, self.node.factory, self.node.bitcoind, self.node.bitcoind_work, self.node.net)
+                    # P2P submission happens right away; RPC submission overlaps with the share being added and broadcast below
+                    block = dict(header=header, txs=[get_new_gentx()] + other_transactions)
+                    df = self.node.submit_block(block, False, bitcoin_data.block_type.pack(block), pow_hash)
                     if pow_hash <= header['bits'].target:
                         print
                         print 'GOT BLOCK FROM MINER! Passing to bitcoind! %s%064x' % (self.node.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, header_hash)
                         print
+                        submission = dict(hash='%064x' % (header_hash,), found_time=found_time, p2p_latency=time.time() - found_time, rpc_latency=None)
+                        self.block_submissions.append(submission)
+                        @df.addCallback
+                        def _(success, submission=submission):
+                            if success:
+                                submission['rpc_latency'] = time.time() - submission['found_time']
             except:
                 log.err(None, 'Error while processing potential block:')
             
@@ -359,7 +462,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
             assert header['merkle_root'] == bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), merkle_link)
             assert header['bits'] == ba['bits']
             
-            on_time = self.new_work_event.times == lp_count
+            on_time = (self.new_work_event.times if new_work_times is None else new_work_times) == lp_count
             
             for aux_work, index, hashes in mm_later:
                 try:
@@ -368,7 +471,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
                             pack.IntType(256, 'big').pack(aux_work['hash']).encode('hex'),
                             bitcoin_data.aux_pow_type.pack(dict(
                                 merkle_tx=dict(
-                                    tx=new_gentx,
+                                    tx=get_new_gentx(),
                                     block_hash=header_hash,
                                     merkle_link=merkle_link,
                                 ),
@@ -414,21 +517,33 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 
                 self.share_received.happened(bitcoin_data.target_to_average_attempts(share.target), not on_time, share.hash)
             
-            if pow_hash > target:
+            if pow_hash > response_target:
                 print 'Worker %s submitted share with hash > target:' % (user,)
                 print '    Hash:   %56x' % (pow_hash,)
-                print '    Target: %56x' % (target,)
+                print '    Target: %56x' % (response_target,)
             elif header_hash in received_header_hashes:
                 print >>sys.stderr, 'Worker %s submitted share more than once!' % (user,)
             else:
                 received_header_hashes.add(header_hash)
                 
-                self.pseudoshare_received.happened(bitcoin_data.target_to_average_attempts(target), not on_time, user)
-                self.recent_shares_ts_work.append((time.time(), bitcoin_data.target_to_average_attempts(target)))
-                while len(self.recent_shares_ts_work) > 50:
-                    self.recent_shares_ts_work.pop(0)
-                self.local_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), dead=not on_time, user=user, share_target=share_info['bits'].target))
-                self.local_addr_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), pubkey_hash=pubkey_hash))
+                self.pseudoshare_received.happened(bitcoin_data.target_to_average_attempts(response_target), not on_time, user)
+                work = bitcoin_data.target_to_average_attempts(response_target)
+                self.recent_shares_ts_work.append((time.time(), work))
+                self.local_rate_monitor.add(dict([
+                    ('work', work),
+                    ('shares', work/bitcoin_data.target_to_average_attempts(share_info['bits'].target)),
+                    ('pseudoshares', 1),
+                ] + ([
+                    ('dead_pseudoshares', 1),
+                ] if not on_time else [])))
+                self.local_miner_rate_monitor.add(dict([
+                    (('work', user), work),
+                ] + ([
+                    (('dead_work', user), work),
+                ] if not on_time else [])))
+                self.local_addr_rate_monitor.add({pubkey_hash: work})
+                self.local_user_hash_rates.add(user, work)
+                self.local_addr_hash_rates.add(pubkey_hash, work)
             
             return on_time
         